@@ -0,0 +1,251 @@
+"""
+Admission control for LLM-backed endpoints.
+
+- Per-user token buckets cap how fast one user can start LLM work.
+- Per-model concurrency limits cap in-flight LLM calls per worker. Requests over
+  the limit wait in a bounded FIFO queue; a full queue or a wait past the deadline
+  is shed immediately with 429 + Retry-After instead of piling onto the provider.
+- The limiters live on the app's event loop (bind_model_limiters on startup).
+  Calls from other loops, such as quiz generation in ingestion threads, take
+  their slots from the same limiters, so the cap covers the whole worker.
+"""
+import os
+import math
+import time
+import asyncio
+import weakref
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from cachetools import TTLCache
+from fastapi import HTTPException
+
+# Per-user rate: sustained requests per minute and burst size
+USER_RATE_PER_MINUTE = float(os.environ.get("ADMISSION_USER_RATE_PER_MINUTE", "20"))
+USER_BURST = float(os.environ.get("ADMISSION_USER_BURST", "5"))
+# Per-model concurrency (per worker), e.g. "gpt-4.1=16,gpt-4.1-mini=32"; others use the default
+DEFAULT_MODEL_CONCURRENCY = int(os.environ.get("ADMISSION_MODEL_CONCURRENCY", "16"))
+MODEL_CONCURRENCY = {
+    name.strip(): int(limit)
+    for name, _, limit in (
+        item.partition("=") for item in os.environ.get("ADMISSION_MODEL_LIMITS", "").split(",") if "=" in item
+    )
+}
+# Waiting room per model and how long a request may wait in it (seconds)
+QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "32"))
+QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))
+
+
+def _too_many_requests(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Take one token. Returns 0 on success, otherwise the seconds until one is available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+# Idle buckets are full again after capacity / rate seconds, so they can be dropped
+_buckets: TTLCache = TTLCache(
+    maxsize=50_000, ttl=max(60.0, USER_BURST / (USER_RATE_PER_MINUTE / 60.0))
+)
+
+
+def check_user_rate(user_key: Optional[str]) -> None:
+    """
+    Charge one request to the user's bucket; raises 429 when it is empty.
+    """
+    if not user_key or USER_RATE_PER_MINUTE <= 0:
+        return
+    bucket = _buckets.get(user_key)
+    if bucket is None:
+        bucket = TokenBucket(USER_RATE_PER_MINUTE / 60.0, USER_BURST)
+    # Re-insert on every hit so active users' buckets don't expire
+    _buckets[user_key] = bucket
+    wait = bucket.take()
+    if wait > 0:
+        raise _too_many_requests("Too many requests, please slow down", wait)
+
+
+class Slot:
+    """
+    One unit of model concurrency. Release is idempotent.
+    """
+
+    def __init__(self, limiter: "ConcurrencyLimiter"):
+        self._limiter = limiter
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._limiter._release(time.monotonic() - self._started)
+
+    async def __aenter__(self) -> "Slot":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+
+class RemoteSlot(Slot):
+    """
+    A slot held on the app loop by code running on another event loop.
+    """
+
+    def __init__(self, slot: Slot, loop: asyncio.AbstractEventLoop):
+        self._slot = slot
+        self._loop = loop
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            try:
+                self._loop.call_soon_threadsafe(self._slot.release)
+            except RuntimeError:
+                # The app loop has shut down, and its limiters with it
+                pass
+
+
+class ConcurrencyLimiter:
+    """
+    Semaphore with a bounded FIFO wait queue and shedding (one per model per event loop).
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        # Moving average of how long a slot is held, used for Retry-After
+        self._service_time = 5.0
+
+    def retry_after(self) -> float:
+        return self._service_time * (len(self._waiters) + 1) / self.limit
+
+    def check_capacity(self) -> None:
+        """
+        Fail fast (before doing any work) when the wait queue is already full.
+        """
+        if self.active >= self.limit and len(self._waiters) >= self.max_queue:
+            raise _too_many_requests(f"{self.name} is at capacity, please retry shortly", self.retry_after())
+
+    async def acquire(self, timeout: float = QUEUE_TIMEOUT, shed: bool = True) -> Slot:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return Slot(self)
+        if shed:
+            self.check_capacity()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                self._release(None)
+            else:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise _too_many_requests(f"{self.name} is at capacity, please retry shortly", self.retry_after())
+        return Slot(self)
+
+    def _release(self, held_for: Optional[float]) -> None:
+        if held_for is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * held_for
+        # Hand the slot straight to the next live waiter (FIFO), otherwise free it
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+# Loop that owns the worker's limiters, set on startup
+_app_loop: Optional[asyncio.AbstractEventLoop] = None
+# Limiters hold futures, so they are kept per event loop; only the app loop's are
+# used while it runs, other loops' are for code running without the app
+_limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, ConcurrencyLimiter]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_model_limiter(model: str) -> ConcurrencyLimiter:
+    loop = asyncio.get_running_loop()
+    limiters = _limiters.setdefault(loop, {})
+    limiter = limiters.get(model)
+    if limiter is None:
+        limiter = ConcurrencyLimiter(model, MODEL_CONCURRENCY.get(model, DEFAULT_MODEL_CONCURRENCY), QUEUE_SIZE)
+        limiters[model] = limiter
+    return limiter
+
+
+def bind_model_limiters() -> None:
+    """
+    Make the running loop's limiters the ones every loop in this process uses
+    (called on app startup).
+    """
+    global _app_loop
+    _app_loop = asyncio.get_running_loop()
+
+
+def admit(user_key: Optional[str], model: str) -> None:
+    """
+    Cheap pre-check before a request does any work: user rate, then model queue space.
+    """
+    check_user_rate(user_key)
+    get_model_limiter(model).check_capacity()
+
+
+async def acquire_model_slot(model: str, timeout: float = QUEUE_TIMEOUT, shed: bool = True) -> Slot:
+    """
+    Wait for a concurrency slot for model. With shed=False (background work) the
+    queue bound is ignored and only the timeout applies.
+    """
+    app_loop = _app_loop
+    if app_loop is None or app_loop is asyncio.get_running_loop() or not app_loop.is_running():
+        return await get_model_limiter(model).acquire(timeout=timeout, shed=shed)
+
+    # Another loop (an ingestion thread): queue on the app loop's limiter
+    future = asyncio.run_coroutine_threadsafe(acquire_model_slot(model, timeout, shed), app_loop)
+    try:
+        slot = await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(lambda granted: _release_granted(granted, app_loop))
+        raise
+    return RemoteSlot(slot, app_loop)
+
+
+def _release_granted(future, loop: asyncio.AbstractEventLoop) -> None:
+    # A slot granted just as the waiting caller was cancelled goes straight back
+    if not future.cancelled() and future.exception() is None:
+        RemoteSlot(future.result(), loop).release()
@@ -1,20 +1,28 @@
 from __future__ import annotations as _annotations
 
 # Import Basics
-import os
 from dotenv import load_dotenv
-from dataclasses import dataclass
-from typing import List, Optional
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
 
 # Import PydanticAI (Agent creation)
 from pydantic_ai import Agent, RunContext
 from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.settings import ModelSettings
 
-# Import Gemini (Embedding)
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+# Import retrieval (Embedding + Vector Database context assembly)
+from retrieval import (
+    RetrievalPrefetch,
+    retrieve_documentation,
+    retrieve_documentation_batch,
+)
 
-# Import Supabase (Vector Database)
-from supabase import Client
+# Import documentation outline (page listing + page content)
+from documentation import (
+    get_page_content as fetch_page_content,
+    list_documentation_pages as fetch_documentation_pages,
+)
 
 # Import OpenAI (LLM)
 from openai import AsyncOpenAI
@@ -22,18 +30,38 @@ from openai import AsyncOpenAI
 # Load environment variables
 load_dotenv()
 
+# Import shared OpenAI client (pooled per event loop)
+from llm_client import get_chat_model
+
+# Import per-turn latency breakdown (model request and tool call timers)
+from timings import TimedModel, tool_call
+
 # Initialize LLM
 llm = "gpt-4.1"
 model = OpenAIChatModel(llm)
 
+
+def get_agent_model() -> TimedModel:
+    """
+    The agent's model bound to the shared, pooled OpenAI client, timing each
+    request. Pass it as model= when running an agent; the module-level model only
+    defines the agents.
+    """
+    return TimedModel(get_chat_model(llm))
+
 # Step 1: Define the dependencies
 @dataclass
 class CPSSChatDeps:
-    supabase: Client
     openai_client: AsyncOpenAI
     # Context for scoping retrieval
     course_id: Optional[str] = None
     course_code: Optional[str] = None
+    # Chat session, so follow-ups can reuse the chunks retrieved in earlier turns
+    session_id: Optional[str] = None
+    # One entry per documentation lookup made during the run (surfaced to streaming clients)
+    retrieval_log: List[Dict[str, Any]] = field(default_factory=list)
+    # Speculative retrieval for the raw user message (started before the first model call)
+    prefetch: Optional[RetrievalPrefetch] = None
 
 # Prompt for AI Agent (Instructions)
 # Base template; can be formatted with a specific course at runtime.
@@ -44,12 +72,13 @@ including lecture notes, slides, and other assignments to help you answer questi
 
 Your only job is to assist with this and you don't answer other questions besides describing what you are able to do.
 
-When responding to user queries, you may be provided with previous conversation context to help you understand follow-up questions and references to previous topics discussed. Use this context to provide coherent and relevant responses that build upon the conversation history.
+When responding to user queries, you may be provided with a summary of the conversation so far and previous conversation context to help you understand follow-up questions and references to previous topics discussed. Use this context to provide coherent and relevant responses that build upon the conversation history.
 
 Don't ask the user before taking an action, just do it. Always make sure you look at the documentation with the provided tools before answering the user's question unless you have already done so.
 
 When you first look at the documentation, always start with RAG.
-Then also always check the list of available documentation pages and retrieve the content of page(s) if it'll help.
+If the question spans several concepts, retrieve them together in one call with one sub-query per concept.
+Then also always check the list of available documentation pages (list_documentation_pages) and retrieve the content of page(s) (get_page_content) if it'll help.
 
 Always let the user know when you didn't find the answer in the documentation - be honest.
 """
@@ -61,124 +90,117 @@ def _build_system_prompt(course_title: Optional[str], course_code: Optional[str]
     code = course_code or "CZ4055"
     return system_prompt_template.format(course_title=title, course_code=code)
 
-# Step 2: Define the agent
-# Default agent (fallback) with legacy course prompt
-cpss_chat_expert = Agent(
-    model,
-    system_prompt=_build_system_prompt(None, None),
-    deps_type=CPSSChatDeps,
-    retries=2,
-)
-
-async def get_embedding(text: str) -> List[float]:
-    try:
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/gemini-embedding-001")
-        embedding = embeddings.embed_query(text)
-        return embedding
-    except Exception as e:
-        print(f"Error getting embedding: {e}")
-
-# Step 3: Define the tools for the default agent
-@cpss_chat_expert.tool
+# Step 2: Define the tools (shared by every agent so tool schemas are identical)
 async def retrieve_relevant_documentation(ctx: RunContext[CPSSChatDeps], user_query: str) -> str:
     """
     Retrieve relevant documentation chunks based on the query with RAG.
     
     Args:
-        ctx: The context including the Supabase client and OpenAI client
+        ctx: The context including the OpenAI client and course scope
         user_query: The user's question or query
     
     Returns:
-        A formatted string containing the top 5 most relevant documentation chunks
+        The most relevant, de-duplicated documentation chunks that fit the context budget
     """
-    try:
-        # Get the embeddings for the query
-        query_embedding = await get_embedding(user_query)
-
-        # Build an optional filter for course scoping
-        filter_payload = {}
-        if ctx.deps.course_id:
-            filter_payload["course_id"] = ctx.deps.course_id
-        elif ctx.deps.course_code:
-            filter_payload["course_code"] = ctx.deps.course_code
-
-        # Query Supabase for relevant documents, scoped by course when available
-        result = ctx.deps.supabase.rpc(
-            "match_ingested_documents",
-            {
-                "query_embedding": query_embedding,
-                "match_count": 5,
-                "filter": filter_payload,
-            }
-        ).execute()
-        print(result)
-
-        if not result.data:
-            return "No relevant documentation found."
-        
-        # Format the results
-        formatted_chunks = []
-        for doc in result.data:
-            chunk_text = f"""
-            {doc['content']}
-            """
-            formatted_chunks.append(chunk_text)
-        
-        return "\n\n---\n\n".join(formatted_chunks)
+    with tool_call("retrieve_relevant_documentation"):
+        return await retrieve_documentation(
+            user_query,
+            course_id=ctx.deps.course_id,
+            course_code=ctx.deps.course_code,
+            retrieval_log=ctx.deps.retrieval_log,
+            prefetch=ctx.deps.prefetch,
+            session_id=ctx.deps.session_id,
+        )
+
+
+async def retrieve_documentation_for_queries(
+    ctx: RunContext[CPSSChatDeps], sub_queries: List[str]
+) -> str:
+    """
+    Retrieve documentation for several focused sub-queries in a single call with RAG.
+    Use this instead of repeated retrieve_relevant_documentation calls when the
+    question spans several concepts (e.g. a comparison or multi-part question).
+    
+    Args:
+        ctx: The context including the OpenAI client and course scope
+        sub_queries: One short, self-contained search query per concept (at most 5)
     
-    except Exception as e:
-        print(f"Error retrieving documentation: {e}")
-        return f"Error retrieving documentation: {str(e)}"
+    Returns:
+        The merged, de-duplicated documentation chunks for all sub-queries
+    """
+    with tool_call("retrieve_documentation_for_queries"):
+        return await retrieve_documentation_batch(
+            sub_queries,
+            course_id=ctx.deps.course_id,
+            course_code=ctx.deps.course_code,
+            retrieval_log=ctx.deps.retrieval_log,
+            session_id=ctx.deps.session_id,
+        )
 
 
-def get_cpss_agent(course_title: Optional[str], course_code: Optional[str]) -> Agent:
-    """Build an Agent instance with a course-specific system prompt and same tools."""
+async def list_documentation_pages(ctx: RunContext[CPSSChatDeps]) -> str:
+    """
+    List the course's documentation files and their section headings.
+    
+    Args:
+        ctx: The context including the course scope
+    
+    Returns:
+        One line per file and section, each with a page id for get_page_content
+    """
+    with tool_call("list_documentation_pages"):
+        return await fetch_documentation_pages(ctx.deps.course_id, ctx.deps.course_code)
+
+
+async def get_page_content(ctx: RunContext[CPSSChatDeps], page_id: str) -> str:
+    """
+    Retrieve the full content of a documentation page.
+    
+    Args:
+        ctx: The context including the course scope
+        page_id: A page id from list_documentation_pages ("2" for a whole file, "2.3" for one section)
+    
+    Returns:
+        The page content
+    """
+    with tool_call("get_page_content"):
+        return await fetch_page_content(ctx.deps.course_id, ctx.deps.course_code, page_id)
+
+
+def _build_agent(system_prompt: str) -> Agent:
     agent = Agent(
         model,
-        system_prompt=_build_system_prompt(course_title, course_code),
+        system_prompt=system_prompt,
         deps_type=CPSSChatDeps,
         retries=2,
     )
+    agent.tool(retrieve_relevant_documentation)
+    agent.tool(retrieve_documentation_for_queries)
+    agent.tool(list_documentation_pages)
+    agent.tool(get_page_content)
+    return agent
 
-    @agent.tool  # type: ignore[misc]
-    async def retrieve_relevant_documentation_dynamic(
-        ctx: RunContext[CPSSChatDeps], user_query: str
-    ) -> str:
-        try:
-            query_embedding = await get_embedding(user_query)
-
-            filter_payload = {}
-            if ctx.deps.course_id:
-                filter_payload["course_id"] = ctx.deps.course_id
-            elif ctx.deps.course_code:
-                filter_payload["course_code"] = ctx.deps.course_code
-
-            result = ctx.deps.supabase.rpc(
-                "match_ingested_documents",
-                {
-                    "query_embedding": query_embedding,
-                    "match_count": 5,
-                    "filter": filter_payload,
-                },
-            ).execute()
-
-            print(result)
-
-            if not result.data:
-                return "No relevant documentation found."
-
-            formatted_chunks = []
-            for doc in result.data:
-                chunk_text = f"""
-                {doc['content']}
-                """
-                formatted_chunks.append(chunk_text)
-
-            return "\n\n---\n\n".join(formatted_chunks)
-        except Exception as e:
-            print(f"Error retrieving documentation: {e}")
-            return f"Error retrieving documentation: {str(e)}"
 
-    return agent
+# Step 3: Define the agents
+# Default agent (fallback) with legacy course prompt
+cpss_chat_expert = _build_agent(_build_system_prompt(None, None))
 
-    
\ No newline at end of file
+
+@lru_cache(maxsize=256)
+def get_cpss_agent(course_title: Optional[str], course_code: Optional[str]) -> Agent:
+    """
+    Return the course-specific agent. Agents are cached per course so the system
+    prompt and tool schemas (the cacheable prompt prefix) are byte-identical across
+    turns and sessions; everything volatile goes into the user message.
+    """
+    return _build_agent(_build_system_prompt(course_title, course_code))
+
+
+def prompt_cache_settings(course_id: Optional[str]) -> ModelSettings:
+    """
+    Model settings that route requests sharing a course prefix to the same
+    provider-side prompt cache.
+    """
+    if not course_id:
+        return ModelSettings()
+    return ModelSettings(extra_body={"prompt_cache_key": f"course-{course_id}"})
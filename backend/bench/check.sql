@@ -0,0 +1,53 @@
+-- Correctness checks for script/vector-bench.sh, run after seeding the courses
+-- and syncing the per-course indexes (every bench course qualifies for one).
+do $$
+begin
+  if exists (
+    select 1 from bench_courses b
+    where not exists (
+      select 1 from pg_indexes i where i.indexname = course_vector_index_name(b.course_id)
+    )
+  ) then
+    raise exception 'sync_course_vector_indexes did not index every bench course';
+  end if;
+end;
+$$;
+
+-- Course-filtered searches return match_count rows, all from the course, however
+-- many other courses share the global index
+do $$
+declare
+  v_query vector := (select v from bench_queries where n = 1);
+  v_course record;
+  v_filter jsonb;
+  v_rows int;
+  v_outside int;
+begin
+  for v_course in
+    select b.course_id, c.code
+    from bench_courses b
+    join courses c on c.id = b.course_id
+    order by b.n
+    limit 3
+  loop
+    foreach v_filter in array array[
+      jsonb_build_object('course_id', v_course.course_id),
+      jsonb_build_object('course_code', v_course.code)
+    ] loop
+      select count(*), count(*) filter (where m.course_id <> v_course.course_id)
+      into v_rows, v_outside
+      from match_ingested_documents(v_query, 20, v_filter) m;
+      if v_rows <> 20 or v_outside > 0 then
+        raise exception 'match_ingested_documents(%): % rows, % from other courses', v_filter, v_rows, v_outside;
+      end if;
+
+      select count(*), count(*) filter (where m.course_id <> v_course.course_id)
+      into v_rows, v_outside
+      from match_ingested_documents_two_stage(v_query, 20, v_filter) m;
+      if v_rows <> 20 or v_outside > 0 then
+        raise exception 'match_ingested_documents_two_stage(%): % rows, % from other courses', v_filter, v_rows, v_outside;
+      end if;
+    end loop;
+  end loop;
+end;
+$$;
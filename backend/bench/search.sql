@@ -0,0 +1,9 @@
+-- pgbench transaction: one course-scoped top-20 search with a random query vector
+\set q random(1, 100)
+\set c random(1, :courses)
+select count(*) from match_course_documents(
+  (select v from bench_queries where n = :q),
+  (select course_id from bench_courses where n = :c),
+  20,
+  :ef_search
+);
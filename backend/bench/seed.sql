@@ -0,0 +1,46 @@
+-- Seed synthetic courses for the vector search benchmark (script/vector-bench.sh).
+-- Variables: :courses (total courses wanted), :chunks (chunks per course).
+-- Re-running with a larger :courses only adds the missing courses.
+
+create table if not exists bench_courses (n int primary key, course_id uuid not null);
+create table if not exists bench_queries (n int primary key, v vector(768) not null);
+
+insert into bench_queries (n, v)
+select q, (select array_agg(random() - 0.5)::vector(768) from generate_series(1, 768) where q > 0)
+from generate_series(1, 100) q
+on conflict (n) do nothing;
+
+with new_courses as (
+  select n from generate_series(1, :courses) n
+  where n not in (select n from bench_courses)
+), inserted as (
+  insert into courses (code, name)
+  select 'BENCH' || n, 'Benchmark course ' || n from new_courses
+  returning id, code
+)
+insert into bench_courses (n, course_id)
+select substr(code, 6)::int, id from inserted;
+
+-- One file per course, so two-stage search has a file to pick
+insert into course_files (course_id, filename, centroid)
+select
+  b.course_id,
+  'bench-' || b.n || '.pdf',
+  (select array_agg(random() - 0.5)::vector(768) from generate_series(1, 768) where b.n > 0)
+from bench_courses b
+where not exists (select 1 from course_files f where f.course_id = b.course_id);
+
+insert into ingested_documents (content, embedding, course_id, course_file_id, chunk_index, total_chunks)
+select
+  'benchmark chunk ' || g,
+  (select array_agg(random() - 0.5)::vector(768) from generate_series(1, 768) where g >= 0),
+  b.course_id,
+  f.id,
+  g,
+  :chunks
+from bench_courses b
+join course_files f on f.course_id = b.course_id
+cross join generate_series(0, :chunks - 1) g
+where not exists (select 1 from ingested_documents d where d.course_id = b.course_id);
+
+analyze ingested_documents;
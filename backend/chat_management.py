@@ -1,13 +1,64 @@
 import os
-from datetime import datetime
-from typing import Optional
+import re
+import json
+import base64
+import weakref
+import time
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Set, Tuple
 
 from fastapi import HTTPException
 from pydantic import BaseModel
-from openai import AsyncOpenAI
-from supabase.client import create_client
+from pydantic_ai import Agent
+from pydantic_ai.messages import (
+    FunctionToolCallEvent,
+    FunctionToolResultEvent,
+    PartDeltaEvent,
+    PartStartEvent,
+    TextPart,
+    TextPartDelta,
+)
 
-from agent import cpss_chat_expert, CPSSChatDeps, get_cpss_agent
+from admission import QUEUE_TIMEOUT, acquire_model_slot, admit, Slot
+from agent import cpss_chat_expert, CPSSChatDeps, get_agent_model, get_cpss_agent, llm, prompt_cache_settings
+from conversation import (
+    RECENT_MESSAGE_LIMIT,
+    build_prompt,
+    cached_history,
+    known_last_message_id,
+    remember_history,
+    remember_message,
+    schedule_summary_refresh,
+)
+from llm_client import get_openai_client
+from resilience import CHAT_DEADLINE, deadline, time_left
+from timings import Timings, bind_timings, timed_phase
+from retrieval import RETRIEVAL_PREFETCH, RetrievalPrefetch
+from write_behind import flushed, persist_message
+from database import (
+    begin_chat_turn,
+    fetch_session_messages,
+    get_course,
+    get_course_by_code,
+    get_courses_by_ids,
+    get_recent_messages,
+    get_user_id_by_email,
+    insert_chat_run,
+    list_user_sessions,
+)
+
+
+# Share one LLM run between identical first-turn questions arriving concurrently
+COALESCE_FIRST_TURNS = os.environ.get("CHAT_COALESCE_FIRST_TURNS", "true").lower() in ("1", "true", "yes")
+# How often a non-streaming request checks whether its client is still connected (seconds)
+DISCONNECT_POLL_INTERVAL = float(os.environ.get("CHAT_DISCONNECT_POLL_INTERVAL", "0.5"))
+# Default page sizes for the session list and message history, and the largest a client may ask for
+SESSIONS_PAGE_SIZE = int(os.environ.get("CHAT_SESSIONS_PAGE_SIZE", "30"))
+MESSAGES_PAGE_SIZE = int(os.environ.get("CHAT_MESSAGES_PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.environ.get("CHAT_MAX_PAGE_SIZE", "100"))
+CURSOR_TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}[T ][\d:.]+(Z|[+-]\d{2}(:?\d{2})?)?")
 
 
 class ChatSendRequest(BaseModel):
@@ -22,305 +73,581 @@ class ChatSendRequest(BaseModel):
     session_id: Optional[str] = None
 
 
+async def _resolve_user_id(payload: ChatSendRequest) -> str:
+    if payload.user_id:
+        return payload.user_id
+    user_id = await get_user_id_by_email(payload.user_email)
+    if not user_id:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user_id
+
+
+async def _resolve_course(payload: ChatSendRequest) -> dict:
+    if payload.course_id:
+        course = await get_course(payload.course_id, "id, code, name, content_updated_at")
+    else:
+        course = await get_course_by_code(payload.course_code, "id, code, name, content_updated_at")
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+    return course
+
+
+@dataclass
+class ChatTurn:
+    """
+    Everything prepared before the LLM call for one chat message.
+    """
+    session_id: str
+    user_message_id: Optional[str]
+    course_id: str
+    course_code: Optional[str]
+    course_name: Optional[str]
+    message: str
+    prompt: str
+    # Set for the first message of a conversation (no history or summary to condition on)
+    first_turn: bool = False
+    course_version: Optional[str] = None
+    # Database time of the user message, and time.monotonic() when it came back
+    user_message_at: Optional[datetime] = None
+    user_message_clock: float = 0.0
+    # time.monotonic() by which a streamed turn must finish (its deadline starts before _begin_turn)
+    deadline_at: Optional[float] = None
+    # Latency breakdown stored with the AI message
+    timings: Timings = field(default_factory=Timings)
+
+
+async def _begin_turn(payload: ChatSendRequest) -> ChatTurn:
+    """
+    Pre-LLM phase shared by chat_send and chat_stream. Two round trips: user/course
+    lookups run concurrently, then chat_begin_turn validates/creates the session,
+    stores the user message, bumps updated_at and returns the rolling summary plus
+    the last one or two raw turns.
+    """
+    if not payload.message or not (payload.user_id or payload.user_email):
+        raise HTTPException(status_code=400, detail="message and user are required")
+    if not payload.course_id and not payload.course_code:
+        raise HTTPException(status_code=400, detail="course_id or course_code is required")
+
+    timings = Timings()
+    # Resolve user and course concurrently (independent lookups), while any of the
+    # session's deferred writes from the previous turn finish storing
+    with timed_phase(timings, "lookups"):
+        user_id, course, _ = await asyncio.gather(
+            _resolve_user_id(payload), _resolve_course(payload), flushed(payload.session_id)
+        )
+    course_code = course.get("code")
+    course_name = course.get("name")
+
+    # Validate/create session, store user message and fetch history in one round trip
+    base_title_parts = [p for p in [course_code, course_name] if p]
+    with timed_phase(timings, "begin_turn"):
+        turn = await begin_chat_turn(
+            user_id=user_id,
+            course_id=course["id"],
+            session_id=payload.session_id,
+            content=payload.message,
+            title_prefix=" - ".join(base_title_parts) if base_title_parts else "Chat",
+            history_limit=RECENT_MESSAGE_LIMIT,
+            known_last_message_id=known_last_message_id(payload.session_id),
+        )
+        session_id = turn["session_id"]
+        user_message_clock = time.monotonic()
+
+        # History comes from this worker's ring buffer when the database confirmed it is
+        # current; otherwise the returned rows refill the buffer
+        cached = cached_history(session_id) if turn.get("history_current") else None
+        if cached is not None:
+            history = list(cached)
+        else:
+            history = turn.get("history")
+            if history is None:
+                # Buffer evicted between the lookup and the reply: load it directly
+                rows = await get_recent_messages(session_id, RECENT_MESSAGE_LIMIT + 1)
+                history = [m for m in reversed(rows) if m["id"] != turn.get("user_message_id")]
+            # The refilled buffer also keeps this worker's replies that are not stored yet
+            history = list(remember_history(session_id, history))
+    remember_message(session_id, turn.get("user_message_id"), "user", payload.message)
+
+    # Prepare the message with context (history is oldest first, excludes the current message)
+    prompt = build_prompt(payload.message, turn.get("summary"), history)
+
+    return ChatTurn(
+        session_id=session_id,
+        user_message_id=turn.get("user_message_id"),
+        course_id=course["id"],
+        course_code=course_code,
+        course_name=course_name,
+        message=payload.message,
+        prompt=prompt,
+        first_turn=not history and not turn.get("summary"),
+        course_version=course.get("content_updated_at"),
+        user_message_at=_parse_timestamp(turn.get("user_message_created_at")),
+        user_message_clock=user_message_clock,
+        timings=timings,
+    )
+
+
+def _parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+def _reply_created_at(turn: ChatTurn) -> Optional[str]:
+    # The user message's database time plus how long the turn took here: after the
+    # question, before anything stored later (the next question included), and
+    # independent of this worker's wall clock and of when the write-behind flushes
+    if turn.user_message_at is None:
+        return None
+    elapsed = max(time.monotonic() - turn.user_message_clock, 0.0)
+    return (turn.user_message_at + timedelta(seconds=elapsed, microseconds=1)).isoformat()
+
+
+def _agent_and_deps(turn: ChatTurn):
+    deps = CPSSChatDeps(
+        openai_client=get_openai_client(),
+        course_id=turn.course_id,
+        course_code=turn.course_code,
+        session_id=turn.session_id,
+    )
+    # Start retrieval for the raw message now so it overlaps the first model call
+    if RETRIEVAL_PREFETCH:
+        deps.prefetch = RetrievalPrefetch(
+            turn.message, course_id=turn.course_id, course_code=turn.course_code, session_id=turn.session_id
+        )
+    # Build a course-specific agent prompt
+    agent = get_cpss_agent(turn.course_name, turn.course_code)
+    return agent, deps
+
+
+def _model_settings(turn: ChatTurn):
+    settings = prompt_cache_settings(turn.course_id)
+    # Each model request within the run is bounded by what is left of the turn's deadline
+    left = time_left()
+    if left is not None:
+        settings["timeout"] = left
+    return settings
+
+
+async def _run_agent(turn: ChatTurn):
+    # Hold a model concurrency slot for the whole run (tool calls included)
+    async with await acquire_model_slot(llm, timeout=time_left(QUEUE_TIMEOUT)):
+        agent, deps = _agent_and_deps(turn)
+        try:
+            return await asyncio.wait_for(
+                agent.run(
+                    turn.prompt,
+                    deps=deps,
+                    model=get_agent_model(),
+                    model_settings=_model_settings(turn),
+                ),
+                time_left(),
+            )
+        finally:
+            if deps.prefetch is not None:
+                deps.prefetch.cancel()
+
+
+# In-flight first-turn runs (per worker): (course_id, course version, normalized message) -> [task, waiters]
+_inflight_runs: Dict[tuple, list] = {}
+# Fire-and-forget writes (run outcomes) that must outlive a cancelled request
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _coalesce_key(turn: ChatTurn) -> Optional[tuple]:
+    # Only first turns are context-free, so only they can share an answer
+    if not COALESCE_FIRST_TURNS or not turn.first_turn:
+        return None
+    return (turn.course_id, turn.course_version, " ".join(turn.message.lower().split()))
+
+
+async def _run_agent_coalesced(turn: ChatTurn):
+    """
+    Single-flight wrapper around _run_agent. Concurrent first-turn requests with the
+    same key await one run. Returns (result, leader): only the leader's message
+    records token usage, since followers did not cost an LLM call.
+    """
+    key = _coalesce_key(turn)
+    if key is None:
+        return await _run_agent(turn), True
+
+    entry = _inflight_runs.get(key)
+    leader = entry is None
+    if leader:
+        entry = [asyncio.create_task(_run_agent(turn)), 0]
+        _inflight_runs[key] = entry
+        entry[0].add_done_callback(lambda _: _inflight_runs.pop(key, None))
+    task = entry[0]
+    entry[1] += 1
+    try:
+        # Shielded so one client going away doesn't cancel the run for everyone else
+        return await asyncio.shield(task), leader
+    except asyncio.CancelledError:
+        # ...but once the last waiting client is gone, stop the run
+        if entry[1] == 1 and not task.done():
+            task.cancel()
+        raise
+    finally:
+        entry[1] -= 1
+
+
+def _usage_columns(usage) -> dict:
+    """
+    Map a pydantic-ai run usage onto chat_messages token columns.
+    """
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": usage.input_tokens,
+        "completion_tokens": usage.output_tokens,
+        "cached_tokens": usage.cache_read_tokens,
+    }
+
+
+async def _finish_turn(turn: ChatTurn, ai_text: str, thinking_time: int, usage=None) -> Optional[str]:
+    """
+    Persist the AI message (with token usage) and bump the session's updated_at
+    behind the response (write_behind), and fold the turn into the session's
+    rolling summary in the background. Returns the AI message id.
+    """
+    ai_message_id = await persist_message({
+        "session_id": turn.session_id,
+        "content": ai_text,
+        "sender": "ai",
+        "thinking_time": thinking_time,
+        "latency": turn.timings.summary(),
+        "created_at": _reply_created_at(turn),
+        **_usage_columns(usage),
+    })
+    remember_message(turn.session_id, ai_message_id, "ai", ai_text)
+    schedule_summary_refresh(turn.session_id, turn.message, ai_text)
+    return ai_message_id
+
+
+def _record_run(
+    turn: ChatTurn,
+    outcome: str,
+    started: float,
+    *,
+    ai_message_id: Optional[str] = None,
+    streamed: bool = False,
+    coalesced: bool = False,
+    error: Optional[str] = None,
+) -> None:
+    """
+    Record how an agent run ended (completed / cancelled / failed). Runs as a
+    background task so it still happens when the request itself was cancelled.
+    """
+    async def _write():
+        try:
+            # The run references the AI message, which may still be in the journal
+            await flushed(turn.session_id)
+            await insert_chat_run({
+                "session_id": turn.session_id,
+                "user_message_id": turn.user_message_id,
+                "ai_message_id": ai_message_id,
+                "course_id": turn.course_id,
+                "outcome": outcome,
+                "streamed": streamed,
+                "coalesced": coalesced,
+                "duration_ms": int((time.perf_counter() - started) * 1000),
+                "error": error[:500] if error else None,
+            })
+        except Exception as e:
+            print(f"Warning: Could not record chat run: {e}")
+
+    task = asyncio.create_task(_write())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def run_until_disconnected(
+    work: Awaitable[Any],
+    is_disconnected: Callable[[], Awaitable[bool]],
+    poll_interval: float = DISCONNECT_POLL_INTERVAL,
+) -> Any:
+    """
+    Await work, polling the client connection. If the client goes away first, cancel
+    the work (agent run, tool calls, retrieval) and answer 499 to nobody.
+    """
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await is_disconnected():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        if not task.done():
+            task.cancel()
+
+
 async def chat_send(payload: ChatSendRequest):
     """
     Persist chat session/messages and return AI response.
     - If session_id not provided, create a chat_session for (user, course) at first message time.
     - Store both user message and AI response in chat_messages.
     """
-    try:
-        if not payload.message or not (payload.user_id or payload.user_email):
-            raise HTTPException(status_code=400, detail="message and user are required")
+    # Every external call made for this turn is bounded by the remaining deadline
+    with deadline(CHAT_DEADLINE):
+        turn = None
+        started = time.perf_counter()
+        try:
+            # Shed before touching the database when the user or the model is over its limit
+            admit(payload.user_id or payload.user_email, llm)
+            turn = await _begin_turn(payload)
 
-        # Init clients
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        openai_client = AsyncOpenAI()
-
-        # Resolve user_id if only email provided
-        user_id = payload.user_id
-        if not user_id and payload.user_email:
-            ures = (
-                supabase_client.table("users")
-                .select("id")
-                .eq("email", payload.user_email)
-                .execute()
-            )
-            if not ures.data:
-                raise HTTPException(status_code=404, detail="User not found")
-            user_id = ures.data[0]["id"]
-
-        # Resolve course_id
-        course_id = payload.course_id
-        if not course_id:
-            if not payload.course_code:
-                raise HTTPException(status_code=400, detail="course_id or course_code is required")
-            cres = (
-                supabase_client.table("courses")
-                .select("id, code, name")
-                .eq("code", payload.course_code)
-                .execute()
-            )
-            if not cres.data:
-                raise HTTPException(status_code=404, detail="Course not found")
-            course_id = cres.data[0]["id"]
-            course_code = cres.data[0]["code"]
-            course_name = cres.data[0]["name"]
-        else:
-            course_code = payload.course_code
-            course_name = None
-
-        # Ensure a session exists or create one
-        session_id = payload.session_id
-        if session_id:
-            # Validate session belongs to user and course
-            sres = (
-                supabase_client.table("chat_sessions")
-                .select("id, user_id, course_id")
-                .eq("id", session_id)
-                .execute()
+            # Get AI response
+            start = datetime.utcnow()
+            with bind_timings(turn.timings), timed_phase(turn.timings, "agent"):
+                ai_output, leader = await _run_agent_coalesced(turn)
+            end = datetime.utcnow()
+            thinking_time = int((end - start).total_seconds())
+            ai_text = ai_output.output if hasattr(ai_output, "output") else str(ai_output)
+
+            # Store AI message (each request gets its own rows, even when the answer was shared)
+            ai_message_id = await _finish_turn(
+                turn, ai_text, thinking_time, ai_output.usage() if leader else None
             )
-            if not sres.data:
-                raise HTTPException(status_code=400, detail="Session not found")
-            srow = sres.data[0]
-            if srow.get("user_id") != user_id or srow.get("course_id") != course_id:
-                raise HTTPException(status_code=400, detail="Invalid session for this user/course")
-        else:
-            # Create a session with a sensible title
-            if not course_code or not course_name:
-                # fetch for title if missing
-                cres2 = (
-                    supabase_client.table("courses")
-                    .select("code, name")
-                    .eq("id", course_id)
-                    .execute()
-                )
-                if cres2.data:
-                    course_code = cres2.data[0]["code"]
-                    course_name = cres2.data[0]["name"]
-            # Count existing sessions for this user+course to append sequence number
-            try:
-                existing = (
-                    supabase_client.table("chat_sessions")
-                    .select("id")
-                    .eq("user_id", user_id)
-                    .eq("course_id", course_id)
-                    .execute()
-                )
-                seq = (len(existing.data) if existing and existing.data is not None else 0) + 1
-            except Exception:
-                # Fallback if count fails
-                seq = 1
-
-            base_title_parts = [p for p in [course_code, course_name] if p]
-            base_title = " - ".join(base_title_parts) if base_title_parts else "Chat"
-            title = f"{base_title} - Chat {seq}"
-            current_time = datetime.utcnow().isoformat()
-            session_data = {
-                "user_id": user_id,
-                "course_id": course_id,
-                "title": title,
+            _record_run(turn, "completed", started, ai_message_id=ai_message_id, coalesced=not leader)
+
+            return {
+                "success": True,
+                "response": ai_text,
+                "session_id": turn.session_id,
+                "user_message_id": turn.user_message_id,
+                "ai_message_id": ai_message_id,
+                "thinking_time": thinking_time,
+                "coalesced": not leader,
             }
-            
-            # Try to add updated_at field, but don't fail if column doesn't exist
-            try:
-                session_data["updated_at"] = current_time
-            except:
-                pass
-                
-            screate = (
-                supabase_client.table("chat_sessions")
-                .insert(session_data)
-                .execute()
-            )
-            if not screate.data:
-                raise HTTPException(status_code=500, detail="Failed to create session")
-            session_id = screate.data[0]["id"]
-
-        # Store user message
-        umsg = (
-            supabase_client.table("chat_messages")
-            .insert({
-                "session_id": session_id,
-                "content": payload.message,
-                "sender": "user",
-            })
-            .execute()
-        )
 
-        # Update session's updated_at timestamp immediately when user sends message
-        # This makes the session move to top right away, before AI responds
+        except asyncio.CancelledError:
+            # Client disconnected: the run was cancelled and nothing is persisted
+            if turn is not None:
+                _record_run(turn, "cancelled", started)
+            raise
+        except HTTPException as e:
+            if turn is not None:
+                _record_run(turn, "failed", started, error=str(e.detail))
+            raise
+        except asyncio.TimeoutError as e:
+            if turn is not None:
+                _record_run(turn, "failed", started, error=f"Deadline exceeded: {e}")
+            raise HTTPException(status_code=504, detail="Chat response timed out, please try again")
+        except Exception as e:
+            if turn is not None:
+                _record_run(turn, "failed", started, error=str(e))
+            raise HTTPException(status_code=500, detail=f"Chat send error: {str(e)}")
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def _run_stream_turn(turn: ChatTurn, emit: Callable[[str], None], slot: Optional[Slot] = None) -> None:
+    """
+    The agent turn behind _stream_turn, run as its own task so the request deadline
+    and timings context are set and reset in one context, and cleanup (run record,
+    prefetch, model slot) happens here rather than in the generator. Frames go to emit.
+    """
+    start = time.perf_counter()
+    first_token_ms: Optional[int] = None
+    seconds = CHAT_DEADLINE if turn.deadline_at is None else max(0.0, turn.deadline_at - time.monotonic())
+    with deadline(seconds), bind_timings(turn.timings):
+        deps = None
+        recorded = False
         try:
-            current_timestamp = datetime.utcnow().isoformat()
-            supabase_client.table("chat_sessions").update({
-                "updated_at": current_timestamp
-            }).eq("id", session_id).execute()
+            agent, deps = _agent_and_deps(turn)
+            reported_retrievals = 0
+            agent_started = time.perf_counter()
+            async with agent.iter(
+                turn.prompt,
+                deps=deps,
+                model=get_agent_model(),
+                model_settings=_model_settings(turn),
+            ) as run:
+                async for node in run:
+                    if Agent.is_model_request_node(node):
+                        async with node.stream(run.ctx) as request_stream:
+                            async for event in request_stream:
+                                delta = None
+                                if isinstance(event, PartStartEvent) and isinstance(event.part, TextPart):
+                                    delta = event.part.content
+                                elif isinstance(event, PartDeltaEvent) and isinstance(event.delta, TextPartDelta):
+                                    delta = event.delta.content_delta
+                                if delta:
+                                    if first_token_ms is None:
+                                        first_token_ms = int((time.perf_counter() - start) * 1000)
+                                    emit(_sse("token", {"delta": delta}))
+                    elif Agent.is_call_tools_node(node):
+                        async with node.stream(run.ctx) as tool_stream:
+                            async for event in tool_stream:
+                                if isinstance(event, FunctionToolCallEvent):
+                                    emit(_sse("tool_call", {
+                                        "tool": event.part.tool_name,
+                                        "args": event.part.args,
+                                    }))
+                                elif isinstance(event, FunctionToolResultEvent):
+                                    emit(_sse("tool_result", {"tool": event.result.tool_name}))
+                                    for entry in deps.retrieval_log[reported_retrievals:]:
+                                        emit(_sse("retrieval", entry))
+                                    reported_retrievals = len(deps.retrieval_log)
+                ai_text = run.result.output
+                usage = run.usage()
+            turn.timings.phase("agent", time.perf_counter() - agent_started)
+            if first_token_ms is not None:
+                turn.timings.phases["first_token"] = first_token_ms
+
+            thinking_time = int(time.perf_counter() - start)
+            ai_message_id = await _finish_turn(turn, ai_text, thinking_time, usage)
+            recorded = True
+            _record_run(turn, "completed", start, ai_message_id=ai_message_id, streamed=True)
+            emit(_sse("done", {
+                "success": True,
+                "response": ai_text,
+                "session_id": turn.session_id,
+                "user_message_id": turn.user_message_id,
+                "ai_message_id": ai_message_id,
+                "thinking_time": thinking_time,
+                "timing": {
+                    "first_token_ms": first_token_ms,
+                    "total_ms": int((time.perf_counter() - start) * 1000),
+                    "prefetch_used": bool(deps.prefetch and deps.prefetch.used),
+                },
+            }))
+        except asyncio.CancelledError:
+            # Client disconnected mid-stream: the agent run and its tool calls are cancelled
+            if not recorded:
+                _record_run(turn, "cancelled", start, streamed=True)
+            raise
         except Exception as e:
-            print(f"Warning: Could not update session timestamp: {e}")
-
-        # Ensure we have course meta for prompt
-        if not course_code or not course_name:
-            cres_meta = (
-                supabase_client.table("courses")
-                .select("code, name")
-                .eq("id", course_id)
-                .execute()
-            )
-            if cres_meta.data and len(cres_meta.data) > 0:
-                course_code = course_code or cres_meta.data[0]["code"]
-                course_name = course_name or cres_meta.data[0]["name"]
+            print(f"Chat stream error: {e}")
+            _record_run(turn, "failed", start, streamed=True, error=str(e))
+            emit(_sse("error", {"success": False, "detail": f"Chat stream error: {str(e)}"}))
+        finally:
+            if deps is not None and deps.prefetch is not None:
+                deps.prefetch.cancel()
+            if slot is not None:
+                slot.release()
+
 
-        # Get recent chat history for context (limit to prevent overloading)
-        chat_history = ""
+async def _stream_turn(turn: ChatTurn, slot: Optional[Slot] = None) -> AsyncIterator[str]:
+    """
+    Run the agent with pydantic-ai's graph iteration and yield SSE frames:
+    - session: ids known before generation starts
+    - token: text deltas as the model produces them
+    - tool_call / tool_result: agent tool activity
+    - retrieval: what each documentation lookup returned
+    - done: final text, message ids and timing (after the AI message is persisted)
+    - error: generation failed; nothing is persisted
+    """
+    yield _sse("session", {"session_id": turn.session_id, "user_message_id": turn.user_message_id})
+
+    frames: asyncio.Queue = asyncio.Queue()
+    task = asyncio.create_task(_run_stream_turn(turn, frames.put_nowait, slot))
+    task.add_done_callback(lambda _: frames.put_nowait(None))  # end of stream, however the turn ended
+    try:
+        while True:
+            frame = await frames.get()
+            if frame is None:
+                break
+            yield frame
+    finally:
+        # Client disconnected (or the stream was closed): stop the turn; it cleans up after itself
+        task.cancel()
+
+
+async def chat_stream(payload: ChatSendRequest) -> AsyncIterator[str]:
+    """
+    Streaming variant of chat_send. Session/user-message persistence happens before
+    this returns, so request errors still surface as regular HTTP errors; the returned
+    iterator yields Server-Sent Events for the generation itself.
+    """
+    # The deadline covers the session round trips and the admission queue too; the
+    # stream task (started later, outside this context) gets what is left of it
+    with deadline(CHAT_DEADLINE):
         try:
-            # Get last 10 messages (5 user + 5 AI pairs) to provide context without overloading
-            history_result = (
-                supabase_client.table("chat_messages")
-                .select("content, sender, created_at")
-                .eq("session_id", session_id)
-                .order("created_at", desc=True)
-                .limit(10)
-                .execute()
-            )
-            
-            if history_result.data and len(history_result.data) > 1:  # More than just the current message
-                # Reverse to get chronological order (oldest first)
-                history_messages = list(reversed(history_result.data[1:]))  # Exclude the just-stored user message
-                
-                # Format chat history for context
-                history_lines = []
-                for msg in history_messages:
-                    sender_label = "User" if msg["sender"] == "user" else "Assistant"
-                    history_lines.append(f"{sender_label}: {msg['content']}")
-                
-                if history_lines:
-                    chat_history = "\n".join(history_lines)
+            admit(payload.user_id or payload.user_email, llm)
+            turn = await _begin_turn(payload)
+        except HTTPException:
+            raise
         except Exception as e:
-            print(f"Warning: Could not retrieve chat history: {e}")
-            # Continue without history if retrieval fails
+            raise HTTPException(status_code=500, detail=f"Chat send error: {str(e)}")
 
-        # Prepare the message with context
-        if chat_history:
-            contextualized_message = f"""Previous conversation context:
-{chat_history}
+        # Take the model slot before the response starts so shedding is still a plain 429
+        slot = await acquire_model_slot(llm, timeout=time_left(QUEUE_TIMEOUT))
+        turn.deadline_at = time.monotonic() + time_left()
+    stream = _stream_turn(turn, slot)
+    # The generator releases the slot when it finishes; this covers a client that
+    # disconnects before the stream is ever started
+    weakref.finalize(stream, slot.release)
+    return stream
 
-Current question: {payload.message}"""
-        else:
-            contextualized_message = payload.message
-
-        # Get AI response
-        start = datetime.utcnow()
-        deps = CPSSChatDeps(
-            supabase=supabase_client,
-            openai_client=openai_client,
-            course_id=course_id,
-            course_code=course_code,
-        )
-        # Build a course-specific agent prompt
-        agent = get_cpss_agent(course_name, course_code)
-        ai_output = await agent.run(contextualized_message, deps=deps)
-        end = datetime.utcnow()
-        thinking_time = int((end - start).total_seconds())
-        ai_text = ai_output.output if hasattr(ai_output, "output") else str(ai_output)
-
-        # Store AI message
-        amsg = (
-            supabase_client.table("chat_messages")
-            .insert({
-                "session_id": session_id,
-                "content": ai_text,
-                "sender": "ai",
-                "thinking_time": thinking_time,
-            })
-            .execute()
-        )
 
-        return {
-            "success": True,
-            "response": ai_text,
-            "session_id": session_id,
-            "user_message_id": (umsg.data[0]["id"] if umsg.data else None),
-            "ai_message_id": (amsg.data[0]["id"] if amsg.data else None),
-            "thinking_time": thinking_time,
-        }
+def _encode_cursor(sort_value: str, row_id: str) -> str:
+    raw = json.dumps([sort_value, row_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: Optional[str]) -> Optional[Tuple[str, str]]:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+        # Both halves end up inside a PostgREST filter, so accept only what we issued
+        if not isinstance(sort_value, str) or not CURSOR_TIMESTAMP.fullmatch(sort_value):
+            raise ValueError(sort_value)
+        if not isinstance(row_id, str) or not row_id.replace("-", "").isalnum():
+            raise ValueError(row_id)
+        return sort_value, row_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Chat send error: {str(e)}")
 
+def _page_size(limit: Optional[int], default: int) -> int:
+    if limit is None:
+        return default
+    return max(1, min(limit, MAX_PAGE_SIZE))
 
-async def list_chat_sessions(user_id: Optional[str] = None, user_email: Optional[str] = None):
+
+async def list_chat_sessions(
+    user_id: Optional[str] = None,
+    user_email: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+):
     try:
         if not user_id and not user_email:
             raise HTTPException(status_code=400, detail="user_id or user_email required")
 
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]
-        )
-
         # Resolve user
         if not user_id and user_email:
-            ures = (
-                supabase_client.table("users").select("id").eq("email", user_email).execute()
-            )
-            if not ures.data:
+            user_id = await get_user_id_by_email(user_email)
+            if not user_id:
                 raise HTTPException(status_code=404, detail="User not found")
-            user_id = ures.data[0]["id"]
 
-        # Fetch chat sessions and handle ordering in Python to properly handle NULL updated_at values
-        try:
-            sres = (
-                supabase_client.table("chat_sessions")
-                .select("id, course_id, title, created_at, updated_at")
-                .eq("user_id", user_id)
-                .execute()
-            )
-            
-            sessions = sres.data or []
-            
-            # Sort sessions in Python: first by updated_at (treating NULL as very old), then by created_at
-            # This ensures sessions with recent activity come first
-            def sort_key(session):
-                # Use updated_at if available, otherwise use created_at
-                sort_time = session.get('updated_at') or session.get('created_at') or '1970-01-01T00:00:00Z'
-                return sort_time
-            
-            sessions.sort(key=sort_key, reverse=True)
-            
-            # Create a mock response object to maintain compatibility
-            class MockResponse:
-                def __init__(self, data):
-                    self.data = data
-            sres = MockResponse(sessions)
-            
-        except Exception as e:
-            print(f"Fallback to created_at ordering due to error: {e}")
-            # Fallback if updated_at column doesn't exist
-            sres = (
-                supabase_client.table("chat_sessions")
-                .select("id, course_id, title, created_at")
-                .eq("user_id", user_id)
-                .order("created_at", desc=True)
-                .execute()
-            )
-        sessions = sres.data or []
+        # Fetch one page, most recent activity first (coalesce(updated_at, created_at), id),
+        # plus one extra row to tell whether another page follows
+        page_size = _page_size(limit, SESSIONS_PAGE_SIZE)
+        sessions = await list_user_sessions(user_id, page_size + 1, before=_decode_cursor(cursor))
+        has_more = len(sessions) > page_size
+        sessions = sessions[:page_size]
         if not sessions:
-            return {"success": True, "sessions": []}
+            return {"success": True, "sessions": [], "has_more": False, "next_cursor": None}
 
         # Fetch courses for referenced ids
         course_ids = list({row["course_id"] for row in sessions if row.get("course_id")})
         cmap = {}
-        if course_ids:
-            cres = (
-                supabase_client.table("courses")
-                .select("id, code, name")
-                .in_("id", course_ids)
-                .execute()
-            )
-            for c in (cres.data or []):
-                cmap[c["id"]] = {"id": c["id"], "code": c["code"], "name": c["name"]}
+        for c in await get_courses_by_ids(course_ids):
+            cmap[c["id"]] = {"id": c["id"], "code": c["code"], "name": c["name"]}
 
         enriched = []
         for row in sessions:
@@ -335,25 +662,37 @@ async def list_chat_sessions(user_id: Optional[str] = None, user_email: Optional
                 }
             )
 
-        return {"success": True, "sessions": enriched}
+        last = sessions[-1]
+        return {
+            "success": True,
+            "sessions": enriched,
+            "has_more": has_more,
+            "next_cursor": _encode_cursor(last["last_activity_at"], last["id"]) if has_more else None,
+        }
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"List sessions error: {str(e)}")
 
 
-async def list_session_messages(session_id: str):
+async def list_session_messages(session_id: str, limit: Optional[int] = None, cursor: Optional[str] = None):
+    """
+    Return the newest page of a session's messages (oldest first within the page).
+    Pass next_cursor back as cursor to load the page of older messages before it.
+    """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        mres = (
-            supabase_client.table("chat_messages")
-            .select("id, content, sender, thinking_time, created_at")
-            .eq("session_id", session_id)
-            .order("created_at", desc=False)
-            .execute()
-        )
-        return {"success": True, "messages": mres.data or []}
+        page_size = _page_size(limit, MESSAGES_PAGE_SIZE)
+        await flushed(session_id)
+        messages = await fetch_session_messages(session_id, page_size + 1, before=_decode_cursor(cursor))
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+        next_cursor = None
+        if has_more:
+            oldest = messages[-1]
+            next_cursor = _encode_cursor(oldest["created_at"], oldest["id"])
+        messages.reverse()
+        return {"success": True, "messages": messages, "has_more": has_more, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"List messages error: {str(e)}")
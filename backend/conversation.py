@@ -0,0 +1,179 @@
+import os
+import asyncio
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Set
+
+from cachetools import TTLCache
+
+
+from database import get_session_summary, update_session_summary
+from llm_client import SUMMARY_TIMEOUT, get_openai_client
+from retrieval import estimate_tokens
+from write_behind import is_pending
+
+# Raw messages kept verbatim in the prompt (last two user/AI turns)
+RECENT_MESSAGE_LIMIT = int(os.environ.get("CHAT_RECENT_MESSAGES", "4"))
+# Token cap for the raw recent messages, and per message (long AI answers get clipped)
+HISTORY_TOKEN_CAP = int(os.environ.get("CHAT_HISTORY_TOKEN_CAP", "800"))
+MESSAGE_TOKEN_CAP = int(os.environ.get("CHAT_MESSAGE_TOKEN_CAP", "300"))
+# Model used to fold each finished turn into the rolling summary
+SUMMARY_MODEL = os.environ.get("CHAT_SUMMARY_MODEL", "gpt-4.1-mini")
+SUMMARY_MAX_TOKENS = 300
+# Sessions whose recent messages are kept in memory (per worker), and for how long (seconds)
+HISTORY_CACHE_SESSIONS = int(os.environ.get("CHAT_HISTORY_CACHE_SESSIONS", "5000"))
+HISTORY_CACHE_TTL = int(os.environ.get("CHAT_HISTORY_CACHE_TTL", "1800"))
+
+SUMMARY_SYSTEM_PROMPT = """You maintain a running summary of a tutoring conversation between a student and a course assistant.
+
+Given the current summary and the latest exchange, return an updated summary that:
+- records the topics discussed, what the student is trying to learn, and any open questions
+- keeps key facts, definitions and conclusions the assistant gave, in a few words each
+- omits pasted documentation, greetings and formatting
+- stays under 150 words
+
+Return ONLY the updated summary text."""
+
+# Background refresh bookkeeping (per worker): session_id -> [lock, pending refreshes]
+_summary_locks: Dict[str, list] = {}
+_background_tasks: Set[asyncio.Task] = set()
+
+# session_id -> ring buffer of the last RECENT_MESSAGE_LIMIT messages (LRU + TTL eviction)
+_history_cache: TTLCache = TTLCache(maxsize=HISTORY_CACHE_SESSIONS, ttl=HISTORY_CACHE_TTL)
+
+
+def cached_history(session_id: Optional[str]) -> Optional[Deque[Dict]]:
+    """
+    The cached recent messages of a session (oldest first), or None on a miss.
+    """
+    if not session_id:
+        return None
+    return _history_cache.get(session_id)
+
+
+def known_last_message_id(session_id: Optional[str]) -> Optional[str]:
+    """
+    Id of the newest cached message already stored, passed to chat_begin_turn so it
+    can skip the history scan when nothing was written elsewhere (e.g. by the other
+    worker). Messages still in the write-behind journal are not in the database
+    yet, so they are skipped; the buffer holds them.
+    """
+    for message in reversed(cached_history(session_id) or ()):
+        if not is_pending(message.get("id")):
+            return message.get("id")
+    return None
+
+
+def remember_history(session_id: str, messages: List[Dict]) -> Deque[Dict]:
+    """
+    Replace the session's ring buffer with messages loaded from the database.
+    Buffered messages still waiting in the write-behind journal are missing from
+    that snapshot, so they are kept after it.
+    """
+    loaded = {m.get("id") for m in messages}
+    pending = [
+        m for m in _history_cache.get(session_id) or ()
+        if is_pending(m.get("id")) and m.get("id") not in loaded
+    ]
+    history: Deque[Dict] = deque(
+        ({"id": m.get("id"), "sender": m["sender"], "content": m["content"]} for m in [*messages, *pending]),
+        maxlen=RECENT_MESSAGE_LIMIT,
+    )
+    _history_cache[session_id] = history
+    return history
+
+
+def remember_message(session_id: str, message_id: Optional[str], sender: str, content: str) -> None:
+    """
+    Append a message this worker just wrote. Only extends a buffer that is already
+    in sync; a missing buffer is loaded from the database on the next turn instead.
+    """
+    history = _history_cache.get(session_id)
+    if history is None or not message_id:
+        return
+    history.append({"id": message_id, "sender": sender, "content": content})
+    # Re-insert to refresh the entry's TTL
+    _history_cache[session_id] = history
+
+
+def _clip(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rstrip() + " ..."
+
+
+def format_recent_history(messages: List[Dict], token_cap: int = HISTORY_TOKEN_CAP) -> str:
+    """
+    Format the most recent raw messages (oldest first) under a token cap.
+    Newer messages win when the cap is reached.
+    """
+    lines: List[str] = []
+    used_tokens = 0
+    for msg in reversed(messages[-RECENT_MESSAGE_LIMIT:]):
+        sender_label = "User" if msg["sender"] == "user" else "Assistant"
+        line = f"{sender_label}: {_clip(msg['content'], MESSAGE_TOKEN_CAP)}"
+        cost = estimate_tokens(line)
+        if used_tokens + cost > token_cap:
+            break
+        lines.append(line)
+        used_tokens += cost
+    return "\n".join(reversed(lines))
+
+
+def build_prompt(message: str, summary: Optional[str], recent_messages: List[Dict]) -> str:
+    """
+    Combine the rolling summary, the last one or two raw turns and the question.
+    """
+    sections = []
+    if summary:
+        sections.append(f"Summary of the conversation so far:\n{summary}")
+    recent = format_recent_history(recent_messages)
+    if recent:
+        sections.append(f"Previous conversation context:\n{recent}")
+    if not sections:
+        return message
+    sections.append(f"Current question: {message}")
+    return "\n\n".join(sections)
+
+
+async def _refresh_summary(session_id: str, user_message: str, ai_message: str) -> None:
+    entry = _summary_locks.setdefault(session_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            # Re-read inside the lock so back-to-back turns fold in order
+            current_summary = await get_session_summary(session_id)
+            exchange = (
+                f"Current summary:\n{current_summary or '(none yet)'}\n\n"
+                f"Latest exchange:\nUser: {_clip(user_message, MESSAGE_TOKEN_CAP)}\n"
+                f"Assistant: {_clip(ai_message, MESSAGE_TOKEN_CAP * 2)}"
+            )
+            response = await get_openai_client().chat.completions.create(
+                model=SUMMARY_MODEL,
+                timeout=SUMMARY_TIMEOUT,
+                messages=[
+                    {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                    {"role": "user", "content": exchange},
+                ],
+                temperature=0.2,
+                max_tokens=SUMMARY_MAX_TOKENS,
+            )
+            summary = (response.choices[0].message.content or "").strip()
+            if summary:
+                await update_session_summary(session_id, summary, datetime.utcnow().isoformat())
+    except Exception as e:
+        print(f"Warning: Could not refresh conversation summary: {e}")
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _summary_locks.pop(session_id, None)
+
+
+def schedule_summary_refresh(session_id: str, user_message: str, ai_message: str) -> None:
+    """
+    Fold the finished turn into the session's rolling summary without delaying the response.
+    """
+    task = asyncio.create_task(_refresh_summary(session_id, user_message, ai_message))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
@@ -1,12 +1,10 @@
-import os
 import tempfile
 import shutil
 from pathlib import Path
 from typing import List
 
 from fastapi import HTTPException, UploadFile
-from supabase.client import create_client
-
+from database import get_user_id_by_email, insert_course, insert_course_file
 from ingestion import files_upload
 
 
@@ -25,19 +23,10 @@ async def create_course(
     """
     temp_dir = None
     try:
-        # Initialize Supabase client
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"],
-        )
-
         # Resolve user by email to get UUID
-        user_res = (
-            supabase_client.table("users").select("id").eq("email", user_email).execute()
-        )
-        if not user_res.data:
+        user_id = await get_user_id_by_email(user_email)
+        if not user_id:
             raise HTTPException(status_code=404, detail="User not found for provided email")
-        user_id = user_res.data[0]["id"]
 
         # Create course (files_count based on current upload)
         try:
@@ -48,14 +37,13 @@ async def create_course(
                 "files_count": len(files),
                 "quizzes_count": 0,
             }
-            course_res = supabase_client.table("courses").insert(course_insert).execute()
+            course = await insert_course(course_insert)
         except Exception as e:
             # Likely duplicate code due to unique constraint
             raise HTTPException(status_code=400, detail=f"Failed to create course: {str(e)}")
 
-        if not course_res.data:
+        if not course:
             raise HTTPException(status_code=500, detail="Course creation failed")
-        course = course_res.data[0]
         course_id = course["id"]
 
         # Prepare temp dir and save files while inserting course_files rows
@@ -85,20 +73,16 @@ async def create_course(
                 )
 
             # Insert course_files row first to get course_file_id
-            cf_res = (
-                supabase_client.table("course_files")
-                .insert(
-                    {
-                        "course_id": course_id,
-                        "uploaded_by": user_id,
-                        "filename": file.filename,
-                    }
-                )
-                .execute()
+            cf_row = await insert_course_file(
+                {
+                    "course_id": course_id,
+                    "uploaded_by": user_id,
+                    "filename": file.filename,
+                }
             )
-            if not cf_res.data:
+            if not cf_row:
                 raise HTTPException(status_code=500, detail="Failed to create course file record")
-            course_file_id = cf_res.data[0]["id"]
+            course_file_id = cf_row["id"]
             filename_to_fileid[file.filename] = course_file_id
 
             # Save file to temp dir for ingestion
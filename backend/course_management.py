@@ -1,12 +1,27 @@
-import os
 import tempfile
 import shutil
 from pathlib import Path
+from datetime import datetime
 from typing import List, Dict
 
 from fastapi import HTTPException, UploadFile
-from supabase.client import create_client
-
+from database import (
+    count_course_files,
+    delete_chat_sessions_for_course,
+    delete_course_file_record,
+    delete_course_files_for_course,
+    delete_course_record,
+    delete_documents_for_course,
+    delete_documents_for_file,
+    delete_quizzes_for_course,
+    drop_course_vector_index,
+    get_course,
+    get_course_file,
+    get_user_id_by_email,
+    insert_course_file,
+    update_course,
+)
+from documentation import invalidate_course_outline
 from ingestion import files_upload
 
 
@@ -22,24 +37,14 @@ async def upload_course_files(
     """
     temp_dir = None
     try:
-        # Init Supabase client
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]
-        )
-
         # Resolve user ID
-        user_res = (
-            supabase_client.table("users").select("id").eq("email", user_email).execute()
-        )
-        if not user_res.data:
+        user_id = await get_user_id_by_email(user_email)
+        if not user_id:
             raise HTTPException(status_code=404, detail="User not found for provided email")
-        user_id = user_res.data[0]["id"]
 
         # Ensure course exists and is owned/accessible (best-effort ownership check)
-        course_res = (
-            supabase_client.table("courses").select("id, created_by").eq("id", course_id).execute()
-        )
-        if not course_res.data:
+        course_row = await get_course(course_id, "id, created_by")
+        if not course_row:
             # Already deleted or never existed; treat as idempotent success
             return {"success": True, "message": "Course already deleted"}
 
@@ -71,18 +76,14 @@ async def upload_course_files(
                 )
 
             # Insert into course_files
-            cf_res = (
-                supabase_client.table("course_files")
-                .insert({
-                    "course_id": course_id,
-                    "uploaded_by": user_id,
-                    "filename": file.filename,
-                })
-                .execute()
-            )
-            if not cf_res.data:
+            cf_row = await insert_course_file({
+                "course_id": course_id,
+                "uploaded_by": user_id,
+                "filename": file.filename,
+            })
+            if not cf_row:
                 raise HTTPException(status_code=500, detail="Failed to create course file record")
-            course_file_id = cf_res.data[0]["id"]
+            course_file_id = cf_row["id"]
             filename_to_fileid[file.filename] = course_file_id
 
             # Persist file to temp dir for ingestion
@@ -115,21 +116,18 @@ async def upload_course_files(
                 print(f"Quiz generation error: {e}")
                 quiz_results = {"success": False, "error": str(e)}
 
-        # Recompute files_count to be authoritative
-        count_res = (
-            supabase_client.table("course_files")
-            .select("id", count="exact")
-            .eq("course_id", course_id)
-            .execute()
-        )
-        new_count = count_res.count if hasattr(count_res, "count") else len(count_res.data or [])
+        # New files change the course outline
+        invalidate_course_outline(course_id)
 
-        # Update courses.files_count
-        supabase_client.table("courses").update({"files_count": new_count}).eq("id", course_id).execute()
+        # Recompute files_count to be authoritative
+        new_count = await count_course_files(course_id)
 
-        # Fetch course for return (including updated counts)
-        course_fetch = supabase_client.table("courses").select("*").eq("id", course_id).execute()
-        course = course_fetch.data[0] if course_fetch.data else {"id": course_id, "files_count": new_count}
+        # Update courses.files_count (returns the updated course, including counts)
+        course = await update_course(course_id, {
+            "files_count": new_count,
+            "content_updated_at": datetime.utcnow().isoformat(),
+        })
+        course = course or {"id": course_id, "files_count": new_count}
 
         # Cleanup
         shutil.rmtree(temp_dir, ignore_errors=True)
@@ -159,54 +157,44 @@ async def delete_course_file(*, course_id: str, course_file_id: str, user_email:
     Authorization: verifies that user_email matches the course's created_by.
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]
-        )
-
         # Resolve user
-        user_res = (
-            supabase_client.table("users").select("id").eq("email", user_email).execute()
-        )
-        if not user_res.data:
+        user_id = await get_user_id_by_email(user_email)
+        if not user_id:
             raise HTTPException(status_code=404, detail="User not found for provided email")
-        user_id = user_res.data[0]["id"]
 
         # Ensure course exists and is owned by user
-        course_res = (
-            supabase_client.table("courses").select("id, created_by").eq("id", course_id).execute()
-        )
-        if not course_res.data:
+        course_row = await get_course(course_id, "id, created_by")
+        if not course_row:
             raise HTTPException(status_code=404, detail="Course not found")
-        if course_res.data[0]["created_by"] != user_id:
+        if course_row["created_by"] != user_id:
             raise HTTPException(status_code=403, detail="Not authorized to modify this course")
 
         # Ensure file belongs to the course
-        cf_res = (
-            supabase_client.table("course_files").select("id, course_id").eq("id", course_file_id).execute()
-        )
-        if not cf_res.data:
+        cf_row = await get_course_file(course_file_id)
+        if not cf_row:
             raise HTTPException(status_code=404, detail="Course file not found")
-        if cf_res.data[0]["course_id"] != course_id:
+        if cf_row["course_id"] != course_id:
             raise HTTPException(status_code=400, detail="File does not belong to the provided course")
 
         # Delete related ingested documents (best effort)
         try:
-            supabase_client.table("ingested_documents").delete().eq("course_file_id", course_file_id).execute()
+            await delete_documents_for_file(course_file_id)
         except Exception:
             # Continue even if there are no ingested docs or RLS prevents; service key should allow
             pass
 
         # Delete the course_files row
-        supabase_client.table("course_files").delete().eq("id", course_file_id).execute()
+        await delete_course_file_record(course_file_id)
+        invalidate_course_outline(course_id)
 
         # Recompute files_count
-        count_res = (
-            supabase_client.table("course_files").select("id", count="exact").eq("course_id", course_id).execute()
-        )
-        new_count = count_res.count if hasattr(count_res, "count") else len(count_res.data or [])
+        new_count = await count_course_files(course_id)
 
         # Update courses.files_count
-        supabase_client.table("courses").update({"files_count": new_count}).eq("id", course_id).execute()
+        await update_course(course_id, {
+            "files_count": new_count,
+            "content_updated_at": datetime.utcnow().isoformat(),
+        })
 
         return {"success": True, "message": "File deleted", "new_files_count": new_count}
 
@@ -225,59 +213,51 @@ async def delete_course(*, course_id: str, user_email: str):
     - Deletes the course row
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]
-        )
-
         # Resolve user
-        user_res = (
-            supabase_client.table("users").select("id").eq("email", user_email).execute()
-        )
-        if not user_res.data:
+        user_id = await get_user_id_by_email(user_email)
+        if not user_id:
             raise HTTPException(status_code=404, detail="User not found for provided email")
-        user_id = user_res.data[0]["id"]
 
         # Ensure course exists and is owned by user
-        course_res = (
-            supabase_client.table("courses").select("id, created_by").eq("id", course_id).execute()
-        )
-        if not course_res.data:
+        course_row = await get_course(course_id, "id, created_by")
+        if not course_row:
             raise HTTPException(status_code=404, detail="Course not found")
-        if course_res.data[0]["created_by"] != user_id:
+        if course_row["created_by"] != user_id:
             raise HTTPException(status_code=403, detail="Not authorized to delete this course")
 
         # Delete ingested documents associated with the course
         try:
-            supabase_client.table("ingested_documents").delete().eq("course_id", course_id).execute()
+            await delete_documents_for_course(course_id)
         except Exception:
             pass
 
         # Delete chat messages and sessions related to this course (child first)
         try:
-            sessions_res = (
-                supabase_client.table("chat_sessions").select("id").eq("course_id", course_id).execute()
-            )
-            session_ids = [row["id"] for row in (sessions_res.data or [])]
-            if session_ids:
-                supabase_client.table("chat_messages").delete().in_("session_id", session_ids).execute()
-            supabase_client.table("chat_sessions").delete().eq("course_id", course_id).execute()
+            await delete_chat_sessions_for_course(course_id)
         except Exception:
             pass
 
         # Delete course files for the course
         try:
-            supabase_client.table("course_files").delete().eq("course_id", course_id).execute()
+            await delete_course_files_for_course(course_id)
         except Exception:
             pass
 
         # Optional: delete quizzes and sessions if present (best-effort, ignore if tables don't exist)
         try:
-            supabase_client.table("quizzes").delete().eq("course_id", course_id).execute()
+            await delete_quizzes_for_course(course_id)
+        except Exception:
+            pass
+
+        # Drop the course's partial vector index, if it has one
+        try:
+            await drop_course_vector_index(course_id)
         except Exception:
             pass
 
         # Finally, delete the course
-        supabase_client.table("courses").delete().eq("id", course_id).execute()
+        await delete_course_record(course_id)
+        invalidate_course_outline(course_id)
 
         return {"success": True, "message": "Course deleted"}
 
@@ -0,0 +1,749 @@
+"""
+Shared Supabase data-access layer.
+
+Every module talks to Supabase through the repository functions below instead of
+calling create_client(...) per request. Async callers share one AsyncClient per
+event loop, backed by a pooled HTTP/2 httpx client with keep-alive, so PostgREST
+calls no longer block the event loop or pay a fresh TLS handshake each time.
+"""
+import os
+import asyncio
+import weakref
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from cachetools import TTLCache
+from fastapi import HTTPException
+from postgrest.exceptions import APIError
+from supabase import (
+    AsyncClient,
+    AsyncClientOptions,
+    Client,
+    ClientOptions,
+    acreate_client,
+    create_client,
+)
+
+Row = Dict[str, Any]
+
+# Connection pool tuning (per worker process)
+MAX_CONNECTIONS = int(os.environ.get("SUPABASE_MAX_CONNECTIONS", "50"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("SUPABASE_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.environ.get("SUPABASE_KEEPALIVE_EXPIRY", "30"))
+REQUEST_TIMEOUT = float(os.environ.get("SUPABASE_TIMEOUT", "15"))
+
+# One async client per event loop. The main uvicorn loop owns the long-lived one;
+# ingestion threads that call asyncio.run(...) get their own short-lived client.
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+_async_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+_sync_client: Optional[Client] = None
+
+# User ids and course metadata/ownership are read several times per request and
+# rarely change, so they are cached per worker. Writes through this module drop
+# the affected entries; other workers pick changes up within the TTL. Misses are
+# not cached, so a newly registered user or created course is visible at once.
+LOOKUP_CACHE_TTL = float(os.environ.get("LOOKUP_CACHE_TTL", "60"))
+LOOKUP_CACHE_SIZE = int(os.environ.get("LOOKUP_CACHE_SIZE", "10000"))
+# Course columns served from the cache; other columns (counts) always hit the database
+COURSE_CACHE_COLUMNS = frozenset({"id", "code", "name", "created_by", "content_updated_at"})
+
+# Ingestion threads share these with the main loop
+_lookup_lock = threading.Lock()
+# email -> user id
+_user_ids: TTLCache = TTLCache(maxsize=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL)
+# course id -> row with COURSE_CACHE_COLUMNS
+_courses: TTLCache = TTLCache(maxsize=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL)
+# course code -> course id
+_course_codes: TTLCache = TTLCache(maxsize=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL)
+
+
+def _credentials() -> tuple:
+    url = os.environ.get("SUPABASE_URL")
+    key = os.environ.get("SUPABASE_SERVICE_KEY")
+    if not url or not key:
+        raise HTTPException(status_code=500, detail="Supabase configuration missing")
+    return url, key
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+async def get_client() -> AsyncClient:
+    """
+    Return the pooled async Supabase client for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is not None:
+        return client
+
+    url, key = _credentials()
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=_pool_limits(),
+        timeout=httpx.Timeout(REQUEST_TIMEOUT),
+    )
+    client = await acreate_client(
+        url, key, options=AsyncClientOptions(httpx_client=http_client)
+    )
+    # Another coroutine may have won the race while we were awaiting
+    existing = _async_clients.setdefault(loop, client)
+    if existing is not client:
+        await http_client.aclose()
+    else:
+        _async_http_clients[loop] = http_client
+    return existing
+
+
+def get_sync_client() -> Client:
+    """
+    Return the pooled synchronous client. Only for code that runs in worker
+    threads (e.g. the Docling ingestion pipeline), never inside async handlers.
+    """
+    global _sync_client
+    if _sync_client is None:
+        url, key = _credentials()
+        http_client = httpx.Client(
+            http2=True,
+            limits=_pool_limits(),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT),
+        )
+        _sync_client = create_client(url, key, options=ClientOptions(httpx_client=http_client))
+    return _sync_client
+
+
+async def close_clients() -> None:
+    """
+    Close the async client owned by the running loop (called on app shutdown).
+    """
+    loop = asyncio.get_running_loop()
+    _async_clients.pop(loop, None)
+    http_client = _async_http_clients.pop(loop, None)
+    if http_client is not None:
+        try:
+            await http_client.aclose()
+        except Exception as e:
+            print(f"Warning: Could not close Supabase connection pool cleanly: {e}")
+
+
+def _first(res) -> Optional[Row]:
+    return res.data[0] if res and res.data else None
+
+
+# ---------------------------------------------------------------------------
+# Users
+# ---------------------------------------------------------------------------
+
+async def get_user_by_email(email: str) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("users").select("*").eq("email", email).execute()
+    return _first(res)
+
+
+async def get_user_id_by_email(email: str) -> Optional[str]:
+    with _lookup_lock:
+        user_id = _user_ids.get(email)
+    if user_id:
+        return user_id
+    client = await get_client()
+    res = await client.table("users").select("id").eq("email", email).execute()
+    row = _first(res)
+    if not row:
+        return None
+    with _lookup_lock:
+        _user_ids[email] = row["id"]
+    return row["id"]
+
+
+async def insert_user(data: Row) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("users").insert(data).execute()
+    return _first(res)
+
+
+async def require_user_id(email: str, detail: str = "User not found") -> str:
+    """
+    Resolve a user's id by email or raise 404.
+    """
+    user_id = await get_user_id_by_email(email)
+    if not user_id:
+        raise HTTPException(status_code=404, detail=detail)
+    return user_id
+
+
+# ---------------------------------------------------------------------------
+# Courses
+# ---------------------------------------------------------------------------
+
+def _cacheable_columns(columns: str) -> Optional[List[str]]:
+    wanted = [c.strip() for c in columns.split(",") if c.strip()]
+    return wanted if wanted and COURSE_CACHE_COLUMNS.issuperset(wanted) else None
+
+
+def _cache_course(row: Row) -> None:
+    with _lookup_lock:
+        _courses[row["id"]] = row
+        if row.get("code"):
+            _course_codes[row["code"]] = row["id"]
+
+
+def invalidate_course_cache(course_id: Optional[str] = None, code: Optional[str] = None) -> None:
+    """
+    Drop a course's cached metadata (by id and/or code) after it is created,
+    updated or deleted.
+    """
+    with _lookup_lock:
+        row = _courses.pop(course_id, None) if course_id else None
+        for course_code in {code, row.get("code") if row else None}:
+            if course_code:
+                _course_codes.pop(course_code, None)
+
+
+async def get_course(course_id: str, columns: str = "id, code, name, created_by") -> Optional[Row]:
+    wanted = _cacheable_columns(columns)
+    if wanted is None:
+        client = await get_client()
+        res = await client.table("courses").select(columns).eq("id", course_id).execute()
+        return _first(res)
+
+    with _lookup_lock:
+        row = _courses.get(course_id)
+    if row is None:
+        client = await get_client()
+        res = (
+            await client.table("courses")
+            .select(", ".join(sorted(COURSE_CACHE_COLUMNS)))
+            .eq("id", course_id)
+            .execute()
+        )
+        row = _first(res)
+        if row is None:
+            return None
+        _cache_course(row)
+    return {c: row.get(c) for c in wanted}
+
+
+async def get_course_by_code(code: str, columns: str = "id, code, name, created_by") -> Optional[Row]:
+    wanted = _cacheable_columns(columns)
+    if wanted is None:
+        client = await get_client()
+        res = await client.table("courses").select(columns).eq("code", code).execute()
+        return _first(res)
+
+    with _lookup_lock:
+        course_id = _course_codes.get(code)
+        row = _courses.get(course_id) if course_id else None
+    if row is None:
+        client = await get_client()
+        res = (
+            await client.table("courses")
+            .select(", ".join(sorted(COURSE_CACHE_COLUMNS)))
+            .eq("code", code)
+            .execute()
+        )
+        row = _first(res)
+        if row is None:
+            return None
+        _cache_course(row)
+    return {c: row.get(c) for c in wanted}
+
+
+async def get_courses_by_ids(course_ids: List[str]) -> List[Row]:
+    if not course_ids:
+        return []
+    client = await get_client()
+    res = await client.table("courses").select("id, code, name").in_("id", course_ids).execute()
+    return res.data or []
+
+
+async def list_course_ids() -> List[str]:
+    client = await get_client()
+    res = await client.table("courses").select("id").execute()
+    return [row["id"] for row in (res.data or [])]
+
+
+async def insert_course(data: Row) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("courses").insert(data).execute()
+    invalidate_course_cache(code=data.get("code"))
+    return _first(res)
+
+
+async def update_course(course_id: str, data: Row) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("courses").update(data).eq("id", course_id).execute()
+    # Count updates (files_count, quizzes_count) don't touch cached columns
+    if COURSE_CACHE_COLUMNS.intersection(data):
+        invalidate_course_cache(course_id, data.get("code"))
+    return _first(res)
+
+
+async def delete_course_record(course_id: str) -> None:
+    client = await get_client()
+    await client.table("courses").delete().eq("id", course_id).execute()
+    invalidate_course_cache(course_id)
+
+
+async def require_course_owner(course_id: str, user_email: str) -> str:
+    """
+    Verify that user_email owns the course and return the user's id.
+    Raises 404 for an unknown user and 403 when the course is missing or not owned.
+    """
+    user_id = await require_user_id(user_email)
+    course = await get_course(course_id, "created_by")
+    if not course or course["created_by"] != user_id:
+        raise HTTPException(status_code=403, detail="Permission denied")
+    return user_id
+
+
+# ---------------------------------------------------------------------------
+# Course files and ingested documents
+# ---------------------------------------------------------------------------
+
+async def get_course_file(course_file_id: str) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("course_files").select("id, course_id").eq("id", course_file_id).execute()
+    return _first(res)
+
+
+async def list_course_files(course_id: str) -> List[Row]:
+    client = await get_client()
+    res = await client.table("course_files").select("*").eq("course_id", course_id).execute()
+    return res.data or []
+
+
+async def list_course_outlines(course_id: str) -> List[Row]:
+    client = await get_client()
+    res = (
+        await client.table("course_files")
+        .select("id, filename, outline")
+        .eq("course_id", course_id)
+        .order("created_at")
+        .execute()
+    )
+    return res.data or []
+
+
+async def insert_course_file(data: Row) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("course_files").insert(data).execute()
+    return _first(res)
+
+
+async def count_course_files(course_id: str) -> int:
+    client = await get_client()
+    res = (
+        await client.table("course_files")
+        .select("id", count="exact")
+        .eq("course_id", course_id)
+        .execute()
+    )
+    return res.count if res.count is not None else len(res.data or [])
+
+
+async def delete_course_file_record(course_file_id: str) -> None:
+    client = await get_client()
+    await client.table("course_files").delete().eq("id", course_file_id).execute()
+
+
+async def delete_course_files_for_course(course_id: str) -> None:
+    client = await get_client()
+    await client.table("course_files").delete().eq("course_id", course_id).execute()
+
+
+async def delete_documents_for_file(course_file_id: str) -> None:
+    client = await get_client()
+    await client.table("ingested_documents").delete().eq("course_file_id", course_file_id).execute()
+
+
+async def delete_documents_for_course(course_id: str) -> None:
+    client = await get_client()
+    await client.table("ingested_documents").delete().eq("course_id", course_id).execute()
+
+
+async def match_documents(
+    query_embedding: List[float], match_count: int, filter_payload: Row
+) -> List[Row]:
+    client = await get_client()
+    res = await client.rpc(
+        "match_ingested_documents",
+        {
+            "query_embedding": query_embedding,
+            "match_count": match_count,
+            "filter": filter_payload,
+        },
+    ).execute()
+    return res.data or []
+
+
+async def match_course_documents(
+    query_embedding: List[float], course_id: str, match_count: int, ef_search: int
+) -> List[Row]:
+    client = await get_client()
+    res = await client.rpc(
+        "match_course_documents",
+        {
+            "query_embedding": query_embedding,
+            "p_course_id": course_id,
+            "match_count": match_count,
+            "ef_search": ef_search,
+        },
+    ).execute()
+    return res.data or []
+
+
+async def drop_course_vector_index(course_id: str) -> None:
+    client = await get_client()
+    await client.rpc("drop_course_vector_index", {"p_course_id": course_id}).execute()
+
+
+async def match_documents_two_stage(
+    query_embedding: List[float],
+    match_count: int,
+    filter_payload: Row,
+    file_count: int,
+    section_count: int,
+) -> List[Row]:
+    client = await get_client()
+    res = await client.rpc(
+        "match_ingested_documents_two_stage",
+        {
+            "query_embedding": query_embedding,
+            "match_count": match_count,
+            "filter": filter_payload,
+            "file_count": file_count,
+            "section_count": section_count,
+        },
+    ).execute()
+    return res.data or []
+
+
+async def get_chunk_ranges(ranges: List[Tuple[str, int, int]]) -> List[Row]:
+    """
+    Fetch every chunk in the given (course_file_id, first_index, last_index) ranges
+    in a single query, ordered by file and position. start_index (the chunk's
+    character offset in its file) is null for chunks ingested before it was stored.
+    """
+    if not ranges:
+        return []
+    client = await get_client()
+    conditions = ",".join(
+        f"and(course_file_id.eq.{file_id},chunk_index.gte.{first},chunk_index.lte.{last})"
+        for file_id, first, last in ranges
+    )
+    res = (
+        await client.table("ingested_documents")
+        .select("id, course_file_id, chunk_index, content, start_index:metadata->start_index")
+        .or_(conditions)
+        .order("course_file_id")
+        .order("chunk_index")
+        .execute()
+    )
+    return res.data or []
+
+
+# ---------------------------------------------------------------------------
+# Chat sessions and messages
+# ---------------------------------------------------------------------------
+
+async def get_chat_session(session_id: str) -> Optional[Row]:
+    client = await get_client()
+    res = (
+        await client.table("chat_sessions")
+        .select("id, user_id, course_id")
+        .eq("id", session_id)
+        .execute()
+    )
+    return _first(res)
+
+
+async def touch_chat_session(session_id: str, timestamp: str) -> None:
+    client = await get_client()
+    await client.table("chat_sessions").update({"updated_at": timestamp}).eq("id", session_id).execute()
+
+
+async def get_session_summary(session_id: str) -> Optional[str]:
+    client = await get_client()
+    res = await client.table("chat_sessions").select("summary").eq("id", session_id).execute()
+    row = _first(res)
+    return row.get("summary") if row else None
+
+
+async def update_session_summary(session_id: str, summary: str, timestamp: str) -> None:
+    client = await get_client()
+    await (
+        client.table("chat_sessions")
+        .update({"summary": summary, "summary_updated_at": timestamp})
+        .eq("id", session_id)
+        .execute()
+    )
+
+
+def _keyset_before(column: str, cursor: Tuple[str, str]) -> str:
+    # (column, id) < cursor for a descending keyset page, as a PostgREST or() filter
+    value, row_id = cursor
+    return f'{column}.lt."{value}",and({column}.eq."{value}",id.lt.{row_id})'
+
+
+async def list_user_sessions(
+    user_id: str, limit: int, before: Optional[Tuple[str, str]] = None
+) -> List[Row]:
+    """
+    One page of a user's sessions, most recently active first. before is the
+    (last_activity_at, id) of the last row of the previous page.
+    """
+    client = await get_client()
+    query = (
+        client.table("chat_sessions")
+        .select("id, course_id, title, created_at, updated_at, last_activity_at")
+        .eq("user_id", user_id)
+    )
+    if before:
+        query = query.or_(_keyset_before("last_activity_at", before))
+    res = (
+        await query.order("last_activity_at", desc=True)
+        .order("id", desc=True)
+        .limit(limit)
+        .execute()
+    )
+    return res.data or []
+
+
+async def list_session_ids_for_course(course_id: str) -> List[str]:
+    client = await get_client()
+    res = await client.table("chat_sessions").select("id").eq("course_id", course_id).execute()
+    return [row["id"] for row in (res.data or [])]
+
+
+async def delete_chat_session_record(session_id: str) -> None:
+    """
+    Delete a chat session and its messages (messages first).
+    """
+    client = await get_client()
+    await client.table("chat_messages").delete().eq("session_id", session_id).execute()
+    await client.table("chat_sessions").delete().eq("id", session_id).execute()
+
+
+async def delete_chat_sessions_for_course(course_id: str) -> None:
+    client = await get_client()
+    session_ids = await list_session_ids_for_course(course_id)
+    if session_ids:
+        await client.table("chat_messages").delete().in_("session_id", session_ids).execute()
+    await client.table("chat_sessions").delete().eq("course_id", course_id).execute()
+
+
+async def begin_chat_turn(
+    *,
+    user_id: str,
+    course_id: str,
+    session_id: Optional[str],
+    content: str,
+    title_prefix: str,
+    history_limit: int,
+    known_last_message_id: Optional[str] = None,
+) -> Row:
+    """
+    Validate or create the session, bump updated_at, fetch recent history and insert
+    the user's message in one round trip (see migrations/001_chat_begin_turn.sql).
+    Returns {"session_id", "user_message_id", "user_message_created_at", "history",
+    "history_current", "summary"} with history oldest first. When known_last_message_id is still the session's
+    latest message, history is None and history_current is true (migrations/011).
+    """
+    client = await get_client()
+    try:
+        res = await client.rpc(
+            "chat_begin_turn",
+            {
+                "p_user_id": user_id,
+                "p_course_id": course_id,
+                "p_session_id": session_id,
+                "p_content": content,
+                "p_title_prefix": title_prefix,
+                "p_history_limit": history_limit,
+                "p_known_last_message_id": known_last_message_id,
+            },
+        ).execute()
+    except APIError as e:
+        # Session validation errors raised by the function map to 400s
+        if e.code in ("P0002", "22023"):
+            raise HTTPException(status_code=400, detail=e.message)
+        raise
+    return res.data
+
+
+async def insert_chat_message(data: Row) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("chat_messages").insert(data).execute()
+    return _first(res)
+
+
+async def flush_chat_writes(messages: List[Row], touches: List[Row]) -> None:
+    """
+    Store a batch of deferred chat writes in one transaction (see
+    migrations/013_write_behind.sql and 017_chat_message_order.sql). Messages
+    already stored are skipped, so a batch can safely be sent again.
+    """
+    client = await get_client()
+    await client.rpc("chat_flush_writes", {"p_messages": messages, "p_touches": touches}).execute()
+
+
+async def insert_chat_run(data: Row) -> None:
+    client = await get_client()
+    await client.table("chat_runs").insert(data).execute()
+
+
+async def get_recent_messages(session_id: str, limit: int) -> List[Row]:
+    """
+    Return the latest `limit` messages of a session, newest first.
+    """
+    client = await get_client()
+    res = (
+        await client.table("chat_messages")
+        .select("id, content, sender, created_at")
+        .eq("session_id", session_id)
+        .order("created_at", desc=True)
+        .limit(limit)
+        .execute()
+    )
+    return res.data or []
+
+
+async def fetch_session_messages(
+    session_id: str, limit: int, before: Optional[Tuple[str, str]] = None
+) -> List[Row]:
+    """
+    One page of a session's messages, newest first. before is the (created_at, id)
+    of the oldest message already loaded.
+    """
+    client = await get_client()
+    query = (
+        client.table("chat_messages")
+        .select("id, content, sender, thinking_time, created_at")
+        .eq("session_id", session_id)
+    )
+    if before:
+        query = query.or_(_keyset_before("created_at", before))
+    res = (
+        await query.order("created_at", desc=True)
+        .order("id", desc=True)
+        .limit(limit)
+        .execute()
+    )
+    return res.data or []
+
+
+# ---------------------------------------------------------------------------
+# Quizzes
+# ---------------------------------------------------------------------------
+
+async def list_quiz_topics(course_id: str) -> List[Row]:
+    client = await get_client()
+    res = await client.table("quiz_topics").select("*").eq("course_id", course_id).execute()
+    return res.data or []
+
+
+async def get_quiz_topic(topic_id: str, course_id: Optional[str] = None) -> Optional[Row]:
+    client = await get_client()
+    query = client.table("quiz_topics").select("*").eq("id", topic_id)
+    if course_id:
+        query = query.eq("course_id", course_id)
+    res = await query.execute()
+    return _first(res)
+
+
+async def count_quiz_topics(course_id: str) -> int:
+    client = await get_client()
+    res = (
+        await client.table("quiz_topics")
+        .select("id", count="exact")
+        .eq("course_id", course_id)
+        .execute()
+    )
+    return res.count if res.count is not None else 0
+
+
+async def insert_quiz_topic(data: Row) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("quiz_topics").insert(data).execute()
+    return _first(res)
+
+
+async def update_quiz_topic(topic_id: str, data: Row) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("quiz_topics").update(data).eq("id", topic_id).execute()
+    return _first(res)
+
+
+async def delete_quiz_topic(topic_id: str) -> None:
+    """
+    Delete a quiz topic and its questions (questions first, foreign key constraint).
+    """
+    client = await get_client()
+    await client.table("quiz_questions").delete().eq("topic_id", topic_id).execute()
+    await client.table("quiz_topics").delete().eq("id", topic_id).execute()
+
+
+async def delete_quizzes_for_course(course_id: str) -> None:
+    client = await get_client()
+    await client.table("quizzes").delete().eq("course_id", course_id).execute()
+
+
+async def list_topic_questions(topic_id: str, ordered: bool = False) -> List[Row]:
+    client = await get_client()
+    query = client.table("quiz_questions").select("*").eq("topic_id", topic_id)
+    if ordered:
+        query = query.order("created_at")
+    res = await query.execute()
+    return res.data or []
+
+
+async def list_questions_for_topics(topic_ids: List[str]) -> List[Row]:
+    if not topic_ids:
+        return []
+    client = await get_client()
+    res = await client.table("quiz_questions").select("*").in_("topic_id", topic_ids).execute()
+    return res.data or []
+
+
+async def get_quiz_question(question_id: str) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("quiz_questions").select("topic_id").eq("id", question_id).execute()
+    return _first(res)
+
+
+async def insert_quiz_questions(rows: List[Row]) -> List[Row]:
+    client = await get_client()
+    res = await client.table("quiz_questions").insert(rows).execute()
+    return res.data or []
+
+
+async def update_quiz_question(question_id: str, data: Row) -> Optional[Row]:
+    client = await get_client()
+    res = await client.table("quiz_questions").update(data).eq("id", question_id).execute()
+    return _first(res)
+
+
+async def delete_quiz_question(question_id: str) -> None:
+    client = await get_client()
+    await client.table("quiz_questions").delete().eq("id", question_id).execute()
+
+
+async def adjust_quizzes_count(course_id: str, delta: int) -> None:
+    """
+    Increment/decrement courses.quizzes_count (never below zero).
+    """
+    course = await get_course(course_id, "quizzes_count")
+    if course is None:
+        return
+    current_count = course.get("quizzes_count", 0) or 0
+    await update_course(course_id, {"quizzes_count": max(0, current_count + delta)})
@@ -0,0 +1,135 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+from cachetools import LRUCache, TTLCache
+
+from database import get_chunk_ranges, get_course_by_code, list_course_outlines
+from retrieval import estimate_tokens, stitch_chunks
+
+# Per-course outlines are small; keep them for a few minutes per worker
+OUTLINE_CACHE_TTL = int(os.environ.get("DOC_OUTLINE_CACHE_TTL", "300"))
+OUTLINE_CACHE_SIZE = int(os.environ.get("DOC_OUTLINE_CACHE_SIZE", "256"))
+# Page content is bounded by total size (bytes), not by entry count
+PAGE_CACHE_BYTES = int(os.environ.get("DOC_PAGE_CACHE_BYTES", str(16 * 1024 * 1024)))
+# Longest page returned to the model in one tool call
+PAGE_TOKEN_CAP = int(os.environ.get("DOC_PAGE_TOKEN_CAP", "3000"))
+# Longest page listing returned to the model
+OUTLINE_MAX_LINES = int(os.environ.get("DOC_OUTLINE_MAX_LINES", "200"))
+
+# course_id -> [{"id", "filename", "outline"}]
+_outline_cache: TTLCache = TTLCache(maxsize=OUTLINE_CACHE_SIZE, ttl=OUTLINE_CACHE_TTL)
+# (course_file_id, first_chunk, last_chunk) -> page text; chunks never change once ingested
+_page_cache: LRUCache = LRUCache(maxsize=PAGE_CACHE_BYTES, getsizeof=lambda text: len(text.encode("utf-8")))
+
+
+def invalidate_course_outline(course_id: str) -> None:
+    """
+    Drop the cached outline after files are added to or removed from a course.
+    """
+    _outline_cache.pop(course_id, None)
+
+
+async def _resolve_course_id(course_id: Optional[str], course_code: Optional[str]) -> Optional[str]:
+    if course_id:
+        return course_id
+    if course_code:
+        course = await get_course_by_code(course_code, "id")
+        return course["id"] if course else None
+    return None
+
+
+async def get_course_outline(course_id: str) -> List[Dict]:
+    outline = _outline_cache.get(course_id)
+    if outline is None:
+        outline = await list_course_outlines(course_id)
+        _outline_cache[course_id] = outline
+    return outline
+
+
+def _page_range(course_file: Dict, section_no: Optional[int]) -> Optional[Tuple[int, int]]:
+    sections = course_file.get("outline") or []
+    if not sections:
+        return None
+    if section_no is None:
+        return sections[0]["first_chunk"], max(s["last_chunk"] for s in sections)
+    if not 1 <= section_no <= len(sections):
+        return None
+    section = sections[section_no - 1]
+    return section["first_chunk"], section["last_chunk"]
+
+
+def format_outline(files: List[Dict]) -> str:
+    lines = ["Documentation pages (pass a page id to get_page_content; a file id returns the whole file):"]
+    for file_no, course_file in enumerate(files, start=1):
+        sections = course_file.get("outline") or []
+        suffix = "" if sections else " (no outline available; use RAG for this file)"
+        lines.append(f"[{file_no}] {course_file['filename']}{suffix}")
+        for section_no, section in enumerate(sections, start=1):
+            indent = "  " * min(section.get("level", 1), 4)
+            lines.append(f"{indent}[{file_no}.{section_no}] {section['title']}")
+    if len(lines) > OUTLINE_MAX_LINES:
+        hidden = len(lines) - OUTLINE_MAX_LINES
+        lines = lines[:OUTLINE_MAX_LINES] + [f"... {hidden} more entries not shown"]
+    return "\n".join(lines)
+
+
+async def list_documentation_pages(course_id: Optional[str], course_code: Optional[str]) -> str:
+    """
+    Return the course's files and their section headings with page ids.
+    """
+    try:
+        resolved_id = await _resolve_course_id(course_id, course_code)
+        if not resolved_id:
+            return "No course selected, so there are no documentation pages to list."
+        files = await get_course_outline(resolved_id)
+        if not files:
+            return "No documentation pages found for this course."
+        return format_outline(files)
+    except Exception as e:
+        print(f"Error listing documentation pages: {e}")
+        return f"Error listing documentation pages: {str(e)}"
+
+
+async def get_page_content(course_id: Optional[str], course_code: Optional[str], page_id: str) -> str:
+    """
+    Return the text of a page ("2" for a whole file, "2.3" for one section),
+    served from the page cache when possible.
+    """
+    try:
+        resolved_id = await _resolve_course_id(course_id, course_code)
+        if not resolved_id:
+            return "No course selected, so there is no page content to retrieve."
+
+        # Parse "file" or "file.section"
+        parts = page_id.strip().strip("[]").split(".")
+        try:
+            file_no = int(parts[0])
+            section_no = int(parts[1]) if len(parts) > 1 and parts[1] else None
+        except ValueError:
+            return f"Invalid page id '{page_id}'. Use an id from list_documentation_pages, e.g. '1' or '1.2'."
+
+        files = await get_course_outline(resolved_id)
+        if not 1 <= file_no <= len(files):
+            return f"Page '{page_id}' not found. Call list_documentation_pages for valid ids."
+        course_file = files[file_no - 1]
+        page_range = _page_range(course_file, section_no)
+        if page_range is None:
+            return f"Page '{page_id}' is not available. Use retrieve_relevant_documentation instead."
+
+        key = (course_file["id"], *page_range)
+        content = _page_cache.get(key)
+        if content is None:
+            rows = await get_chunk_ranges([key])
+            content = stitch_chunks(rows)
+            if not content:
+                return f"Page '{page_id}' has no stored content. Use retrieve_relevant_documentation instead."
+            # cachetools raises ValueError for an item larger than the whole cache
+            if _page_cache.getsizeof(content) <= _page_cache.maxsize:
+                _page_cache[key] = content
+
+        if estimate_tokens(content) > PAGE_TOKEN_CAP:
+            content = content[:PAGE_TOKEN_CAP * 4].rstrip() + "\n\n... (truncated; request a single section for the rest)"
+        return f"{course_file['filename']} [{page_id}]\n\n{content}"
+    except Exception as e:
+        print(f"Error retrieving page content: {e}")
+        return f"Error retrieving page content: {str(e)}"
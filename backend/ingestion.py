@@ -1,9 +1,11 @@
 # Import Basics
-import os
+import re
 from time import time
 from pathlib import Path
 from dotenv import load_dotenv
-from typing import Union, Dict, Optional
+from typing import Union, Dict, List, Optional
+
+import numpy as np
 
 # Import Docling (Text extraction from unstructured)
 from docling.datamodel.base_models import InputFormat
@@ -16,17 +18,12 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 # Import Gemini (Embedding)
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
-# Import Supabase (Vector Database)
-from supabase import create_client, Client
+# Import shared data-access layer (Vector Database)
+from database import get_sync_client
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Supabase
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-
 # Initialize Docling converter
 pipeline_options = PdfPipelineOptions()
 pipeline_options.do_ocr = True
@@ -42,11 +39,57 @@ converter = DocumentConverter(
 )
 
 # Initialize LangChain chunker
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=690, chunk_overlap=100)
+text_splitter = RecursiveCharacterTextSplitter(chunk_size=690, chunk_overlap=100, add_start_index=True)
 
 # Initialize Gemini embedding model
 embeddings = GoogleGenerativeAIEmbeddings(model="models/gemini-embedding-001")
 
+# Markdown headings in the Docling export ("## Title")
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$", re.MULTILINE)
+
+
+def build_outline(text: str, chunks: List) -> List[Dict]:
+    """
+    Map each markdown section of a file to the range of chunks that cover it.
+    Returns [{"title", "level", "first_chunk", "last_chunk"}] in document order.
+    """
+    if not chunks:
+        return []
+    sections = [(m.start(), len(m.group(1)), m.group(2).strip()) for m in HEADING_PATTERN.finditer(text)]
+    if not sections or text[:sections[0][0]].strip():
+        # Content before the first heading becomes its own section
+        sections.insert(0, (0, 1, "(Introduction)"))
+
+    spans = [
+        (chunk.metadata.get("start_index", 0), chunk.metadata.get("start_index", 0) + len(chunk.page_content))
+        for chunk in chunks
+    ]
+    outline = []
+    for position, (start, level, title) in enumerate(sections):
+        end = sections[position + 1][0] if position + 1 < len(sections) else len(text)
+        covering = [idx for idx, (chunk_start, chunk_end) in enumerate(spans) if chunk_end > start and chunk_start < end]
+        if not covering:
+            continue
+        outline.append({
+            "title": title,
+            "level": level,
+            "first_chunk": covering[0],
+            "last_chunk": covering[-1],
+        })
+    return outline
+
+
+def centroid(vectors: List[List[float]]) -> List[float]:
+    """
+    Unit-normalised mean of a set of embeddings (cosine-comparable with query embeddings).
+    """
+    mean = np.mean(np.asarray(vectors, dtype=np.float32), axis=0)
+    norm = float(np.linalg.norm(mean))
+    if norm > 0:
+        mean = mean / norm
+    return mean.tolist()
+
+
 def files_upload(
     documents_dir: Union[str, Path],
     *,
@@ -57,6 +100,8 @@ def files_upload(
 ) -> Dict:
     start = time()
     try:
+        # Ingestion runs in a worker thread, so it uses the pooled synchronous client
+        supabase = get_sync_client()
         documents_path = Path(documents_dir)
         
         # Get all supported file types
@@ -100,8 +145,11 @@ def files_upload(
             
             chunks = text_splitter.create_documents([text])
             total_chunks = len(chunks)
+
+            file_embeddings = []
             for idx, chunk in enumerate(chunks):
                 embedding = embeddings.embed_query(chunk.page_content)
+                file_embeddings.append(embedding)
                 all_chunks.append({
                     "filename": file_path.name,
                     "content": chunk.page_content,
@@ -109,15 +157,43 @@ def files_upload(
                     "metadata": {
                         "source": str(file_path),
                         "chunk_index": idx,
-                        "total_chunks": total_chunks
+                        "total_chunks": total_chunks,
+                        # Character offset in the file, so retrieval can stitch neighbours exactly
+                        "start_index": chunk.metadata.get("start_index"),
                     }
                 })
+
+            # Store the file's outline and centroids (documentation page tools, two-stage retrieval)
+            course_file_id = actual_course_file_ids.get(file_path.name)
+            if course_file_id and chunks:
+                outline = build_outline(text, chunks)
+                supabase.table("course_files").update({
+                    "outline": outline,
+                    "centroid": centroid(file_embeddings),
+                }).eq("id", course_file_id).execute()
+                section_rows = [
+                    {
+                        "course_id": course_id,
+                        "course_file_id": course_file_id,
+                        "section_index": section_no,
+                        "title": section["title"],
+                        "first_chunk": section["first_chunk"],
+                        "last_chunk": section["last_chunk"],
+                        "centroid": centroid(file_embeddings[section["first_chunk"]:section["last_chunk"] + 1]),
+                    }
+                    for section_no, section in enumerate(outline)
+                ]
+                if section_rows:
+                    supabase.table("course_file_sections").insert(section_rows).execute()
         
         # Insert into ingested_documents with required fields
         for chunk in all_chunks:
             row = {
                 "content": chunk["content"],
                 "embedding": chunk["embedding"],
+                "chunk_index": chunk["metadata"]["chunk_index"],
+                "total_chunks": chunk["metadata"]["total_chunks"],
+                "metadata": chunk["metadata"],
             }
             # Optionally include course linkage if provided
             if course_id:
@@ -136,7 +212,7 @@ def files_upload(
         if generate_quiz and course_id and user_email and file_contents:
             try:
                 import asyncio
-                quiz_result = asyncio.run(generate_quizzes_for_files(
+                quiz_result = asyncio.run(_generate_quizzes_in_thread(
                     course_id=course_id,
                     user_email=user_email,
                     file_contents=file_contents,
@@ -159,6 +235,22 @@ def files_upload(
         return {"ingestion": f"Error: {str(e)}", "quiz_generation": "Not attempted due to ingestion error"}
 
 
+async def _generate_quizzes_in_thread(**kwargs) -> Dict:
+    """
+    generate_quizzes_for_files on a loop created by asyncio.run in this thread.
+    The loop's OpenAI and Supabase clients are closed before it ends, so each
+    upload doesn't leave a connection pool behind.
+    """
+    from database import close_clients
+    from llm_client import close_openai_client
+
+    try:
+        return await generate_quizzes_for_files(**kwargs)
+    finally:
+        await close_openai_client()
+        await close_clients()
+
+
 async def generate_quizzes_for_files(
     course_id: str,
     user_email: str,
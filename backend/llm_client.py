@@ -0,0 +1,96 @@
+"""
+Shared OpenAI client.
+
+The agent, chat, conversation summaries and quiz generation all use the client
+returned by get_openai_client() instead of constructing AsyncOpenAI() per call.
+There is one client per event loop, backed by a keep-alive httpx pool, so
+requests reuse warm connections instead of paying a TLS handshake per message.
+"""
+import os
+import asyncio
+import weakref
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+# Connection pool tuning (per worker process)
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.environ.get("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "2"))
+# Default timeouts; individual calls pass their own timeout= where they need less/more
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "60"))
+
+# Per-call timeouts (seconds)
+CHAT_TIMEOUT = OPENAI_TIMEOUT
+SUMMARY_TIMEOUT = float(os.environ.get("OPENAI_SUMMARY_TIMEOUT", "20"))
+QUIZ_TIMEOUT = float(os.environ.get("OPENAI_QUIZ_TIMEOUT", "120"))
+
+# One client (and pydantic-ai model per model name) per event loop. The main
+# uvicorn loop owns the long-lived one; ingestion threads that call
+# asyncio.run(...) get their own short-lived client.
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = (
+    weakref.WeakKeyDictionary()
+)
+_chat_models: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _http_client() -> httpx.AsyncClient:
+    return DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    )
+
+
+def get_openai_client() -> AsyncOpenAI:
+    """
+    Return the pooled AsyncOpenAI client for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(
+            http_client=_http_client(),
+            max_retries=OPENAI_MAX_RETRIES,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        )
+        _clients[loop] = client
+    return client
+
+
+def get_chat_model(model_name: str) -> OpenAIChatModel:
+    """
+    Return a pydantic-ai chat model backed by the shared client. Pass it as
+    model= to agent.run / agent.iter so agent requests use the same pool.
+    """
+    loop = asyncio.get_running_loop()
+    models = _chat_models.setdefault(loop, {})
+    model = models.get(model_name)
+    if model is None:
+        model = OpenAIChatModel(model_name, provider=OpenAIProvider(openai_client=get_openai_client()))
+        models[model_name] = model
+    return model
+
+
+async def close_openai_client() -> None:
+    """
+    Close the client owned by the running loop (called on app shutdown).
+    """
+    loop = asyncio.get_running_loop()
+    _chat_models.pop(loop, None)
+    client: Optional[AsyncOpenAI] = _clients.pop(loop, None)
+    if client is not None:
+        try:
+            await client.close()
+        except Exception as e:
+            print(f"Warning: Could not close OpenAI connection pool cleanly: {e}")
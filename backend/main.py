@@ -1,28 +1,80 @@
-import os
 import tempfile
 import shutil
 import asyncio
 from functools import partial
 from pathlib import Path
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from typing import List
 from ingestion import files_upload
 from course_management import upload_course_files, delete_course_file, delete_course
-from agent import cpss_chat_expert, CPSSChatDeps
-from supabase.client import create_client
-from openai import AsyncOpenAI
+from admission import acquire_model_slot, admit, bind_model_limiters
+from agent import cpss_chat_expert, CPSSChatDeps, get_agent_model, llm
+from llm_client import close_openai_client, get_openai_client
+from write_behind import start_write_behind, stop_write_behind
+from warmup import warm_course
+from documentation import invalidate_course_outline
+from database import (
+    adjust_quizzes_count,
+    close_clients,
+    count_course_files,
+    count_quiz_topics,
+    delete_chat_session_record,
+    delete_course_files_for_course,
+    delete_course_record,
+    delete_quiz_question,
+    delete_quiz_topic,
+    get_client,
+    get_course,
+    get_quiz_question,
+    get_quiz_topic,
+    get_user_id_by_email,
+    insert_course,
+    insert_quiz_questions,
+    insert_quiz_topic,
+    list_course_files,
+    list_course_ids,
+    list_quiz_topics,
+    list_topic_questions,
+    require_course_owner,
+    update_course,
+    update_quiz_question,
+    update_quiz_topic,
+)
 from user_management import login_user, UserLoginRequest
 from chat_management import (
     chat_send as chat_send_service,
+    chat_stream as chat_stream_service,
     ChatSendRequest,
     list_chat_sessions as list_chat_sessions_service,
     list_session_messages as list_session_messages_service,
+    run_until_disconnected,
 )
 from quiz_generation import get_course_quizzes
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Model concurrency limits cover calls from ingestion threads' loops too
+    bind_model_limiters()
+    # Open the pooled Supabase connection up front and close it on shutdown
+    try:
+        await get_client()
+    except Exception as e:
+        print(f"Warning: Could not initialise Supabase client: {e}")
+    # Replay chat writes journaled before the last shutdown and start the flusher
+    try:
+        await start_write_behind()
+    except Exception as e:
+        print(f"Warning: Could not start chat write-behind, storing chat messages directly: {e}")
+    yield
+    await stop_write_behind()
+    await close_clients()
+    await close_openai_client()
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow CORS from both localhost and Vercel deployment
 app.add_middleware(
@@ -37,30 +89,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def sync_course_quiz_counts():
+async def sync_course_quiz_counts():
     """
     Helper function to sync quiz counts for all courses based on actual quiz_topics count
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        
         # Get all courses
-        courses_result = supabase_client.table("courses").select("id").execute()
-        
-        if courses_result.data:
-            for course in courses_result.data:
-                course_id = course["id"]
-                
-                # Count actual quiz topics for this course
-                quiz_count_result = supabase_client.table("quiz_topics").select("id", count="exact").eq("course_id", course_id).execute()
-                actual_count = quiz_count_result.count if quiz_count_result.count is not None else 0
-                
-                # Update the course with correct count
-                supabase_client.table("courses").update({"quizzes_count": actual_count}).eq("id", course_id).execute()
-                
+        for course_id in await list_course_ids():
+            # Count actual quiz topics for this course
+            actual_count = await count_quiz_topics(course_id)
+            
+            # Update the course with correct count
+            await update_course(course_id, {"quizzes_count": actual_count})
+            
         return {"success": True, "message": "Quiz counts synced"}
     except Exception as e:
         print(f"Error syncing quiz counts: {e}")
@@ -83,14 +124,13 @@ async def user_management(request: UserLoginRequest):
 #     return pdf_upload()
 
 @app.post("/query")
-async def query(q: str):
-    supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
-        )
-    openai_client = AsyncOpenAI()
-    deps = CPSSChatDeps(supabase=supabase_client, openai_client=openai_client)
-    response = await cpss_chat_expert.run(q, deps=deps)
+async def query(q: str, request: Request):
+    # No user on this route: rate-limit by client address, and shed before any work
+    admit(f"ip:{request.client.host}" if request.client else None, llm)
+    openai_client = get_openai_client()
+    deps = CPSSChatDeps(openai_client=openai_client)
+    async with await acquire_model_slot(llm):
+        response = await cpss_chat_expert.run(q, deps=deps, model=get_agent_model())
     print(response.output)
     return response.output
 
@@ -107,19 +147,10 @@ async def create_course_route(
     """
     temp_dir = None
     try:
-        # Initialize Supabase client
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"],
-        )
-
         # Resolve user by email to get UUID
-        user_res = (
-            supabase_client.table("users").select("id").eq("email", user_email).execute()
-        )
-        if not user_res.data:
+        user_id = await get_user_id_by_email(user_email)
+        if not user_id:
             raise HTTPException(status_code=404, detail="User not found for provided email")
-        user_id = user_res.data[0]["id"]
 
         # Create course record first (but files_count will be updated after successful ingestion)
         try:
@@ -130,10 +161,9 @@ async def create_course_route(
                 "files_count": 0,  # Will be updated after successful ingestion
                 "quizzes_count": 0,
             }
-            course_res = supabase_client.table("courses").insert(course_insert).execute()
-            if not course_res.data:
+            course = await insert_course(course_insert)
+            if not course:
                 raise HTTPException(status_code=500, detail="Failed to create course")
-            course = course_res.data[0]
             course_id = course["id"]
         except Exception as e:
             if "duplicate key value violates unique constraint" in str(e):
@@ -185,11 +215,15 @@ async def create_course_route(
             temp_dir
         )
         
+        # An outline cached while the files were being ingested is incomplete
+        invalidate_course_outline(course_id)
+
         # Update course files count after successful ingestion
         final_files_count = len(uploaded_files)
-        supabase_client.table("courses").update({
-            "files_count": final_files_count
-        }).eq("id", course_id).execute()
+        await update_course(course_id, {
+            "files_count": final_files_count,
+            "content_updated_at": datetime.utcnow().isoformat(),
+        })
 
         # Clean up temporary directory
         shutil.rmtree(temp_dir)
@@ -207,8 +241,8 @@ async def create_course_route(
         # Clean up course if it was created but processing failed
         if 'course_id' in locals():
             try:
-                supabase_client.table("course_files").delete().eq("course_id", course_id).execute()
-                supabase_client.table("courses").delete().eq("id", course_id).execute()
+                await delete_course_files_for_course(course_id)
+                await delete_course_record(course_id)
             except:
                 pass  # Best effort cleanup
         raise
@@ -216,8 +250,8 @@ async def create_course_route(
         # Clean up course if it was created but processing failed
         if 'course_id' in locals():
             try:
-                supabase_client.table("course_files").delete().eq("course_id", course_id).execute()
-                supabase_client.table("courses").delete().eq("id", course_id).execute()
+                await delete_course_files_for_course(course_id)
+                await delete_course_record(course_id)
             except:
                 pass  # Best effort cleanup
         raise HTTPException(status_code=500, detail=f"Error creating course: {str(e)}")
@@ -236,24 +270,14 @@ async def upload_course_files_route(
     """
     temp_dir = None
     try:
-        # Init Supabase client
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]
-        )
-
         # Resolve user ID
-        user_res = (
-            supabase_client.table("users").select("id").eq("email", user_email).execute()
-        )
-        if not user_res.data:
+        user_id = await get_user_id_by_email(user_email)
+        if not user_id:
             raise HTTPException(status_code=404, detail="User not found for provided email")
-        user_id = user_res.data[0]["id"]
 
         # Ensure course exists
-        course_res = (
-            supabase_client.table("courses").select("id, created_by").eq("id", course_id).execute()
-        )
-        if not course_res.data:
+        course_row = await get_course(course_id, "id, created_by")
+        if not course_row:
             raise HTTPException(status_code=404, detail="Course not found")
 
         # Prepare temp dir and files for processing
@@ -297,20 +321,23 @@ async def upload_course_files_route(
             temp_dir
         )
 
+        # New files change the course outline
+        invalidate_course_outline(course_id)
+
         # Update course files count
-        total_files = supabase_client.table("course_files").select("id", count="exact").eq("course_id", course_id).execute()
-        files_count = total_files.count if total_files.count else 0
-        supabase_client.table("courses").update({"files_count": files_count}).eq("id", course_id).execute()
+        files_count = await count_course_files(course_id)
+        # Bumping content_updated_at keeps chat answers from before the upload from being reused
+        await update_course(course_id, {
+            "files_count": files_count,
+            "content_updated_at": datetime.utcnow().isoformat(),
+        })
 
         # Get updated course data including quizzes count
-        updated_course_res = (
-            supabase_client.table("courses")
-            .select("id, code, name, created_by, files_count, quizzes_count, created_at")
-            .eq("id", course_id)
-            .execute()
+        updated_course = await get_course(
+            course_id, "id, code, name, created_by, files_count, quizzes_count, created_at"
         )
         
-        course_data = updated_course_res.data[0] if updated_course_res.data else {"id": course_id}
+        course_data = updated_course or {"id": course_id}
 
         # Clean up temp directory
         shutil.rmtree(temp_dir)
@@ -350,19 +377,48 @@ async def delete_course_route(
     return await delete_course(course_id=course_id, user_email=user_email)
 
 
+@app.post("/courses/{course_id}/warm")
+async def warm_course_route(course_id: str):
+    """
+    Call when a student opens a course chat: prepares the course agent, outline,
+    vector index and connections in the background so the first question is fast.
+    """
+    return await warm_course(course_id)
+
+
 @app.post("/chat/send")
-async def chat_send(payload: ChatSendRequest):
-    return await chat_send_service(payload)
+async def chat_send(payload: ChatSendRequest, request: Request):
+    # Cancel the agent run if the client (or the frontend proxy) gives up waiting
+    return await run_until_disconnected(chat_send_service(payload), request.is_disconnected)
+
+
+@app.post("/chat/stream")
+async def chat_stream(payload: ChatSendRequest):
+    """
+    Same as /chat/send but streams the answer as Server-Sent Events
+    (session, token, tool_call, tool_result, retrieval, done, error).
+    """
+    events = await chat_stream_service(payload)
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/chat/sessions")
-async def list_chat_sessions(user_id: str | None = None, user_email: str | None = None):
-    return await list_chat_sessions_service(user_id=user_id, user_email=user_email)
+async def list_chat_sessions(
+    user_id: str | None = None,
+    user_email: str | None = None,
+    limit: int | None = None,
+    cursor: str | None = None,
+):
+    return await list_chat_sessions_service(user_id=user_id, user_email=user_email, limit=limit, cursor=cursor)
 
 
 @app.get("/chat/sessions/{session_id}/messages")
-async def list_session_messages(session_id: str):
-    return await list_session_messages_service(session_id)
+async def list_session_messages(session_id: str, limit: int | None = None, cursor: str | None = None):
+    return await list_session_messages_service(session_id, limit=limit, cursor=cursor)
 
 # DELETE chat session endpoint
 @app.delete("/chat/sessions/{session_id}")
@@ -371,14 +427,8 @@ async def delete_chat_session(session_id: str):
     Delete a chat session and its messages.
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        # Delete messages first
-        supabase_client.table("chat_messages").delete().eq("session_id", session_id).execute()
-        # Delete session
-        supabase_client.table("chat_sessions").delete().eq("id", session_id).execute()
+        # Delete messages first, then the session
+        await delete_chat_session_record(session_id)
         return {"success": True}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete session: {str(e)}")
@@ -403,20 +453,8 @@ async def create_quiz_topic_route(
     Create a new empty quiz topic
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        
         # Verify user has permission (course owner)
-        user_res = supabase_client.table("users").select("id").eq("email", user_email).execute()
-        if not user_res.data:
-            raise HTTPException(status_code=404, detail="User not found")
-        user_id = user_res.data[0]["id"]
-        
-        course_res = supabase_client.table("courses").select("created_by").eq("id", course_id).execute()
-        if not course_res.data or course_res.data[0]["created_by"] != user_id:
-            raise HTTPException(status_code=403, detail="Permission denied")
+        await require_course_owner(course_id, user_email)
         
         # Create new quiz topic
         topic_data = {
@@ -425,12 +463,12 @@ async def create_quiz_topic_route(
             "created_at": datetime.utcnow().isoformat()
         }
         
-        create_res = supabase_client.table("quiz_topics").insert(topic_data).execute()
+        created_topic = await insert_quiz_topic(topic_data)
         
-        if not create_res.data:
+        if not created_topic:
             raise HTTPException(status_code=500, detail="Failed to create quiz topic")
         
-        return {"success": True, "topic": create_res.data[0], "message": "Quiz topic created successfully"}
+        return {"success": True, "topic": created_topic, "message": "Quiz topic created successfully"}
         
     except HTTPException:
         raise
@@ -450,26 +488,21 @@ async def generate_quiz_for_course_route(
         from quiz_generation import generate_quiz_for_file, QuizGenerationRequest
         from ingestion import generate_quizzes_for_files
         
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        
         # Get all course files
-        files_result = supabase_client.table("course_files").select("*").eq("course_id", course_id).execute()
+        course_files = await list_course_files(course_id)
         
-        if not files_result.data:
+        if not course_files:
             return {"success": False, "message": "No files found for this course"}
         
         # Check which files already have quizzes
-        existing_topics = supabase_client.table("quiz_topics").select("*").eq("course_id", course_id).execute()
-        existing_filenames = {topic.get("topic_name", "").split(" - ")[0] for topic in existing_topics.data} if existing_topics.data else set()
+        existing_topics = await list_quiz_topics(course_id)
+        existing_filenames = {topic.get("topic_name", "").split(" - ")[0] for topic in existing_topics}
         
         # For simplicity, we'll regenerate content from files that need quizzes
         # In a production environment, you might want to store the original content
         quiz_results = []
         
-        for file_record in files_result.data:
+        for file_record in course_files:
             filename = file_record["filename"]
             
             # Skip if quiz already exists (basic check)
@@ -505,37 +538,15 @@ async def delete_quiz_topic_route(
     Delete a quiz topic and all its questions
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        
         # Verify user has permission (course owner)
-        user_res = supabase_client.table("users").select("id").eq("email", user_email).execute()
-        if not user_res.data:
-            raise HTTPException(status_code=404, detail="User not found")
-        user_id = user_res.data[0]["id"]
-        
-        course_res = supabase_client.table("courses").select("created_by").eq("id", course_id).execute()
-        if not course_res.data or course_res.data[0]["created_by"] != user_id:
-            raise HTTPException(status_code=403, detail="Permission denied")
+        await require_course_owner(course_id, user_email)
         
-        # Delete questions first (foreign key constraint)
-        supabase_client.table("quiz_questions").delete().eq("topic_id", topic_id).execute()
+        # Delete questions first (foreign key constraint), then the topic
+        await delete_quiz_topic(topic_id)
         
-        # Delete topic
-        supabase_client.table("quiz_topics").delete().eq("id", topic_id).execute()
-        
-        # Update quiz count in courses table
+        # Update quiz count in courses table (never below 0)
         try:
-            # Get current quiz count
-            course_result = supabase_client.table("courses").select("quizzes_count").eq("id", course_id).execute()
-            if course_result.data:
-                current_count = course_result.data[0].get("quizzes_count", 0) or 0
-                new_count = max(0, current_count - 1)  # Ensure count doesn't go below 0
-                
-                # Update the count
-                supabase_client.table("courses").update({"quizzes_count": new_count}).eq("id", course_id).execute()
+            await adjust_quizzes_count(course_id, -1)
         except Exception as e:
             print(f"Warning: Failed to update quiz count: {e}")
             # Don't fail the entire operation if count update fails
@@ -559,32 +570,18 @@ async def update_quiz_topic_route(
     Update a quiz topic name
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        
         # Verify user has permission (course owner)
-        user_res = supabase_client.table("users").select("id").eq("email", user_email).execute()
-        if not user_res.data:
-            raise HTTPException(status_code=404, detail="User not found")
-        user_id = user_res.data[0]["id"]
-        
-        course_res = supabase_client.table("courses").select("created_by").eq("id", course_id).execute()
-        if not course_res.data or course_res.data[0]["created_by"] != user_id:
-            raise HTTPException(status_code=403, detail="Permission denied")
+        await require_course_owner(course_id, user_email)
         
         # Verify topic belongs to the course
-        topic_res = supabase_client.table("quiz_topics").select("course_id").eq("id", topic_id).execute()
-        if not topic_res.data or topic_res.data[0]["course_id"] != course_id:
+        topic_row = await get_quiz_topic(topic_id)
+        if not topic_row or topic_row["course_id"] != course_id:
             raise HTTPException(status_code=404, detail="Quiz topic not found or doesn't belong to this course")
         
         # Update topic name
-        update_res = supabase_client.table("quiz_topics").update({
-            "topic_name": topic_name.strip()
-        }).eq("id", topic_id).execute()
+        updated_topic = await update_quiz_topic(topic_id, {"topic_name": topic_name.strip()})
         
-        if not update_res.data:
+        if not updated_topic:
             raise HTTPException(status_code=500, detail="Failed to update quiz topic")
         
         return {"success": True, "message": "Quiz topic updated successfully"}
@@ -601,23 +598,16 @@ async def get_quiz_topic_details_route(course_id: str, topic_id: str):
     Get detailed information about a quiz topic including all questions
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
+        # Get topic details and all questions for this topic concurrently
+        topic, questions = await asyncio.gather(
+            get_quiz_topic(topic_id, course_id),
+            list_topic_questions(topic_id, ordered=True),
         )
-        
-        # Get topic details
-        topic_res = supabase_client.table("quiz_topics").select("*").eq("id", topic_id).eq("course_id", course_id).execute()
-        if not topic_res.data:
+        if not topic:
             raise HTTPException(status_code=404, detail="Quiz topic not found")
         
-        topic = topic_res.data[0]
-        
-        # Get all questions for this topic
-        questions_res = supabase_client.table("quiz_questions").select("*").eq("topic_id", topic_id).order("created_at").execute()
-        
-        topic["questions"] = questions_res.data or []
-        topic["question_count"] = len(questions_res.data or [])
+        topic["questions"] = questions
+        topic["question_count"] = len(questions)
         
         return {"success": True, "topic": topic}
         
@@ -645,24 +635,12 @@ async def update_quiz_question_route(
     Update a quiz question
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        
         # Verify user has permission (course owner)
-        user_res = supabase_client.table("users").select("id").eq("email", user_email).execute()
-        if not user_res.data:
-            raise HTTPException(status_code=404, detail="User not found")
-        user_id = user_res.data[0]["id"]
-        
-        course_res = supabase_client.table("courses").select("created_by").eq("id", course_id).execute()
-        if not course_res.data or course_res.data[0]["created_by"] != user_id:
-            raise HTTPException(status_code=403, detail="Permission denied")
+        await require_course_owner(course_id, user_email)
         
         # Verify question exists and belongs to the topic/course
-        question_res = supabase_client.table("quiz_questions").select("topic_id").eq("id", question_id).execute()
-        if not question_res.data or question_res.data[0]["topic_id"] != topic_id:
+        question_row = await get_quiz_question(question_id)
+        if not question_row or question_row["topic_id"] != topic_id:
             raise HTTPException(status_code=404, detail="Quiz question not found or doesn't belong to this topic")
         
         # Build update object with only provided fields
@@ -679,9 +657,9 @@ async def update_quiz_question_route(
             raise HTTPException(status_code=400, detail="No fields to update")
         
         # Update question
-        update_res = supabase_client.table("quiz_questions").update(update_data).eq("id", question_id).execute()
+        updated_question = await update_quiz_question(question_id, update_data)
         
-        if not update_res.data:
+        if not updated_question:
             raise HTTPException(status_code=500, detail="Failed to update quiz question")
         
         return {"success": True, "message": "Quiz question updated successfully"}
@@ -709,24 +687,12 @@ async def create_quiz_question_route(
     Create a new quiz question
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        
         # Verify user has permission (course owner)
-        user_res = supabase_client.table("users").select("id").eq("email", user_email).execute()
-        if not user_res.data:
-            raise HTTPException(status_code=404, detail="User not found")
-        user_id = user_res.data[0]["id"]
-        
-        course_res = supabase_client.table("courses").select("created_by").eq("id", course_id).execute()
-        if not course_res.data or course_res.data[0]["created_by"] != user_id:
-            raise HTTPException(status_code=403, detail="Permission denied")
+        await require_course_owner(course_id, user_email)
         
         # Verify topic exists and belongs to the course
-        topic_res = supabase_client.table("quiz_topics").select("course_id").eq("id", topic_id).execute()
-        if not topic_res.data or topic_res.data[0]["course_id"] != course_id:
+        topic_row = await get_quiz_topic(topic_id)
+        if not topic_row or topic_row["course_id"] != course_id:
             raise HTTPException(status_code=404, detail="Quiz topic not found or doesn't belong to this course")
         
         # Validate correct answer
@@ -745,12 +711,12 @@ async def create_quiz_question_route(
             "explanation": explanation.strip(),
         }
         
-        create_res = supabase_client.table("quiz_questions").insert(question_data).execute()
+        created_questions = await insert_quiz_questions([question_data])
         
-        if not create_res.data:
+        if not created_questions:
             raise HTTPException(status_code=500, detail="Failed to create quiz question")
         
-        return {"success": True, "question": create_res.data[0], "message": "Quiz question created successfully"}
+        return {"success": True, "question": created_questions[0], "message": "Quiz question created successfully"}
         
     except HTTPException:
         raise
@@ -769,28 +735,16 @@ async def delete_quiz_question_route(
     Delete a quiz question
     """
     try:
-        supabase_client = create_client(
-            os.environ["SUPABASE_URL"],
-            os.environ["SUPABASE_SERVICE_KEY"]
-        )
-        
         # Verify user has permission (course owner)
-        user_res = supabase_client.table("users").select("id").eq("email", user_email).execute()
-        if not user_res.data:
-            raise HTTPException(status_code=404, detail="User not found")
-        user_id = user_res.data[0]["id"]
-        
-        course_res = supabase_client.table("courses").select("created_by").eq("id", course_id).execute()
-        if not course_res.data or course_res.data[0]["created_by"] != user_id:
-            raise HTTPException(status_code=403, detail="Permission denied")
+        await require_course_owner(course_id, user_email)
         
         # Verify question exists and belongs to the topic/course
-        question_res = supabase_client.table("quiz_questions").select("topic_id").eq("id", question_id).execute()
-        if not question_res.data or question_res.data[0]["topic_id"] != topic_id:
+        question_row = await get_quiz_question(question_id)
+        if not question_row or question_row["topic_id"] != topic_id:
             raise HTTPException(status_code=404, detail="Quiz question not found or doesn't belong to this topic")
         
         # Delete the question
-        delete_res = supabase_client.table("quiz_questions").delete().eq("id", question_id).execute()
+        await delete_quiz_question(question_id)
         
         return {"success": True, "message": "Quiz question deleted successfully"}
         
@@ -805,4 +759,4 @@ async def sync_quiz_counts_route():
     """
     Admin endpoint to sync quiz counts for all courses
     """
-    return sync_course_quiz_counts()
+    return await sync_course_quiz_counts()
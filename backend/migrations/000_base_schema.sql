@@ -0,0 +1,84 @@
+-- Base schema (the setup script in README.md, with the columns the backend
+-- actually reads and writes). Safe to re-run: every statement is idempotent.
+
+create extension if not exists vector;
+
+create table if not exists users (
+  id uuid default gen_random_uuid() primary key,
+  email text unique not null,
+  role text default 'student' check (role in ('student', 'professor', 'admin')),
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+create table if not exists courses (
+  id uuid default gen_random_uuid() primary key,
+  code text not null,
+  name text not null,
+  created_by uuid references users(id) on delete cascade,
+  files_count int default 0,
+  quizzes_count int default 0,
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+create table if not exists course_files (
+  id uuid default gen_random_uuid() primary key,
+  course_id uuid references courses(id) on delete cascade,
+  uploaded_by uuid references users(id) on delete set null,
+  filename text not null,
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+create table if not exists chat_sessions (
+  id uuid default gen_random_uuid() primary key,
+  user_id uuid references users(id) on delete cascade,
+  course_id uuid references courses(id) on delete cascade,
+  title text,
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+-- Used by the backend to order sessions by recent activity
+alter table chat_sessions add column if not exists updated_at timestamp with time zone;
+
+create table if not exists chat_messages (
+  id uuid default gen_random_uuid() primary key,
+  session_id uuid references chat_sessions(id) on delete cascade,
+  content text not null,
+  sender text check (sender in ('user', 'ai')),
+  thinking_time float,
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+create table if not exists ingested_documents (
+  id uuid default gen_random_uuid() primary key,
+  content text,
+  embedding vector(768), -- Gemini embedding dimension
+  course_id uuid references courses(id) on delete cascade,
+  course_file_id uuid references course_files(id) on delete cascade,
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+create table if not exists quiz_topics (
+  id uuid default gen_random_uuid() primary key,
+  course_id uuid references courses(id) on delete cascade,
+  topic_name text not null,
+  question_count int default 0,
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+create table if not exists quiz_questions (
+  id uuid default gen_random_uuid() primary key,
+  course_id uuid references courses(id) on delete cascade,
+  topic_id uuid references quiz_topics(id) on delete cascade,
+  created_by uuid references users(id) on delete set null,
+  question_text text not null,
+  option_a text,
+  option_b text,
+  option_c text,
+  option_d text,
+  correct_answer text not null,
+  explanation text,
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+create index if not exists chat_messages_session_created_idx
+  on chat_messages (session_id, created_at desc);
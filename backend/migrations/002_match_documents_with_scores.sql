@@ -0,0 +1,36 @@
+-- match_ingested_documents now returns similarity scores and embeddings so the
+-- backend can apply a relative score cutoff and MMR de-duplication before
+-- packing chunks into the prompt (see retrieval.py).
+
+drop function if exists match_ingested_documents(vector, int, jsonb);
+
+create or replace function match_ingested_documents(
+  query_embedding vector,
+  match_count int default 5,
+  filter jsonb default '{}'::jsonb
+) returns table (
+  id uuid,
+  content text,
+  course_id uuid,
+  course_file_id uuid,
+  similarity float,
+  embedding vector
+)
+language sql stable
+as $$
+  select
+    d.id,
+    d.content,
+    d.course_id,
+    d.course_file_id,
+    1 - (d.embedding <=> query_embedding) as similarity,
+    d.embedding
+  from ingested_documents d
+  where (filter->>'course_id' is null or d.course_id = (filter->>'course_id')::uuid)
+    and (
+      filter->>'course_code' is null
+      or d.course_id in (select c.id from courses c where c.code = filter->>'course_code')
+    )
+  order by d.embedding <=> query_embedding
+  limit match_count;
+$$;
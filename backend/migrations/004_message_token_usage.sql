@@ -0,0 +1,19 @@
+-- Token usage per AI message, including prompt tokens served from the
+-- provider's prefix cache, so the cache hit rate can be measured per course.
+
+alter table chat_messages add column if not exists prompt_tokens int;
+alter table chat_messages add column if not exists completion_tokens int;
+alter table chat_messages add column if not exists cached_tokens int;
+
+create or replace view prompt_cache_stats as
+select
+  s.course_id,
+  date_trunc('day', m.created_at) as day,
+  count(*) as ai_messages,
+  sum(m.prompt_tokens) as prompt_tokens,
+  sum(m.cached_tokens) as cached_tokens,
+  round(sum(m.cached_tokens)::numeric / nullif(sum(m.prompt_tokens), 0), 4) as cache_hit_rate
+from chat_messages m
+join chat_sessions s on s.id = m.session_id
+where m.sender = 'ai' and m.prompt_tokens is not null
+group by s.course_id, date_trunc('day', m.created_at);
@@ -0,0 +1,48 @@
+-- Persist each chunk's position within its source file so retrieval can expand
+-- a hit to its neighbouring chunks (see retrieval.expand_neighbors).
+
+alter table ingested_documents add column if not exists chunk_index int;
+alter table ingested_documents add column if not exists total_chunks int;
+alter table ingested_documents add column if not exists metadata jsonb default '{}'::jsonb;
+
+-- Neighbour lookups are range scans on (course_file_id, chunk_index)
+create index if not exists ingested_documents_file_chunk_idx
+  on ingested_documents (course_file_id, chunk_index);
+
+-- match_ingested_documents additionally returns the chunk position
+drop function if exists match_ingested_documents(vector, int, jsonb);
+
+create or replace function match_ingested_documents(
+  query_embedding vector,
+  match_count int default 5,
+  filter jsonb default '{}'::jsonb
+) returns table (
+  id uuid,
+  content text,
+  course_id uuid,
+  course_file_id uuid,
+  chunk_index int,
+  total_chunks int,
+  similarity float,
+  embedding vector
+)
+language sql stable
+as $$
+  select
+    d.id,
+    d.content,
+    d.course_id,
+    d.course_file_id,
+    d.chunk_index,
+    d.total_chunks,
+    1 - (d.embedding <=> query_embedding) as similarity,
+    d.embedding
+  from ingested_documents d
+  where (filter->>'course_id' is null or d.course_id = (filter->>'course_id')::uuid)
+    and (
+      filter->>'course_code' is null
+      or d.course_id in (select c.id from courses c where c.code = filter->>'course_code')
+    )
+  order by d.embedding <=> query_embedding
+  limit match_count;
+$$;
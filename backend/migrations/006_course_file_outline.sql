@@ -0,0 +1,5 @@
+-- Section outline of each ingested file (headings from the Docling markdown and
+-- the chunk range each one covers), used by the documentation page tools.
+-- Shape: [{"title": text, "level": int, "first_chunk": int, "last_chunk": int}]
+
+alter table course_files add column if not exists outline jsonb;
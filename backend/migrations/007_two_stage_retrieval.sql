@@ -0,0 +1,95 @@
+-- Two-stage retrieval: pick the most relevant files (and sections) by centroid
+-- embedding first, then search chunks only inside them. Centroids are the
+-- unit-normalised mean of the chunk embeddings, computed at ingestion.
+
+alter table course_files add column if not exists centroid vector(768);
+
+create table if not exists course_file_sections (
+  id uuid default gen_random_uuid() primary key,
+  course_id uuid references courses(id) on delete cascade,
+  course_file_id uuid references course_files(id) on delete cascade,
+  section_index int not null,
+  title text,
+  first_chunk int not null,
+  last_chunk int not null,
+  centroid vector(768)
+);
+
+create index if not exists course_file_sections_course_idx on course_file_sections (course_id);
+create index if not exists course_file_sections_file_idx on course_file_sections (course_file_id);
+
+create or replace function match_ingested_documents_two_stage(
+  query_embedding vector,
+  match_count int default 5,
+  filter jsonb default '{}'::jsonb,
+  file_count int default 3,
+  section_count int default 8
+) returns table (
+  id uuid,
+  content text,
+  course_id uuid,
+  course_file_id uuid,
+  chunk_index int,
+  total_chunks int,
+  similarity float,
+  embedding vector
+)
+language plpgsql stable
+as $$
+#variable_conflict use_column
+declare
+  v_course_id uuid;
+  v_files uuid[];
+begin
+  v_course_id := coalesce(
+    (filter->>'course_id')::uuid,
+    (select c.id from courses c where c.code = filter->>'course_code' limit 1)
+  );
+
+  -- Stage 1: top files by centroid, files holding the top sections, and any
+  -- file ingested before centroids existed (so nothing becomes unreachable)
+  if v_course_id is not null then
+    select array_agg(distinct picked.file_id) into v_files
+    from (
+      (select cf.id as file_id
+         from course_files cf
+        where cf.course_id = v_course_id and cf.centroid is not null
+        order by cf.centroid <=> query_embedding
+        limit file_count)
+      union
+      (select s.course_file_id
+         from course_file_sections s
+        where s.course_id = v_course_id and s.centroid is not null
+        order by s.centroid <=> query_embedding
+        limit section_count)
+      union
+      (select cf.id
+         from course_files cf
+        where cf.course_id = v_course_id and cf.centroid is null)
+    ) picked;
+  end if;
+
+  -- No course scope or no centroids yet: plain full scan
+  if v_files is null then
+    return query
+      select * from match_ingested_documents(query_embedding, match_count, filter);
+    return;
+  end if;
+
+  -- Stage 2: chunk search restricted to the selected files
+  return query
+    select
+      d.id,
+      d.content,
+      d.course_id,
+      d.course_file_id,
+      d.chunk_index,
+      d.total_chunks,
+      1 - (d.embedding <=> query_embedding) as similarity,
+      d.embedding
+    from ingested_documents d
+    where d.course_file_id = any(v_files)
+    order by d.embedding <=> query_embedding
+    limit match_count;
+end;
+$$;
@@ -0,0 +1,147 @@
+-- Vector index management and filtered ANN search.
+--
+-- * A global HNSW index serves unscoped searches and small courses.
+-- * Large courses get their own partial HNSW index (create_course_vector_index),
+--   so a course-scoped search walks a graph containing only that course's chunks:
+--   the filter is applied before the ANN scan instead of after it, and latency
+--   no longer depends on how many other courses exist.
+-- * match_course_documents takes course_id as a plain parameter (no JSON filter)
+--   and builds the query with the id inlined, so the planner can match the
+--   partial index. ef_search is set per call.
+
+create index if not exists ingested_documents_course_idx
+  on ingested_documents (course_id);
+
+create index if not exists ingested_documents_embedding_hnsw_idx
+  on ingested_documents using hnsw (embedding vector_cosine_ops)
+  with (m = 16, ef_construction = 64);
+
+create index if not exists course_files_centroid_hnsw_idx
+  on course_files using hnsw (centroid vector_cosine_ops);
+
+create index if not exists course_file_sections_centroid_hnsw_idx
+  on course_file_sections using hnsw (centroid vector_cosine_ops);
+
+-- Name of a course's partial index (identifiers are limited to 63 characters)
+create or replace function course_vector_index_name(p_course_id uuid)
+returns text
+language sql immutable
+as $$
+  select 'ingested_documents_hnsw_' || replace(p_course_id::text, '-', '');
+$$;
+
+create or replace function create_course_vector_index(p_course_id uuid)
+returns text
+language plpgsql
+as $$
+declare
+  v_name text := course_vector_index_name(p_course_id);
+begin
+  execute format(
+    'create index if not exists %I on ingested_documents using hnsw (embedding vector_cosine_ops) '
+    'with (m = 16, ef_construction = 64) where course_id = %L',
+    v_name, p_course_id
+  );
+  return v_name;
+end;
+$$;
+
+create or replace function drop_course_vector_index(p_course_id uuid)
+returns void
+language plpgsql
+as $$
+begin
+  execute format('drop index if exists %I', course_vector_index_name(p_course_id));
+end;
+$$;
+
+-- Create partial indexes for every course with at least p_min_chunks chunks and
+-- drop the ones whose course no longer qualifies. Returns the indexed course ids.
+-- The course ids are collected first: CREATE/DROP INDEX fails while a scan of
+-- ingested_documents is still open in the same session.
+create or replace function sync_course_vector_indexes(p_min_chunks int default 2000)
+returns setof uuid
+language plpgsql
+as $$
+declare
+  v_indexed uuid[];
+  v_unindexed uuid[];
+  v_stale text[];
+  v_course_id uuid;
+  v_name text;
+begin
+  select
+    coalesce(array_agg(counts.course_id) filter (where counts.chunks >= p_min_chunks), '{}'),
+    coalesce(array_agg(counts.course_id) filter (where counts.chunks < p_min_chunks), '{}')
+  into v_indexed, v_unindexed
+  from (
+    select d.course_id, count(*) as chunks
+    from ingested_documents d
+    where d.course_id is not null
+    group by d.course_id
+  ) counts;
+
+  -- Indexes left behind by deleted courses
+  select coalesce(array_agg(i.indexname::text), '{}') into v_stale
+  from pg_indexes i
+  where i.tablename = 'ingested_documents'
+    and i.indexname like 'ingested_documents_hnsw_%'
+    and not exists (
+      select 1 from courses c
+      where course_vector_index_name(c.id) = i.indexname
+    );
+
+  foreach v_course_id in array v_indexed loop
+    perform create_course_vector_index(v_course_id);
+    return next v_course_id;
+  end loop;
+
+  foreach v_course_id in array v_unindexed loop
+    perform drop_course_vector_index(v_course_id);
+  end loop;
+
+  foreach v_name in array v_stale loop
+    execute format('drop index if exists %I', v_name);
+  end loop;
+end;
+$$;
+
+create or replace function match_course_documents(
+  query_embedding vector,
+  p_course_id uuid,
+  match_count int default 5,
+  ef_search int default 40
+) returns table (
+  id uuid,
+  content text,
+  course_id uuid,
+  course_file_id uuid,
+  chunk_index int,
+  total_chunks int,
+  similarity float,
+  embedding vector
+)
+language plpgsql
+as $$
+begin
+  -- Transaction-local: each PostgREST request runs in its own transaction
+  perform set_config('hnsw.ef_search', least(greatest(ef_search, match_count), 1000)::text, true);
+  -- Courses without a partial index use the global index; keep scanning until
+  -- enough rows survive the course filter (pgvector >= 0.8)
+  begin
+    perform set_config('hnsw.iterative_scan', 'relaxed_order', true);
+  exception when others then
+    null;
+  end;
+
+  return query execute format(
+    'select d.id, d.content, d.course_id, d.course_file_id, d.chunk_index, d.total_chunks, '
+    '       1 - (d.embedding <=> $1) as similarity, d.embedding '
+    'from ingested_documents d '
+    'where d.course_id = %L '
+    'order by d.embedding <=> $1 '
+    'limit $2',
+    p_course_id
+  ) using query_embedding::vector(768), match_count;
+end;
+$$;
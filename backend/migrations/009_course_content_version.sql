@@ -0,0 +1,5 @@
+-- Bumped whenever a course's files change. Identical first-turn chat questions are
+-- only coalesced onto one LLM run when they target the same content version.
+
+alter table courses add column if not exists content_updated_at timestamp with time zone
+  default timezone('utc'::text, now());
@@ -0,0 +1,28 @@
+-- One row per agent run with how it ended, so abandoned (client disconnected)
+-- runs can be told apart from completed and failed ones.
+
+create table if not exists chat_runs (
+  id uuid default gen_random_uuid() primary key,
+  session_id uuid references chat_sessions(id) on delete cascade,
+  user_message_id uuid references chat_messages(id) on delete set null,
+  ai_message_id uuid references chat_messages(id) on delete set null,
+  course_id uuid references courses(id) on delete cascade,
+  outcome text not null check (outcome in ('completed', 'cancelled', 'failed')),
+  streamed boolean default false,
+  coalesced boolean default false,
+  duration_ms int,
+  error text,
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+
+create index if not exists chat_runs_outcome_created_idx on chat_runs (outcome, created_at desc);
+
+create or replace view chat_run_outcomes as
+select
+  course_id,
+  date_trunc('hour', created_at) as hour,
+  outcome,
+  count(*) as runs,
+  percentile_cont(0.95) within group (order by duration_ms) as p95_duration_ms
+from chat_runs
+group by course_id, date_trunc('hour', created_at), outcome;
@@ -0,0 +1,99 @@
+-- Per-session history cache support. The backend keeps the last few messages of
+-- each session in memory; it passes the id of the newest message it knows about and
+-- chat_begin_turn only scans and returns history when that is no longer the
+-- session's latest message (e.g. the other worker handled the previous turn).
+
+drop function if exists chat_begin_turn(uuid, uuid, uuid, text, text, int);
+
+create or replace function chat_begin_turn(
+  p_user_id uuid,
+  p_course_id uuid,
+  p_session_id uuid,
+  p_content text,
+  p_title_prefix text,
+  p_history_limit int default 10,
+  p_known_last_message_id uuid default null
+) returns jsonb
+language plpgsql
+as $$
+declare
+  v_session_id uuid := p_session_id;
+  v_session_user uuid;
+  v_session_course uuid;
+  v_summary text;
+  v_seq int;
+  v_now timestamptz := timezone('utc'::text, now());
+  v_history jsonb;
+  v_last_message_id uuid;
+  v_message_id uuid;
+begin
+  if v_session_id is not null then
+    select user_id, course_id, summary into v_session_user, v_session_course, v_summary
+    from chat_sessions
+    where id = v_session_id
+    for update;
+
+    if not found then
+      raise exception 'Session not found' using errcode = 'P0002';
+    end if;
+    if v_session_user is distinct from p_user_id or v_session_course is distinct from p_course_id then
+      raise exception 'Invalid session for this user/course' using errcode = '22023';
+    end if;
+
+    update chat_sessions set updated_at = v_now where id = v_session_id;
+  else
+    select count(*) + 1 into v_seq
+    from chat_sessions
+    where user_id = p_user_id and course_id = p_course_id;
+
+    insert into chat_sessions (user_id, course_id, title, updated_at)
+    values (
+      p_user_id,
+      p_course_id,
+      coalesce(nullif(p_title_prefix, ''), 'Chat') || ' - Chat ' || v_seq,
+      v_now
+    )
+    returning id into v_session_id;
+  end if;
+
+  -- The caller's cached history is current when it ends with the session's latest
+  -- message; only then is the history scan skipped
+  if p_known_last_message_id is not null then
+    select id into v_last_message_id
+    from chat_messages
+    where session_id = v_session_id
+    order by created_at desc
+    limit 1;
+  end if;
+
+  if p_known_last_message_id is null or v_last_message_id is distinct from p_known_last_message_id then
+    select coalesce(
+             jsonb_agg(
+               jsonb_build_object('id', h.id, 'content', h.content, 'sender', h.sender, 'created_at', h.created_at)
+               order by h.created_at
+             ),
+             '[]'::jsonb
+           )
+    into v_history
+    from (
+      select id, content, sender, created_at
+      from chat_messages
+      where session_id = v_session_id
+      order by created_at desc
+      limit greatest(p_history_limit, 0)
+    ) h;
+  end if;
+
+  insert into chat_messages (session_id, content, sender)
+  values (v_session_id, p_content, 'user')
+  returning id into v_message_id;
+
+  return jsonb_build_object(
+    'session_id', v_session_id,
+    'user_message_id', v_message_id,
+    'history', v_history,
+    'history_current', v_history is null,
+    'summary', v_summary
+  );
+end;
+$$;
@@ -0,0 +1,13 @@
+-- Keyset pagination for the chat sidebar and chat history.
+-- Sessions page on (last_activity_at, id), messages on (created_at, id); both
+-- are backed by indexes matching the sort order, so every page is an index range
+-- scan no matter how much history exists.
+
+alter table chat_sessions add column if not exists last_activity_at timestamp with time zone
+  generated always as (coalesce(updated_at, created_at)) stored;
+
+create index if not exists chat_sessions_user_activity_idx
+  on chat_sessions (user_id, last_activity_at desc, id desc);
+
+create index if not exists chat_messages_session_created_id_idx
+  on chat_messages (session_id, created_at desc, id desc);
@@ -0,0 +1,32 @@
+-- Batched store for deferred chat writes (backend/write_behind.py). The backend
+-- journals AI replies and session activity locally, answers the request, and then
+-- flushes them here in one transaction per batch.
+--   * p_messages: chat_messages rows with id and created_at assigned by the backend;
+--     rows already stored are skipped, so replaying a journal is safe, and rows for
+--     sessions deleted in the meantime are dropped
+--   * p_touches: [{"session_id", "updated_at"}]; updated_at only moves forward
+
+create or replace function chat_flush_writes(
+  p_messages jsonb default '[]'::jsonb,
+  p_touches jsonb default '[]'::jsonb
+) returns void
+language plpgsql
+as $$
+begin
+  insert into chat_messages
+  select m.*
+  from jsonb_populate_recordset(null::chat_messages, coalesce(p_messages, '[]'::jsonb)) m
+  where exists (select 1 from chat_sessions s where s.id = m.session_id)
+  order by m.created_at
+  on conflict (id) do nothing;
+
+  update chat_sessions s
+  set updated_at = greatest(coalesce(s.updated_at, t.updated_at), t.updated_at)
+  from (
+    select session_id, max(updated_at) as updated_at
+    from jsonb_to_recordset(coalesce(p_touches, '[]'::jsonb)) as x(session_id uuid, updated_at timestamptz)
+    group by session_id
+  ) t
+  where s.id = t.session_id;
+end;
+$$;
@@ -0,0 +1,47 @@
+-- Millisecond latency breakdown per AI message (backend/timings.py):
+--   lookups_ms, begin_turn_ms, agent_ms, first_token_ms (streaming), total_ms
+--   stages:       {"embedding": [ms, ...], "vector_search": [...], "chunk_fetch": [...]}
+--   llm_requests: [{"ms", "input_tokens", "output_tokens", "cached_tokens"}, ...]
+--   tool_calls:   [{"tool", "ms", "stages": {...}}, ...]
+-- Token totals stay in prompt_tokens / completion_tokens / cached_tokens (004).
+
+alter table chat_messages add column if not exists latency jsonb;
+
+-- Daily per-course latency percentiles and token spend, to spot which stage regressed
+-- and which courses cost the most
+create or replace view chat_latency_stats as
+with messages as (
+  select
+    s.course_id,
+    date_trunc('day', m.created_at) as day,
+    (m.latency ->> 'total_ms')::int as total_ms,
+    (m.latency ->> 'lookups_ms')::int + (m.latency ->> 'begin_turn_ms')::int as pre_work_ms,
+    (m.latency ->> 'agent_ms')::int as agent_ms,
+    (select coalesce(sum((r ->> 'ms')::int), 0) from jsonb_array_elements(m.latency -> 'llm_requests') r) as llm_ms,
+    (select count(*) from jsonb_array_elements(m.latency -> 'llm_requests')) as llm_requests,
+    (select coalesce(sum(v::int), 0) from jsonb_array_elements_text(m.latency -> 'stages' -> 'embedding') v) as embedding_ms,
+    (select coalesce(sum(v::int), 0) from jsonb_array_elements_text(m.latency -> 'stages' -> 'vector_search') v) as vector_search_ms,
+    m.prompt_tokens,
+    m.completion_tokens,
+    m.cached_tokens
+  from chat_messages m
+  join chat_sessions s on s.id = m.session_id
+  where m.sender = 'ai' and m.latency is not null
+)
+select
+  course_id,
+  day,
+  count(*) as ai_messages,
+  percentile_cont(0.5) within group (order by total_ms) as p50_total_ms,
+  percentile_cont(0.95) within group (order by total_ms) as p95_total_ms,
+  percentile_cont(0.95) within group (order by pre_work_ms) as p95_pre_work_ms,
+  percentile_cont(0.95) within group (order by agent_ms) as p95_agent_ms,
+  percentile_cont(0.95) within group (order by llm_ms) as p95_llm_ms,
+  percentile_cont(0.95) within group (order by embedding_ms) as p95_embedding_ms,
+  percentile_cont(0.95) within group (order by vector_search_ms) as p95_vector_search_ms,
+  avg(llm_requests) as avg_llm_requests,
+  sum(prompt_tokens) as prompt_tokens,
+  sum(completion_tokens) as completion_tokens,
+  sum(cached_tokens) as cached_tokens
+from messages
+group by course_id, day;
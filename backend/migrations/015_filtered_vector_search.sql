@@ -0,0 +1,145 @@
+-- Apply the course and file filters of the JSON-filter searches before the ANN
+-- scan, not after it.
+--
+-- With the global HNSW index from 008, "where course_id = ..." and
+-- "where course_file_id = any(...)" were checked against the ef_search (40)
+-- nearest chunks of the whole table only, so a course-scoped search in a
+-- database with many courses returned few rows or none.
+--
+-- * match_ingested_documents resolves the course first and delegates to
+--   match_course_documents (partial per-course index, or the global index with
+--   iterative scan). Unscoped searches use the global index with ef_search
+--   raised to match_count.
+-- * match_ingested_documents_two_stage scans the selected files exactly: they
+--   hold a few hundred chunks, read through ingested_documents_file_chunk_idx.
+
+create or replace function match_ingested_documents(
+  query_embedding vector,
+  match_count int default 5,
+  filter jsonb default '{}'::jsonb
+) returns table (
+  id uuid,
+  content text,
+  course_id uuid,
+  course_file_id uuid,
+  chunk_index int,
+  total_chunks int,
+  similarity float,
+  embedding vector
+)
+language plpgsql
+as $$
+#variable_conflict use_column
+declare
+  v_course_id uuid;
+begin
+  if filter->>'course_id' is not null or filter->>'course_code' is not null then
+    v_course_id := coalesce(
+      (filter->>'course_id')::uuid,
+      (select c.id from courses c where c.code = filter->>'course_code' limit 1)
+    );
+    -- Unknown course code: nothing matches
+    if v_course_id is not null then
+      return query
+        select * from match_course_documents(query_embedding, v_course_id, match_count);
+    end if;
+    return;
+  end if;
+
+  perform set_config('hnsw.ef_search', least(greatest(40, match_count), 1000)::text, true);
+  return query
+    select
+      d.id,
+      d.content,
+      d.course_id,
+      d.course_file_id,
+      d.chunk_index,
+      d.total_chunks,
+      1 - (d.embedding <=> query_embedding) as similarity,
+      d.embedding
+    from ingested_documents d
+    order by d.embedding <=> query_embedding
+    limit match_count;
+end;
+$$;
+
+create or replace function match_ingested_documents_two_stage(
+  query_embedding vector,
+  match_count int default 5,
+  filter jsonb default '{}'::jsonb,
+  file_count int default 3,
+  section_count int default 8
+) returns table (
+  id uuid,
+  content text,
+  course_id uuid,
+  course_file_id uuid,
+  chunk_index int,
+  total_chunks int,
+  similarity float,
+  embedding vector
+)
+language plpgsql
+as $$
+#variable_conflict use_column
+declare
+  v_course_id uuid;
+  v_files uuid[];
+begin
+  v_course_id := coalesce(
+    (filter->>'course_id')::uuid,
+    (select c.id from courses c where c.code = filter->>'course_code' limit 1)
+  );
+
+  -- Stage 1: top files by centroid, files holding the top sections, and any
+  -- file ingested before centroids existed (so nothing becomes unreachable)
+  if v_course_id is not null then
+    select array_agg(distinct picked.file_id) into v_files
+    from (
+      (select cf.id as file_id
+         from course_files cf
+        where cf.course_id = v_course_id and cf.centroid is not null
+        order by cf.centroid <=> query_embedding
+        limit file_count)
+      union
+      (select s.course_file_id
+         from course_file_sections s
+        where s.course_id = v_course_id and s.centroid is not null
+        order by s.centroid <=> query_embedding
+        limit section_count)
+      union
+      (select cf.id
+         from course_files cf
+        where cf.course_id = v_course_id and cf.centroid is null)
+    ) picked;
+  end if;
+
+  -- No course scope or no centroids yet: single-stage search
+  if v_files is null then
+    return query
+      select * from match_ingested_documents(query_embedding, match_count, filter);
+    return;
+  end if;
+
+  -- Stage 2: exact search over the selected files' chunks. The materialised CTE
+  -- keeps the planner from ordering by the global HNSW index and filtering after
+  return query
+    with candidates as materialized (
+      select d.id, d.content, d.course_id, d.course_file_id, d.chunk_index, d.total_chunks, d.embedding
+      from ingested_documents d
+      where d.course_file_id = any(v_files)
+    )
+    select
+      c.id,
+      c.content,
+      c.course_id,
+      c.course_file_id,
+      c.chunk_index,
+      c.total_chunks,
+      1 - (c.embedding <=> query_embedding) as similarity,
+      c.embedding
+    from candidates c
+    order by c.embedding <=> query_embedding
+    limit match_count;
+end;
+$$;
@@ -0,0 +1,39 @@
+-- Deferred chat writes take their timestamps from the database at flush time.
+--
+-- Messages are paged on (created_at, id) and every other chat row is stamped with
+-- the database clock; a created_at from the worker's own clock could order a
+-- reply before the question it answers, or past a page boundary, when the clocks
+-- disagree. Messages in a batch get increasing timestamps in journal order, and
+-- touched sessions move updated_at to the flush time (forward only). A
+-- created_at or updated_at sent by older workers or journals is ignored.
+
+create or replace function chat_flush_writes(
+  p_messages jsonb default '[]'::jsonb,
+  p_touches jsonb default '[]'::jsonb
+) returns void
+language plpgsql
+as $$
+declare
+  v_now timestamptz := clock_timestamp();
+begin
+  insert into chat_messages
+  select (m.msg).*
+  from (
+    select jsonb_populate_record(
+      null::chat_messages,
+      e.value || jsonb_build_object('created_at', v_now + e.n * interval '1 microsecond')
+    ) as msg
+    from jsonb_array_elements(coalesce(p_messages, '[]'::jsonb)) with ordinality as e(value, n)
+  ) m
+  where exists (select 1 from chat_sessions s where s.id = (m.msg).session_id)
+  order by (m.msg).created_at
+  on conflict (id) do nothing;
+
+  update chat_sessions s
+  set updated_at = greatest(coalesce(s.updated_at, v_now), v_now)
+  where s.id in (
+    select (t.value->>'session_id')::uuid
+    from jsonb_array_elements(coalesce(p_touches, '[]'::jsonb)) as t(value)
+  );
+end;
+$$;
@@ -2,26 +2,57 @@ import os
 import uuid
 import random
 import asyncio
-from typing import List, Dict, Optional
+from typing import Any, Awaitable, Callable, List, Dict, Optional
 from datetime import datetime
-from supabase import create_client, Client
 from pydantic import BaseModel, Field
 from fastapi import HTTPException
-from openai import AsyncOpenAI
 import json
 
-# Initialize Supabase (lazy initialization)
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
+from database import (
+    adjust_quizzes_count,
+    get_user_id_by_email,
+    insert_quiz_questions,
+    insert_quiz_topic,
+    list_questions_for_topics,
+    list_quiz_topics,
+)
 
-def get_supabase_client():
-    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
-        raise HTTPException(status_code=500, detail="Supabase configuration missing")
-    return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+# Shared OpenAI client (pooled per event loop) and model concurrency limits
+from llm_client import QUIZ_TIMEOUT, get_openai_client
+from admission import acquire_model_slot
 
-# Initialize OpenAI client (lazy initialization)
-def get_openai_client():
-    return AsyncOpenAI()
+# Large files are split into chunks; chunk questions (and the topic title) are generated
+# concurrently, at most this many calls at a time per quiz
+QUIZ_CHUNK_CONCURRENCY = int(os.environ.get("QUIZ_CHUNK_CONCURRENCY", "4"))
+# Extra attempts per chunk/title call, with exponential backoff starting at QUIZ_RETRY_BACKOFF seconds
+QUIZ_CHUNK_RETRIES = int(os.environ.get("QUIZ_CHUNK_RETRIES", "2"))
+QUIZ_RETRY_BACKOFF = float(os.environ.get("QUIZ_RETRY_BACKOFF", "1"))
+
+
+async def _create_completion(openai_client, **kwargs):
+    # Quiz generation is background work: it queues for a model slot rather than being shed
+    async with await acquire_model_slot(kwargs["model"], timeout=QUIZ_TIMEOUT, shed=False):
+        return await openai_client.chat.completions.create(timeout=QUIZ_TIMEOUT, **kwargs)
+
+
+async def _with_retries(
+    label: str, call: Callable[[], Awaitable[Any]], semaphore: Optional[asyncio.Semaphore] = None
+) -> Any:
+    """
+    Run call() (holding the semaphore only while it runs) and retry failures with
+    exponential backoff. Raises the last error once the retries are used up.
+    """
+    for attempt in range(QUIZ_CHUNK_RETRIES + 1):
+        try:
+            if semaphore is None:
+                return await call()
+            async with semaphore:
+                return await call()
+        except Exception as e:
+            if attempt == QUIZ_CHUNK_RETRIES:
+                raise
+            print(f"Warning: {label} failed ({e}), retrying ({attempt + 1}/{QUIZ_CHUNK_RETRIES})")
+            await asyncio.sleep(QUIZ_RETRY_BACKOFF * 2 ** attempt)
 
 class QuizQuestion(BaseModel):
     question_text: str = Field(..., description="The question text")
@@ -170,7 +201,8 @@ Generate 20 simple questions and 20 scenario-based questions. Return as JSON wit
         
         for attempt in range(max_retries):
             try:
-                response = await openai_client.chat.completions.create(
+                response = await _create_completion(
+                    openai_client,
                     model="gpt-4.1",
                     messages=[
                         {"role": "system", "content": system_prompt},
@@ -323,7 +355,8 @@ Generate {additional_needed} additional questions covering different aspects of
 """
 
     try:
-        response = await openai_client.chat.completions.create(
+        response = await _create_completion(
+            openai_client,
             model="gpt-4.1",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -408,40 +441,58 @@ async def _generate_quiz_multiple_chunks(filename: str, content_chunks: List[str
     Generate quiz for multiple content chunks
     """
     openai_client = get_openai_client()
-    
-    # First, generate topic title from the first chunk
-    topic_response = await openai_client.chat.completions.create(
-        model="gpt-4.1",
-        messages=[
-            {
-                "role": "system", 
-                "content": "Generate a topic title based on the filename and content. Return only the title."
-            },
-            {
-                "role": "user", 
-                "content": f"Filename: {filename}\n\nContent preview:\n{content_chunks[0][:2000]}..."
-            }
-        ],
-        temperature=0.7,
-        max_tokens=100
-    )
-    
-    topic_title = topic_response.choices[0].message.content.strip()
-    
+    semaphore = asyncio.Semaphore(max(1, QUIZ_CHUNK_CONCURRENCY))
+
+    # Topic title from the first chunk
+    async def _topic_title() -> str:
+        topic_response = await _create_completion(
+            openai_client,
+            model="gpt-4.1",
+            messages=[
+                {
+                    "role": "system", 
+                    "content": "Generate a topic title based on the filename and content. Return only the title."
+                },
+                {
+                    "role": "user", 
+                    "content": f"Filename: {filename}\n\nContent preview:\n{content_chunks[0][:2000]}..."
+                }
+            ],
+            temperature=0.7,
+            max_tokens=100
+        )
+        return topic_response.choices[0].message.content.strip()
+
     # Generate questions from chunks (distribute 40 questions across chunks)
     questions_per_chunk = max(1, 40 // len(content_chunks))
     remaining_questions = 40 - (questions_per_chunk * (len(content_chunks) - 1))
     
-    all_questions = []
-    
+    chunk_requests = []
     for i, chunk in enumerate(content_chunks):
         chunk_questions = remaining_questions if i == len(content_chunks) - 1 else questions_per_chunk
         simple_questions = chunk_questions // 2
         scenario_questions = chunk_questions - simple_questions
-        
-        chunk_quiz = await _generate_chunk_questions(
-            chunk, simple_questions, scenario_questions
+        chunk_requests.append(
+            _generate_chunk_questions(chunk, simple_questions, scenario_questions, semaphore)
         )
+
+    # Title and every chunk run concurrently; gather keeps chunk order, so the merged
+    # question list is the same as generating the chunks one after another
+    title_result, *chunk_results = await asyncio.gather(
+        _with_retries("Topic title generation", _topic_title, semaphore),
+        *chunk_requests,
+        return_exceptions=True,
+    )
+    if isinstance(title_result, BaseException):
+        print(f"Warning: Could not generate topic title, using the filename: {title_result}")
+        title_result = os.path.splitext(filename)[0]
+    topic_title = title_result
+
+    all_questions = []
+    for chunk_quiz in chunk_results:
+        if isinstance(chunk_quiz, BaseException):
+            print(f"Error generating chunk questions: {chunk_quiz}")
+            continue
         all_questions.extend(chunk_quiz)
     
     # Ensure we have exactly the target number of questions (20-40)
@@ -475,10 +526,25 @@ async def _generate_quiz_multiple_chunks(filename: str, content_chunks: List[str
     
     return quiz_response
 
-async def _generate_chunk_questions(content: str, simple_count: int, scenario_count: int) -> List[QuizQuestion]:
+async def _generate_chunk_questions(
+    content: str, simple_count: int, scenario_count: int, semaphore: Optional[asyncio.Semaphore] = None
+) -> List[QuizQuestion]:
     """
-    Generate specific number of questions from a content chunk
+    Generate specific number of questions from a content chunk, retrying failed or
+    empty responses. Returns an empty list once the retries are used up.
     """
+    try:
+        return await _with_retries(
+            "Chunk question generation",
+            lambda: _request_chunk_questions(content, simple_count, scenario_count),
+            semaphore,
+        )
+    except Exception as e:
+        print(f"Error generating chunk questions: {e}")
+        return []
+
+
+async def _request_chunk_questions(content: str, simple_count: int, scenario_count: int) -> List[QuizQuestion]:
     openai_client = get_openai_client()
     
     system_prompt = f"""Generate exactly {simple_count + scenario_count} multiple choice questions from the given content.
@@ -502,45 +568,43 @@ Requirements:
 - Each question must have exactly 3 wrong_answers and 1 correct_answer
 - Return ONLY the JSON object"""
 
-    try:
-        response = await openai_client.chat.completions.create(
-            model="gpt-4.1",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": content}
-            ],
-            response_format={"type": "json_object"},
-            temperature=1,
-            max_tokens=8000
-        )
-        
-        response_content = response.choices[0].message.content
-        questions_data = json.loads(response_content)
-        
-        questions = []
-        questions_list = questions_data.get("questions", [])
-        
-        # Ensure we assign correct difficulties
-        simple_assigned = 0
-        scenario_assigned = 0
-        
-        for i, q_data in enumerate(questions_list):
-            if simple_assigned < simple_count:
-                q_data["difficulty"] = "simple"
-                simple_assigned += 1
-            elif scenario_assigned < scenario_count:
-                q_data["difficulty"] = "scenario"
-                scenario_assigned += 1
-            else:
-                break
-                
-            questions.append(QuizQuestion(**q_data))
-        
-        return questions
+    response = await _create_completion(
+        openai_client,
+        model="gpt-4.1",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": content}
+        ],
+        response_format={"type": "json_object"},
+        temperature=1,
+        max_tokens=8000
+    )
     
-    except Exception as e:
-        print(f"Error generating chunk questions: {e}")
-        return []
+    response_content = response.choices[0].message.content
+    questions_data = json.loads(response_content)
+    
+    questions = []
+    questions_list = questions_data.get("questions", [])
+    
+    # Ensure we assign correct difficulties
+    simple_assigned = 0
+    scenario_assigned = 0
+    
+    for i, q_data in enumerate(questions_list):
+        if simple_assigned < simple_count:
+            q_data["difficulty"] = "simple"
+            simple_assigned += 1
+        elif scenario_assigned < scenario_count:
+            q_data["difficulty"] = "scenario"
+            scenario_assigned += 1
+        else:
+            break
+            
+        questions.append(QuizQuestion(**q_data))
+    
+    if not questions:
+        raise ValueError("No valid questions in the response")
+    return questions
 
 async def save_quiz_to_database(
     course_id: str,
@@ -552,36 +616,26 @@ async def save_quiz_to_database(
     Save generated quiz to database (quiz_topics and quiz_questions tables)
     """
     try:
-        supabase = get_supabase_client()
-        
         # Get user ID from email
-        user_result = supabase.table("users").select("id").eq("email", user_email).execute()
-        if not user_result.data:
+        user_id = await get_user_id_by_email(user_email)
+        if not user_id:
             raise HTTPException(status_code=404, detail="User not found")
-        user_id = user_result.data[0]["id"]
         
         # Insert quiz topic
         topic_data = {
             "course_id": course_id,
             "topic_name": quiz_data.topic_title
         }
-        topic_result = supabase.table("quiz_topics").insert(topic_data).execute()
+        topic_row = await insert_quiz_topic(topic_data)
         
-        if not topic_result.data:
+        if not topic_row:
             raise HTTPException(status_code=500, detail="Failed to create quiz topic")
         
-        topic_id = topic_result.data[0]["id"]
+        topic_id = topic_row["id"]
         
         # Update quiz count in courses table
         try:
-            # Get current quiz count
-            course_result = supabase.table("courses").select("quizzes_count").eq("id", course_id).execute()
-            if course_result.data:
-                current_count = course_result.data[0].get("quizzes_count", 0) or 0
-                new_count = current_count + 1
-                
-                # Update the count
-                supabase.table("courses").update({"quizzes_count": new_count}).eq("id", course_id).execute()
+            await adjust_quizzes_count(course_id, 1)
         except Exception as e:
             print(f"Warning: Failed to update quiz count: {e}")
             # Don't fail the entire operation if count update fails
@@ -606,17 +660,17 @@ async def save_quiz_to_database(
             questions_data.append(question_data)
         
         # Batch insert questions
-        questions_result = supabase.table("quiz_questions").insert(questions_data).execute()
+        created_questions = await insert_quiz_questions(questions_data)
         
-        if not questions_result.data:
+        if not created_questions:
             raise HTTPException(status_code=500, detail="Failed to create quiz questions")
         
         return {
             "success": True,
             "topic_id": topic_id,
             "topic_title": quiz_data.topic_title,
-            "questions_created": len(questions_result.data),
-            "message": f"Successfully created quiz topic '{quiz_data.topic_title}' with {len(questions_result.data)} questions"
+            "questions_created": len(created_questions),
+            "message": f"Successfully created quiz topic '{quiz_data.topic_title}' with {len(created_questions)} questions"
         }
         
     except HTTPException:
@@ -665,20 +719,21 @@ async def get_course_quizzes(course_id: str) -> Dict:
     Retrieve all quiz topics and questions for a course
     """
     try:
-        supabase = get_supabase_client()
-        
         # Get quiz topics
-        topics_result = supabase.table("quiz_topics").select("*").eq("course_id", course_id).execute()
+        topics = await list_quiz_topics(course_id)
+        
+        # Get questions for all topics in one round trip, then group them per topic
+        questions_by_topic: Dict[str, List[Dict]] = {topic["id"]: [] for topic in topics}
+        for question in await list_questions_for_topics(list(questions_by_topic)):
+            questions_by_topic.setdefault(question["topic_id"], []).append(question)
         
         topics_with_questions = []
-        for topic in topics_result.data:
-            # Get questions for this topic
-            questions_result = supabase.table("quiz_questions").select("*").eq("topic_id", topic["id"]).execute()
-            
+        for topic in topics:
+            topic_questions = questions_by_topic[topic["id"]]
             topic_data = {
                 **topic,
-                "questions": questions_result.data,
-                "question_count": len(questions_result.data)
+                "questions": topic_questions,
+                "question_count": len(topic_questions)
             }
             topics_with_questions.append(topic_data)
         
@@ -0,0 +1,188 @@
+"""
+Deadlines, hedged calls and circuit breakers for external calls on the chat path.
+
+- A request deadline is set once (chat_send / chat_stream) and carried in a
+  context variable, so every embedding, search and LLM call below it can bound
+  its own timeout by the time left.
+- Hedged calls send a duplicate request when the first one is slower than the
+  operation's recent p95, and use whichever answers first.
+- Each operation has a circuit breaker: after repeated failures calls fail fast
+  for a cool-down period instead of hanging, and callers degrade.
+"""
+import os
+import time
+import asyncio
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, Optional
+
+from timings import record_stage
+
+# Overall budget for one chat turn (seconds)
+CHAT_DEADLINE = float(os.environ.get("CHAT_DEADLINE", "90"))
+# Hedge after the operation's p95, but never sooner than this (seconds)
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "0.15"))
+# Samples kept per operation for the p95 estimate, and how many are needed before hedging
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+# Circuit breaker: consecutive failures to open, and how long it stays open (seconds)
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", "30"))
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceededError(asyncio.TimeoutError):
+    pass
+
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[None]:
+    """
+    Set the deadline for everything awaited inside the block (tasks created inside
+    inherit it). A tighter enclosing deadline wins.
+    """
+    new_deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(min(current, new_deadline) if current is not None else new_deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left(default: Optional[float] = None) -> Optional[float]:
+    """
+    Seconds until the current deadline, capped at default. None when neither is set.
+    """
+    current = _deadline.get()
+    if current is None:
+        return default
+    left = max(0.0, current - time.monotonic())
+    return min(left, default) if default is not None else left
+
+
+class LatencyTracker:
+    def __init__(self):
+        self.samples: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        if len(self.samples) < LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        # Half-open: let a trial call through once the cool-down has passed
+        return time.monotonic() - self.opened_at >= BREAKER_RESET_TIMEOUT
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURE_THRESHOLD:
+            if self.opened_at is None:
+                print(f"Warning: Circuit for {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+
+_latencies: Dict[str, LatencyTracker] = {}
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+async def _timed(name: str, call: Callable[[], Awaitable[Any]]) -> Any:
+    started = time.monotonic()
+    result = await call()
+    _latencies.setdefault(name, LatencyTracker()).record(time.monotonic() - started)
+    return result
+
+
+async def _hedged(name: str, call: Callable[[], Awaitable[Any]]) -> Any:
+    p95 = _latencies.setdefault(name, LatencyTracker()).p95()
+    first = asyncio.ensure_future(_timed(name, call))
+    if p95 is None:
+        return await first
+
+    pending = {first}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=max(HEDGE_MIN_DELAY, p95))
+        if not done:
+            # Slower than usual: race a duplicate request against the first
+            pending.add(asyncio.ensure_future(_timed(name, call)))
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def resilient_call(
+    name: str,
+    call: Callable[[], Awaitable[Any]],
+    *,
+    timeout: float,
+    hedge: bool = True,
+) -> Any:
+    """
+    Run call() under the operation's circuit breaker, bounded by min(timeout, time
+    left on the request deadline), hedged when hedge is set. call must be safe to
+    issue twice (reads only).
+    """
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"{name} is temporarily unavailable")
+
+    budget = time_left(timeout)
+    if budget is not None and budget <= 0:
+        raise DeadlineExceededError(f"No time left for {name}")
+
+    started = time.monotonic()
+    try:
+        result = await asyncio.wait_for(_hedged(name, call) if hedge else _timed(name, call), budget)
+    except asyncio.CancelledError:
+        raise
+    except asyncio.TimeoutError as e:
+        # Only the operation's own timeout counts against it, not a nearly spent request deadline
+        if budget is None or budget >= timeout:
+            breaker.record_failure()
+        raise DeadlineExceededError(f"{name} timed out after {budget:.1f}s") from e
+    except Exception:
+        breaker.record_failure()
+        raise
+    finally:
+        # Per-turn latency breakdown (no-op outside a chat turn)
+        record_stage(name, time.monotonic() - started)
+    breaker.record_success()
+    return result
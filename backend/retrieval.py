@@ -0,0 +1,634 @@
+# Import Basics
+import os
+import json
+import time
+import asyncio
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from cachetools import TTLCache
+
+# Import Gemini (Embedding)
+from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+# Import shared data-access layer (Vector Database)
+from resilience import resilient_call
+from database import (
+    get_chunk_ranges,
+    match_course_documents,
+    match_documents,
+    match_documents_two_stage,
+)
+
+# Context assembly tuning (all overridable via environment)
+# How many candidates to pull from the vector store before filtering
+RETRIEVAL_CANDIDATES = int(os.environ.get("RETRIEVAL_CANDIDATES", "20"))
+# Keep candidates scoring at least this fraction of the top hit's similarity
+RETRIEVAL_RELATIVE_CUTOFF = float(os.environ.get("RETRIEVAL_RELATIVE_CUTOFF", "0.85"))
+# MMR trade-off: 1.0 = pure relevance, 0.0 = pure diversity
+RETRIEVAL_MMR_LAMBDA = float(os.environ.get("RETRIEVAL_MMR_LAMBDA", "0.7"))
+# Upper bound on chunks and on (estimated) tokens returned to the model per tool call
+RETRIEVAL_MAX_CHUNKS = int(os.environ.get("RETRIEVAL_MAX_CHUNKS", "8"))
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get("RETRIEVAL_TOKEN_BUDGET", "1800"))
+# Two-stage retrieval: pick the top files/sections by centroid, then search chunks inside them
+RETRIEVAL_TWO_STAGE = os.environ.get("RETRIEVAL_TWO_STAGE", "true").lower() in ("1", "true", "yes")
+RETRIEVAL_FILE_CANDIDATES = int(os.environ.get("RETRIEVAL_FILE_CANDIDATES", "3"))
+RETRIEVAL_SECTION_CANDIDATES = int(os.environ.get("RETRIEVAL_SECTION_CANDIDATES", "8"))
+# Re-run as a full scan when the two-stage search returns fewer rows than this (0 = never)
+RETRIEVAL_FULL_SCAN_BELOW = int(os.environ.get("RETRIEVAL_FULL_SCAN_BELOW", "3"))
+# HNSW candidate list size for course-scoped searches (recall vs latency), overridable per query
+RETRIEVAL_EF_SEARCH = int(os.environ.get("RETRIEVAL_EF_SEARCH", "40"))
+# Sub-queries accepted by the batched retrieval tool in one call
+RETRIEVAL_MAX_SUB_QUERIES = int(os.environ.get("RETRIEVAL_MAX_SUB_QUERIES", "5"))
+# Speculatively retrieve for the raw user message while the agent's first model call runs
+RETRIEVAL_PREFETCH = os.environ.get("RETRIEVAL_PREFETCH", "true").lower() in ("1", "true", "yes")
+# Reuse the prefetched retrieval when the agent's query embeds this close to the user's message
+RETRIEVAL_PREFETCH_SIMILARITY = float(os.environ.get("RETRIEVAL_PREFETCH_SIMILARITY", "0.9"))
+# Chunks on each side of a hit pulled in as surrounding context (0 disables expansion)
+RETRIEVAL_NEIGHBOR_CHUNKS = int(os.environ.get("RETRIEVAL_NEIGHBOR_CHUNKS", "1"))
+# Token budget once hits have been expanded into passages
+RETRIEVAL_EXPANDED_TOKEN_BUDGET = int(os.environ.get("RETRIEVAL_EXPANDED_TOKEN_BUDGET", "3000"))
+# Per-call timeouts (also bounded by the request deadline); calls are hedged after their p95
+EMBEDDING_TIMEOUT = float(os.environ.get("RETRIEVAL_EMBEDDING_TIMEOUT", "5"))
+SEARCH_TIMEOUT = float(os.environ.get("RETRIEVAL_SEARCH_TIMEOUT", "5"))
+# Recent good contexts served (with a notice) when the embedding or search backend is down
+RETRIEVAL_STALE_CACHE_SIZE = int(os.environ.get("RETRIEVAL_STALE_CACHE_SIZE", "1024"))
+RETRIEVAL_STALE_CACHE_TTL = int(os.environ.get("RETRIEVAL_STALE_CACHE_TTL", "3600"))
+# Follow-ups re-rank the chunks retrieved earlier in the session and skip the vector
+# search when every query's best cached chunk is at least this similar
+RETRIEVAL_SESSION_REUSE = os.environ.get("RETRIEVAL_SESSION_REUSE", "true").lower() in ("1", "true", "yes")
+RETRIEVAL_SESSION_SIMILARITY = float(os.environ.get("RETRIEVAL_SESSION_SIMILARITY", "0.75"))
+# Candidates kept per session (most recent searches first), sessions kept per worker and for how long
+RETRIEVAL_SESSION_MAX_CHUNKS = int(os.environ.get("RETRIEVAL_SESSION_MAX_CHUNKS", "40"))
+RETRIEVAL_SESSION_CACHE_SIZE = int(os.environ.get("RETRIEVAL_SESSION_CACHE_SIZE", "500"))
+RETRIEVAL_SESSION_CACHE_TTL = int(os.environ.get("RETRIEVAL_SESSION_CACHE_TTL", "1800"))
+DEGRADED_NOTICE = (
+    "NOTICE: The course documentation search is temporarily unavailable. Answer from general "
+    "knowledge if you can, and tell the user that the answer could not be checked against the course material."
+)
+STALE_NOTICE = (
+    "NOTICE: The course documentation search is temporarily unavailable; the documentation below "
+    "was retrieved earlier for the same question."
+)
+# Longest text overlap between consecutive chunks (ingestion uses chunk_overlap=100), and the
+# shortest shared text trusted as overlap when a chunk has no stored offset
+CHUNK_OVERLAP_SEARCH = 200
+CHUNK_OVERLAP_MIN = 20
+
+CHUNK_SEPARATOR = "\n\n---\n\n"
+
+# (course scope, normalized queries) -> last good context
+_stale_contexts: TTLCache = TTLCache(maxsize=RETRIEVAL_STALE_CACHE_SIZE, ttl=RETRIEVAL_STALE_CACHE_TTL)
+# session_id -> (course scope, candidate rows with parsed embeddings, most recent first)
+_session_chunks: TTLCache = TTLCache(maxsize=RETRIEVAL_SESSION_CACHE_SIZE, ttl=RETRIEVAL_SESSION_CACHE_TTL)
+
+# Shared Gemini embedding client (created once per process)
+_embeddings: Optional[GoogleGenerativeAIEmbeddings] = None
+
+
+def _get_embeddings_client() -> GoogleGenerativeAIEmbeddings:
+    global _embeddings
+    if _embeddings is None:
+        _embeddings = GoogleGenerativeAIEmbeddings(model="models/gemini-embedding-001")
+    return _embeddings
+
+
+async def get_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    Embed several queries in one batched request (same task type as embed_query).
+    """
+    if len(texts) == 1:
+        call = lambda: asyncio.to_thread(_get_embeddings_client().embed_query, texts[0])
+        return [await resilient_call("embedding", call, timeout=EMBEDDING_TIMEOUT)]
+    call = lambda: asyncio.to_thread(
+        partial(_get_embeddings_client().embed_documents, texts, task_type="RETRIEVAL_QUERY")
+    )
+    return await resilient_call("embedding", call, timeout=EMBEDDING_TIMEOUT)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate (~4 characters per token for English prose).
+    """
+    return max(1, len(text) // 4)
+
+
+def _parse_embedding(value: Any) -> Optional[np.ndarray]:
+    # PostgREST serialises pgvector values as "[0.1,0.2,...]"
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def mmr_select(
+    relevance: np.ndarray,
+    doc_vectors: np.ndarray,
+    lambda_mult: float,
+    k: int,
+) -> List[int]:
+    """
+    Maximal Marginal Relevance over a (n, d) matrix of candidate embeddings.
+    Pairwise similarities are computed once as a matrix product; the greedy loop
+    only updates a running max-similarity vector. Returns indices in selection order.
+    """
+    n = doc_vectors.shape[0]
+    if n == 0 or k <= 0:
+        return []
+
+    docs = doc_vectors / np.clip(np.linalg.norm(doc_vectors, axis=1, keepdims=True), 1e-12, None)
+    pairwise = docs @ docs.T
+
+    selected: List[int] = []
+    max_redundancy = np.zeros(n, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    for _ in range(min(k, n)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_redundancy = np.maximum(max_redundancy, pairwise[best])
+    return selected
+
+
+def assemble_context(
+    result_sets: List[List[Dict[str, Any]]],
+    *,
+    relative_cutoff: float = RETRIEVAL_RELATIVE_CUTOFF,
+    lambda_mult: float = RETRIEVAL_MMR_LAMBDA,
+    max_chunks: int = RETRIEVAL_MAX_CHUNKS,
+    token_budget: int = RETRIEVAL_TOKEN_BUDGET,
+) -> List[Dict[str, Any]]:
+    """
+    Turn raw vector-store candidates (one result set per query) into a compact context:
+    1. per query, drop candidates scoring below relative_cutoff * that query's top
+       similarity (adaptive k) and score the rest relative to it
+    2. merge the queries, de-duplicating chunks and keeping their best score
+    3. order the survivors with MMR to push near-duplicate chunks to the back
+    4. greedily pack chunks into the token budget
+    """
+    merged: Dict[str, Dict[str, Any]] = {}
+    scores: Dict[str, float] = {}
+    for matches in result_sets:
+        if not matches:
+            continue
+        top_score = max(float(m.get("similarity") or 0.0) for m in matches)
+        if top_score <= 0:
+            continue
+        for match in matches:
+            similarity = float(match.get("similarity") or 0.0)
+            if similarity < top_score * relative_cutoff:
+                continue
+            key = match.get("id") or match["content"]
+            score = similarity / top_score
+            if score > scores.get(key, -1.0):
+                merged[key] = match
+                scores[key] = score
+
+    keys = sorted(merged, key=lambda k: scores[k], reverse=True)
+    candidates = [merged[k] for k in keys]
+    relevance = np.asarray([scores[k] for k in keys], dtype=np.float32)
+
+    vectors = [_parse_embedding(m.get("embedding")) for m in candidates]
+    if candidates and all(v is not None for v in vectors):
+        order = mmr_select(relevance, np.vstack(vectors), lambda_mult, len(candidates))
+        candidates = [candidates[i] for i in order]
+
+    packed: List[Dict[str, Any]] = []
+    used_tokens = 0
+    for match in candidates:
+        if len(packed) >= max_chunks:
+            break
+        cost = estimate_tokens(match["content"])
+        if used_tokens + cost > token_budget:
+            # Smaller, lower-ranked chunks may still fit
+            continue
+        packed.append(match)
+        used_tokens += cost
+    return packed
+
+
+def _join_chunks(left: str, right: str, overlap: Optional[int] = None) -> str:
+    # Consecutive chunks share up to chunk_overlap characters; drop the repeated text.
+    # overlap comes from the stored offsets when known; otherwise only a match long
+    # enough not to be a coincidence (a shared space or letter) is trimmed
+    if overlap is None:
+        overlap = 0
+        for size in range(min(len(left), len(right), CHUNK_OVERLAP_SEARCH), CHUNK_OVERLAP_MIN - 1, -1):
+            if left.endswith(right[:size]):
+                overlap = size
+                break
+    if 0 < overlap <= len(right):
+        return left + right[overlap:]
+    return left + "\n" + right
+
+
+def stitch_chunks(rows: List[Dict[str, Any]]) -> str:
+    """
+    Join chunk rows (ordered by chunk_index) into one passage. Consecutive chunks
+    are merged on their shared overlap; gaps are marked with an ellipsis.
+    """
+    content = ""
+    previous = None
+    for row in rows:
+        if not content:
+            content = row["content"]
+        elif previous is not None and previous["chunk_index"] == row["chunk_index"] - 1:
+            overlap = None
+            if previous.get("start_index") is not None and row.get("start_index") is not None:
+                # Exact: how far the previous chunk runs past this one's start
+                overlap = max(0, previous["start_index"] + len(previous["content"]) - row["start_index"])
+            content = _join_chunks(content, row["content"], overlap)
+        else:
+            content += "\n\n...\n\n" + row["content"]
+        previous = row
+    return content
+
+
+def _merge_windows(windows: List[List[int]]) -> List[List[int]]:
+    # windows: [first, last, rank]; overlapping or touching windows become one range
+    merged: List[List[int]] = []
+    for first, last, rank in sorted(windows):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+            merged[-1][2] = min(merged[-1][2], rank)
+        else:
+            merged.append([first, last, rank])
+    return merged
+
+
+async def expand_neighbors(
+    chunks: List[Dict[str, Any]],
+    *,
+    neighbors: int = RETRIEVAL_NEIGHBOR_CHUNKS,
+    token_budget: int = RETRIEVAL_EXPANDED_TOKEN_BUDGET,
+) -> List[Dict[str, Any]]:
+    """
+    Widen each hit to the neighbouring chunks of the same file and merge overlapping
+    windows into contiguous passages. All neighbours are fetched in one query.
+    Passages keep the rank of their best hit; chunks without position metadata
+    (ingested before it was stored) pass through unchanged.
+    """
+    if neighbors <= 0 or not chunks:
+        return chunks
+
+    windows: Dict[str, List[List[int]]] = {}
+    passthrough: List[tuple] = []
+    for rank, chunk in enumerate(chunks):
+        file_id = chunk.get("course_file_id")
+        index = chunk.get("chunk_index")
+        if not file_id or index is None:
+            passthrough.append((rank, chunk))
+            continue
+        last_index = (chunk.get("total_chunks") or index + neighbors + 1) - 1
+        windows.setdefault(file_id, []).append(
+            [max(0, index - neighbors), min(last_index, index + neighbors), rank]
+        )
+
+    ranges = {
+        file_id: _merge_windows(file_windows) for file_id, file_windows in windows.items()
+    }
+    chunk_ranges = [
+        (file_id, first, last)
+        for file_id, file_ranges in ranges.items()
+        for first, last, _ in file_ranges
+    ]
+    rows = await resilient_call(
+        "chunk_fetch", lambda: get_chunk_ranges(chunk_ranges), timeout=SEARCH_TIMEOUT
+    )
+    by_position = {(row["course_file_id"], row["chunk_index"]): row for row in rows}
+
+    passages: List[tuple] = list(passthrough)
+    for file_id, file_ranges in ranges.items():
+        for first, last, rank in file_ranges:
+            content = stitch_chunks([
+                by_position[(file_id, index)]
+                for index in range(first, last + 1)
+                if (file_id, index) in by_position
+            ])
+            if not content:
+                # Neighbour fetch missed: fall back to the hit itself
+                content = chunks[rank]["content"]
+            passages.append((rank, {
+                "course_file_id": file_id,
+                "chunk_range": [first, last],
+                "content": content,
+                "hit": chunks[rank]["content"],
+            }))
+    passages.sort(key=lambda item: item[0])
+
+    # Pack passages into the expanded budget; fall back to the bare hit when a passage is too big
+    packed: List[Dict[str, Any]] = []
+    used_tokens = 0
+    for _, passage in passages:
+        for content in (passage["content"], passage.get("hit")):
+            if not content:
+                continue
+            cost = estimate_tokens(content)
+            if used_tokens + cost <= token_budget:
+                packed.append({**passage, "content": content})
+                used_tokens += cost
+                break
+    return packed
+
+
+def format_context(chunks: List[Dict[str, Any]]) -> str:
+    return CHUNK_SEPARATOR.join(chunk["content"].strip() for chunk in chunks)
+
+
+def _course_filter(course_id: Optional[str], course_code: Optional[str]) -> Dict[str, str]:
+    # Build an optional filter for course scoping
+    filter_payload = {}
+    if course_id:
+        filter_payload["course_id"] = course_id
+    elif course_code:
+        filter_payload["course_code"] = course_code
+    return filter_payload
+
+
+async def _full_scan(embedding: List[float], filter_payload: Dict[str, str], ef_search: int) -> List[Dict[str, Any]]:
+    # Course-scoped ANN search (partial per-course index when one exists)
+    if filter_payload.get("course_id"):
+        call = lambda: match_course_documents(
+            embedding, filter_payload["course_id"], RETRIEVAL_CANDIDATES, ef_search
+        )
+    else:
+        call = lambda: match_documents(embedding, RETRIEVAL_CANDIDATES, filter_payload)
+    return await resilient_call("vector_search", call, timeout=SEARCH_TIMEOUT)
+
+
+async def _match(embedding: List[float], filter_payload: Dict[str, str], ef_search: int) -> List[Dict[str, Any]]:
+    # Two-stage search only pays off within a course; unscoped queries scan everything
+    if not (RETRIEVAL_TWO_STAGE and filter_payload):
+        return await _full_scan(embedding, filter_payload, ef_search)
+    matches = await resilient_call(
+        "vector_search",
+        lambda: match_documents_two_stage(
+            embedding,
+            RETRIEVAL_CANDIDATES,
+            filter_payload,
+            RETRIEVAL_FILE_CANDIDATES,
+            RETRIEVAL_SECTION_CANDIDATES,
+        ),
+        timeout=SEARCH_TIMEOUT,
+    )
+    if len(matches) < RETRIEVAL_FULL_SCAN_BELOW:
+        return await _full_scan(embedding, filter_payload, ef_search)
+    return matches
+
+
+def _remember_session_chunks(
+    session_id: str, filter_payload: Dict[str, str], result_sets: List[List[Dict[str, Any]]]
+) -> None:
+    # Newest candidates first, de-duplicated by chunk id, embeddings parsed once
+    scope, previous = _session_chunks.get(session_id, (filter_payload, []))
+    if scope != filter_payload:
+        previous = []
+    kept: List[Dict[str, Any]] = []
+    seen = set()
+    for match in [m for matches in result_sets for m in matches] + previous:
+        vector = _parse_embedding(match.get("embedding"))
+        if vector is None or not match.get("id") or match["id"] in seen:
+            continue
+        seen.add(match["id"])
+        kept.append({**match, "embedding": vector})
+    _session_chunks[session_id] = (filter_payload, kept[:RETRIEVAL_SESSION_MAX_CHUNKS])
+
+
+def _rerank_session_chunks(
+    session_id: str, filter_payload: Dict[str, str], query_embeddings: List[List[float]]
+) -> Optional[Tuple[List[List[Dict[str, Any]]], float]]:
+    """
+    Score the session's recent candidates against each query. Returns the result
+    sets and the weakest query's best similarity, or None when any query is not
+    covered well enough (or nothing is cached) and a fresh search is needed.
+    """
+    scope, chunks = _session_chunks.get(session_id, (None, []))
+    if scope != filter_payload or not chunks:
+        return None
+    docs = np.vstack([chunk["embedding"] for chunk in chunks])
+    docs = docs / np.clip(np.linalg.norm(docs, axis=1, keepdims=True), 1e-12, None)
+    result_sets: List[List[Dict[str, Any]]] = []
+    coverage = 1.0
+    for embedding in query_embeddings:
+        query = np.asarray(embedding, dtype=np.float32)
+        similarities = docs @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        best = float(similarities.max())
+        if best < RETRIEVAL_SESSION_SIMILARITY:
+            return None
+        coverage = min(coverage, best)
+        result_sets.append([
+            {**chunk, "similarity": float(similarity)} for chunk, similarity in zip(chunks, similarities)
+        ])
+    return result_sets, coverage
+
+
+async def _search(
+    queries: List[str],
+    query_embeddings: List[List[float]],
+    course_id: Optional[str],
+    course_code: Optional[str],
+    started: float,
+    ef_search: int = RETRIEVAL_EF_SEARCH,
+    session_id: Optional[str] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    filter_payload = _course_filter(course_id, course_code)
+    # Follow-ups are usually answered by what this session already retrieved
+    reused = None
+    if session_id and RETRIEVAL_SESSION_REUSE:
+        reused = _rerank_session_chunks(session_id, filter_payload, query_embeddings)
+    if reused is not None:
+        result_sets, coverage = reused
+    else:
+        # Query Supabase for relevant documents, scoped by course when available
+        result_sets = await asyncio.gather(*[
+            _match(embedding, filter_payload, ef_search) for embedding in query_embeddings
+        ])
+        if session_id and RETRIEVAL_SESSION_REUSE:
+            _remember_session_chunks(session_id, filter_payload, list(result_sets))
+    chunks = assemble_context(list(result_sets))
+    hits = len(chunks)
+    try:
+        chunks = await expand_neighbors(chunks)
+    except Exception as e:
+        print(f"Warning: Could not expand neighbouring chunks: {e}")
+    context = format_context(chunks) if chunks else ""
+
+    entry = {
+        "query": queries[0] if len(queries) == 1 else queries,
+        "candidates": sum(len(r) for r in result_sets),
+        "matches": hits,
+        "passages": len(chunks),
+        "tokens": estimate_tokens(context) if chunks else 0,
+        "elapsed_ms": int((time.perf_counter() - started) * 1000),
+    }
+    if reused is not None:
+        entry.update({"session_reuse": True, "similarity": round(coverage, 4)})
+    return context, entry
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    va = np.asarray(a, dtype=np.float32)
+    vb = np.asarray(b, dtype=np.float32)
+    denom = float(np.linalg.norm(va) * np.linalg.norm(vb))
+    return float(va @ vb) / denom if denom else 0.0
+
+
+def _normalize_query(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class RetrievalPrefetch:
+    """
+    Speculative retrieval for the raw user message, started alongside the agent's
+    first model call. The retrieval tool reuses the result when the agent's own
+    query is the same question (exact after normalisation, or by embedding similarity).
+    """
+
+    def __init__(
+        self,
+        query: str,
+        *,
+        course_id: Optional[str],
+        course_code: Optional[str],
+        session_id: Optional[str] = None,
+    ):
+        self.query = query
+        self.used = False
+        self._task = asyncio.create_task(self._run(course_id, course_code, session_id))
+        # Failures surface through result(); don't let an unawaited task log them
+        self._task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def _run(
+        self, course_id: Optional[str], course_code: Optional[str], session_id: Optional[str]
+    ) -> Tuple[List[float], str, Dict[str, Any]]:
+        started = time.perf_counter()
+        [embedding] = await get_embeddings([self.query])
+        context, entry = await _search(
+            [self.query], [embedding], course_id, course_code, started, session_id=session_id
+        )
+        return embedding, context, entry
+
+    async def lookup(self, query: str) -> Tuple[Optional[str], Optional[List[float]], Optional[Dict[str, Any]]]:
+        """
+        Returns (context, None, entry) on a hit. On a miss returns (None, embedding, None)
+        with the query's embedding when it had to be computed, so the caller can reuse it.
+        Never raises: a failed prefetch or embedding is a miss, and the caller's own
+        search (which degrades on errors) runs instead.
+        """
+        try:
+            embedding, context, entry = await self._task
+        except Exception as e:
+            print(f"Warning: Retrieval prefetch failed: {e}")
+            return None, None, None
+
+        if _normalize_query(query) == _normalize_query(self.query):
+            similarity = 1.0
+            query_embedding = None
+        else:
+            try:
+                [query_embedding] = await get_embeddings([query])
+            except Exception as e:
+                print(f"Warning: Could not embed query for prefetch lookup: {e}")
+                return None, None, None
+            similarity = _cosine(query_embedding, embedding)
+            if similarity < RETRIEVAL_PREFETCH_SIMILARITY:
+                return None, query_embedding, None
+
+        self.used = True
+        return context, None, {**entry, "query": query, "prefetched": True, "similarity": round(similarity, 4)}
+
+    def cancel(self) -> None:
+        if not self._task.done():
+            self._task.cancel()
+
+
+async def retrieve_documentation(
+    user_query: str,
+    *,
+    course_id: Optional[str] = None,
+    course_code: Optional[str] = None,
+    retrieval_log: Optional[List[Dict[str, Any]]] = None,
+    prefetch: Optional[RetrievalPrefetch] = None,
+    ef_search: int = RETRIEVAL_EF_SEARCH,
+    session_id: Optional[str] = None,
+) -> str:
+    """
+    Embed the query, fetch a wide candidate set scoped to the course and return the
+    assembled context as a single string for the agent. A matching prefetch is
+    returned as-is.
+    """
+    query_embeddings = None
+    if prefetch is not None and user_query and user_query.strip():
+        context, query_embedding, entry = await prefetch.lookup(user_query.strip())
+        if entry is not None:
+            if retrieval_log is not None:
+                retrieval_log.append(entry)
+            return context or "No relevant documentation found."
+        if query_embedding is not None:
+            query_embeddings = [query_embedding]
+
+    return await retrieve_documentation_batch(
+        [user_query],
+        course_id=course_id,
+        course_code=course_code,
+        retrieval_log=retrieval_log,
+        query_embeddings=query_embeddings,
+        ef_search=ef_search,
+        session_id=session_id,
+    )
+
+
+async def retrieve_documentation_batch(
+    sub_queries: List[str],
+    *,
+    course_id: Optional[str] = None,
+    course_code: Optional[str] = None,
+    retrieval_log: Optional[List[Dict[str, Any]]] = None,
+    query_embeddings: Optional[List[List[float]]] = None,
+    ef_search: int = RETRIEVAL_EF_SEARCH,
+    session_id: Optional[str] = None,
+) -> str:
+    """
+    Embed all sub-queries in one batch request, run their vector searches
+    concurrently and return one merged, de-duplicated context. With a session_id,
+    chunks retrieved earlier in the session are re-ranked first and the search is
+    skipped when they cover every sub-query.
+    """
+    queries = [q.strip() for q in sub_queries if q and q.strip()][:RETRIEVAL_MAX_SUB_QUERIES]
+    if not queries:
+        return "No relevant documentation found."
+    cache_key = (course_id, course_code, tuple(_normalize_query(q) for q in queries))
+    try:
+        # Get the embeddings for every query in one request
+        started = time.perf_counter()
+        if query_embeddings is None or len(query_embeddings) != len(queries):
+            query_embeddings = await get_embeddings(queries)
+
+        context, entry = await _search(
+            queries, query_embeddings, course_id, course_code, started, ef_search, session_id
+        )
+        if retrieval_log is not None:
+            retrieval_log.append(entry)
+
+        if not context:
+            return "No relevant documentation found."
+        _stale_contexts[cache_key] = context
+        return context
+
+    except Exception as e:
+        # Timed out, circuit open or backend error: degrade instead of failing the turn
+        print(f"Error retrieving documentation: {e}")
+        stale = _stale_contexts.get(cache_key)
+        if retrieval_log is not None:
+            retrieval_log.append({
+                "query": queries[0] if len(queries) == 1 else queries,
+                "degraded": "stale" if stale else "unavailable",
+                "error": str(e),
+            })
+        if stale:
+            return f"{STALE_NOTICE}\n\n{stale}"
+        return DEGRADED_NOTICE
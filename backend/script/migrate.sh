@@ -0,0 +1,32 @@
+#!/bin/bash
+
+# Apply backend/migrations/*.sql in numeric order
+# Usage: ./script/migrate.sh                 (local pgvector container, see docker-compose.pgvector.yml)
+#        DATABASE_URL=postgres://... ./script/migrate.sh   (any Postgres, e.g. the Supabase connection string)
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+COMPOSE_FILE="docker-compose.pgvector.yml"
+
+run_psql() {
+    if [ -n "${DATABASE_URL}" ]; then
+        psql "${DATABASE_URL}" -v ON_ERROR_STOP=1 -q "$@"
+    else
+        docker compose -f ${COMPOSE_FILE} exec -T pgvector psql -U postgres -d chatbot -v ON_ERROR_STOP=1 -q "$@"
+    fi
+}
+
+if [ -z "${DATABASE_URL}" ]; then
+    echo "🐘 Starting local pgvector container..."
+    docker compose -f ${COMPOSE_FILE} up -d --wait
+fi
+
+for migration in $(ls migrations/*.sql | sort); do
+    echo "📄 Applying ${migration}..."
+    run_psql < "${migration}"
+done
+
+echo ""
+echo "✅ Migrations applied!"
@@ -0,0 +1,57 @@
+#!/bin/bash
+
+# Benchmark course-scoped vector search latency as the number of courses grows.
+# Runs against the local pgvector container (docker-compose.pgvector.yml) with the
+# migrations applied, seeding synthetic courses step by step and checking the
+# per-course indexes and course-filtered searches (bench/check.sql).
+# Usage: ./script/vector-bench.sh
+# Tunables: COURSE_STEPS="5 20 50" CHUNKS_PER_COURSE=2000 EF_SEARCH=40 CLIENTS=4 DURATION=20
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+COMPOSE_FILE="docker-compose.pgvector.yml"
+COURSE_STEPS=${COURSE_STEPS:-"5 20 50"}
+CHUNKS_PER_COURSE=${CHUNKS_PER_COURSE:-2000}
+EF_SEARCH=${EF_SEARCH:-40}
+CLIENTS=${CLIENTS:-4}
+DURATION=${DURATION:-20}
+
+db() {
+    docker compose -f ${COMPOSE_FILE} exec -T pgvector "$@"
+}
+
+./script/migrate.sh
+
+echo ""
+echo "courses  chunks  tps      p50_ms  p95_ms  p99_ms"
+for courses in ${COURSE_STEPS}; do
+    db psql -U postgres -d chatbot -v ON_ERROR_STOP=1 -q \
+        -v courses=${courses} -v chunks=${CHUNKS_PER_COURSE} -f /bench/seed.sql > /dev/null
+    db psql -U postgres -d chatbot -v ON_ERROR_STOP=1 -q -t \
+        -c "select count(*) from sync_course_vector_indexes(${CHUNKS_PER_COURSE});" > /dev/null
+    # Fail early if the indexes or the course-filtered searches are wrong
+    db psql -U postgres -d chatbot -v ON_ERROR_STOP=1 -q -f /bench/check.sql > /dev/null
+
+    db sh -c "rm -f /tmp/bench_log*"
+    output=$(db pgbench -U postgres -d chatbot -n -c ${CLIENTS} -j ${CLIENTS} -T ${DURATION} \
+        -D courses=${courses} -D ef_search=${EF_SEARCH} \
+        -f /bench/search.sql --log --log-prefix=/tmp/bench_log 2>&1)
+    tps=$(echo "${output}" | awk '/^tps/ {print $3; exit}')
+
+    # Per-transaction logs: third column is the latency in microseconds
+    db sh -c "cat /tmp/bench_log*" | awk '{print $3}' | sort -n | awk -v courses=${courses} \
+        -v chunks=$((courses * CHUNKS_PER_COURSE)) -v tps=${tps} '
+        function pct(p,    i) { i = int(NR * p); if (i < 1) i = 1; return lat[i] / 1000 }
+        { lat[NR] = $1 }
+        END {
+            p50 = pct(0.50)
+            p95 = pct(0.95)
+            p99 = pct(0.99)
+            printf "%-8d %-7d %-8.1f %-7.2f %-7.2f %-7.2f\n", courses, chunks, tps, p50, p95, p99
+        }'
+done
+
+echo ""
+echo "✅ Benchmark complete (p95 should stay flat as courses are added)"
@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# Create per-course partial HNSW indexes for large courses and drop stale ones.
+# Run after bulk ingestion or on a schedule.
+# Usage: DATABASE_URL=postgres://... ./script/vector-indexes.sh [MIN_CHUNKS]
+
+set -e
+
+MIN_CHUNKS=${1:-2000}
+
+if [ -z "${DATABASE_URL}" ]; then
+    echo "DATABASE_URL is not set"
+    exit 1
+fi
+
+echo "🔧 Syncing per-course vector indexes (courses with >= ${MIN_CHUNKS} chunks)..."
+psql "${DATABASE_URL}" -v ON_ERROR_STOP=1 -c "select sync_course_vector_indexes(${MIN_CHUNKS}) as indexed_course_id;"
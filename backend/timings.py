@@ -0,0 +1,133 @@
+"""
+Per-turn latency breakdown, stored with each AI message (chat_messages.latency,
+see migrations/014_message_latency.sql).
+
+A Timings collector is bound to the context for the agent run of one chat turn.
+resilient_call records every embedding, vector search and chunk fetch, TimedModel
+records each LLM request with its token usage, and tool_call() groups the stages
+recorded inside one tool call. Outside a bound turn recording is a no-op.
+"""
+import time
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from pydantic_ai.models.wrapper import WrapperModel
+
+_current: contextvars.ContextVar[Optional["Timings"]] = contextvars.ContextVar("timings", default=None)
+_current_tool: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("timing_tool", default=None)
+
+
+def _ms(seconds: float) -> int:
+    return int(round(seconds * 1000))
+
+
+def _token_counts(usage: Any) -> Dict[str, Optional[int]]:
+    return {
+        "input_tokens": getattr(usage, "input_tokens", None),
+        "output_tokens": getattr(usage, "output_tokens", None),
+        "cached_tokens": getattr(usage, "cache_read_tokens", None),
+    }
+
+
+class Timings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        # Phases of the turn (lookups, begin_turn, agent), in milliseconds
+        self.phases: Dict[str, int] = {}
+        # External calls by operation name, one duration per call
+        self.stages: Dict[str, List[int]] = {}
+        self.llm_requests: List[Dict[str, Any]] = []
+        self.tool_calls: List[Dict[str, Any]] = []
+
+    def phase(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0) + _ms(seconds)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            **{f"{name}_ms": ms for name, ms in self.phases.items()},
+            "total_ms": _ms(time.perf_counter() - self.started),
+            "stages": self.stages,
+            "llm_requests": self.llm_requests,
+            "tool_calls": self.tool_calls,
+        }
+
+
+@contextmanager
+def bind_timings(timings: Timings) -> Iterator[Timings]:
+    """
+    Record into timings for everything awaited inside the block (tasks created
+    inside inherit it).
+    """
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def timed_phase(timings: Timings, name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.phase(name, time.perf_counter() - started)
+
+
+def record_stage(name: str, seconds: float) -> None:
+    timings = _current.get()
+    if timings is None:
+        return
+    timings.stages.setdefault(name, []).append(_ms(seconds))
+    tool = _current_tool.get()
+    if tool is not None:
+        tool["stages"].setdefault(name, []).append(_ms(seconds))
+
+
+@contextmanager
+def tool_call(name: str) -> Iterator[None]:
+    """
+    Time one tool call and attribute the stages recorded inside it to the call.
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    entry: Dict[str, Any] = {"tool": name, "stages": {}}
+    timings.tool_calls.append(entry)
+    token = _current_tool.set(entry)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry["ms"] = _ms(time.perf_counter() - started)
+        _current_tool.reset(token)
+
+
+class TimedModel(WrapperModel):
+    """
+    Model wrapper that records each request's duration and token usage.
+    """
+
+    async def request(self, *args, **kwargs):
+        started = time.perf_counter()
+        response = await super().request(*args, **kwargs)
+        self._record(started, response.usage)
+        return response
+
+    @asynccontextmanager
+    async def request_stream(self, *args, **kwargs) -> AsyncIterator[Any]:
+        started = time.perf_counter()
+        async with super().request_stream(*args, **kwargs) as stream:
+            try:
+                yield stream
+            finally:
+                # Streamed usage is complete once the caller has consumed the stream
+                self._record(started, stream.usage())
+
+    def _record(self, started: float, usage: Any) -> None:
+        timings = _current.get()
+        if timings is None:
+            return
+        timings.llm_requests.append({"ms": _ms(time.perf_counter() - started), **_token_counts(usage)})
@@ -1,15 +1,10 @@
-import os
 import uuid
 from datetime import datetime
-from supabase import create_client, Client
 from pydantic import BaseModel
 from fastapi import HTTPException
 from zoneinfo import ZoneInfo
 
-# Initialize Supabase
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+from database import get_user_by_email as fetch_user_by_email, insert_user
 
 class UserLoginRequest(BaseModel):
     email: str
@@ -27,11 +22,11 @@ async def login_user(request: UserLoginRequest) -> UserResponse:
     """
     try:        
         # Check if user already exists
-        existing_user = supabase.table("users").select("*").eq("email", request.email).execute()
+        existing_user = await fetch_user_by_email(request.email)
         
-        if existing_user.data:
+        if existing_user:
             # User exists, return existing data (preserves admin-assigned roles)
-            user = existing_user.data[0]
+            user = existing_user
             return UserResponse(
                 id=user["id"],
                 email=user["email"],
@@ -44,10 +39,9 @@ async def login_user(request: UserLoginRequest) -> UserResponse:
                 "role": "student"  # Use lowercase to match your database constraint
             }
             
-            result = supabase.table("users").insert(new_user_data).execute()
+            user = await insert_user(new_user_data)
             
-            if result.data:
-                user = result.data[0]
+            if user:
                 return UserResponse(
                     id=user["id"],
                     email=user["email"],
@@ -65,10 +59,9 @@ async def get_user_by_email(email: str) -> UserResponse:
     Get user information by email
     """
     try:        
-        user_data = supabase.table("users").select("*").eq("email", email).execute()
+        user = await fetch_user_by_email(email)
         
-        if user_data.data:
-            user = user_data.data[0]
+        if user:
             return UserResponse(
                 id=user["id"],
                 email=user["email"],
@@ -0,0 +1,85 @@
+"""
+Course warm-up, so a student's first question in a course chat doesn't pay the
+cold costs on its own.
+
+POST /courses/{course_id}/warm resolves the course (now cached) and then, in the
+background: builds the course agent, loads the documentation outline, runs one
+course-scoped retrieval (embedding client and connection, vector index pages,
+chunk fetch) and opens a pooled connection to the model provider. A course is
+warmed at most once per WARM_TTL per worker.
+"""
+import os
+import asyncio
+from typing import Dict, Set
+
+from cachetools import TTLCache
+from fastapi import HTTPException
+
+from agent import get_cpss_agent, llm
+from database import get_course
+from documentation import get_course_outline
+from llm_client import get_openai_client
+from retrieval import retrieve_documentation
+
+# Seconds before the same course is warmed again on this worker
+WARM_TTL = float(os.environ.get("COURSE_WARM_TTL", "300"))
+# Upper bound for one warm-up (seconds)
+WARM_TIMEOUT = float(os.environ.get("COURSE_WARM_TIMEOUT", "20"))
+
+# course_id -> True while recently warmed (or warming)
+_warmed: TTLCache = TTLCache(maxsize=1024, ttl=WARM_TTL)
+_background_tasks: Set[asyncio.Task] = set()
+
+
+async def _open_model_connection() -> None:
+    # A metadata request costs no tokens but leaves a TLS connection in the pool
+    await get_openai_client().models.retrieve(llm, timeout=5)
+
+
+async def _warm(course: Dict) -> None:
+    course_id = course["id"]
+    # Building the agent is synchronous (tool schemas, system prompt) and cached per course
+    get_cpss_agent(course.get("name"), course.get("code"))
+    query = " ".join(p for p in (course.get("code"), course.get("name")) if p) or "course overview"
+    steps = {
+        "outline": get_course_outline(course_id),
+        "retrieval": retrieve_documentation(query, course_id=course_id),
+        "model_connection": _open_model_connection(),
+    }
+    results = await asyncio.wait_for(
+        asyncio.gather(*steps.values(), return_exceptions=True), WARM_TIMEOUT
+    )
+    for name, result in zip(steps, results):
+        if isinstance(result, Exception):
+            print(f"Warning: Course warm-up step {name} failed for {course_id}: {result}")
+
+
+async def _warm_in_background(course: Dict) -> None:
+    try:
+        await _warm(course)
+    except Exception as e:
+        # Let the next request try again
+        _warmed.pop(course["id"], None)
+        print(f"Warning: Course warm-up failed for {course['id']}: {e}")
+
+
+async def warm_course(course_id: str) -> Dict:
+    """
+    Validate the course and start warming it without waiting for the result.
+    """
+    try:
+        course = await get_course(course_id, "id, code, name")
+        if not course:
+            raise HTTPException(status_code=404, detail="Course not found")
+        if course_id in _warmed:
+            return {"success": True, "warming": False}
+
+        _warmed[course_id] = True
+        task = asyncio.create_task(_warm_in_background(course))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        return {"success": True, "warming": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Warm course error: {str(e)}")
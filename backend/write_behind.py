@@ -0,0 +1,311 @@
+"""
+Write-behind persistence for chat writes that don't need to block the response.
+
+AI replies and session activity timestamps are appended to a local journal
+(fsync'd before the call returns) and the request answers straight away; a
+background flusher stores them in Supabase in batches, one chat_flush_writes
+call per batch (migrations/013_write_behind.sql), and empties the journal once
+everything in it is stored.
+
+- Each worker owns one journal file under an exclusive flock. On startup a worker
+  takes over every journal whose lock is free (its owner has exited) and replays
+  it, so writes acknowledged before a crash or restart are not lost.
+- Entries are flushed strictly in journal order and a failed batch is retried
+  until it is stored, so a session's writes land in order. Message ids are
+  assigned here and stored rows are skipped on replay. A reply's created_at is
+  fixed by the caller before it is journaled (derived from the database time of
+  its question, see chat_management._reply_created_at); messages without one and
+  the session's updated_at get the database clock at flush time
+  (migrations/017_chat_message_order.sql).
+- Anything that reads a session's latest messages (the next turn, the message
+  list, chat_runs rows referencing the reply) awaits flushed(session_id) first.
+"""
+import os
+import glob
+import json
+import uuid
+import fcntl
+import asyncio
+import itertools
+import threading
+from collections import deque
+from typing import IO, Any, Deque, Dict, List, Optional, Set, Tuple
+
+from database import flush_chat_writes
+
+WRITE_BEHIND = os.environ.get("CHAT_WRITE_BEHIND", "true").lower() in ("1", "true", "yes")
+JOURNAL_DIR = os.environ.get(
+    "CHAT_JOURNAL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal")
+)
+# Largest batch per flush, and how long the flusher lingers to collect one (seconds)
+FLUSH_BATCH_SIZE = int(os.environ.get("CHAT_FLUSH_BATCH_SIZE", "200"))
+FLUSH_LINGER = float(os.environ.get("CHAT_FLUSH_LINGER", "0.02"))
+FLUSH_MAX_BACKOFF = 30.0
+# How long a reader waits for a session's pending writes before going ahead (seconds)
+FLUSH_WAIT_TIMEOUT = float(os.environ.get("CHAT_FLUSH_WAIT_TIMEOUT", "3"))
+# Time allowed on shutdown to flush what is left; the rest is replayed on the next start
+SHUTDOWN_FLUSH_TIMEOUT = float(os.environ.get("CHAT_SHUTDOWN_FLUSH_TIMEOUT", "5"))
+
+
+class Journal:
+    """
+    Append-only JSON-lines file owned by this worker, plus the entries in it that
+    are not stored yet. File operations block, so callers run them in a thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a+", encoding="utf-8")
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._lock = threading.Lock()
+        self.pending: Deque[Dict[str, Any]] = deque()
+
+    def append(self, entries: List[Dict[str, Any]]) -> None:
+        data = "".join(json.dumps(entry, separators=(",", ":"), default=str) + "\n" for entry in entries)
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.pending.extend(entries)
+
+    def peek(self, limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(itertools.islice(self.pending, limit))
+
+    def ack(self, count: int) -> None:
+        with self._lock:
+            for _ in range(count):
+                self.pending.popleft()
+            if not self.pending:
+                # Everything journaled is stored; start the file over
+                self._file.truncate(0)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def close(self, remove: bool) -> None:
+        with self._lock:
+            if remove:
+                os.remove(self.path)
+            self._file.close()
+
+
+def _read_orphaned_journals(own_path: str) -> Tuple[List[Dict[str, Any]], List[Tuple[str, IO]]]:
+    """
+    Collect the entries of journals left by exited workers. The files stay locked
+    (and on disk) until the caller has re-journaled the entries.
+    """
+    entries: List[Dict[str, Any]] = []
+    handles: List[Tuple[str, IO]] = []
+    for path in sorted(glob.glob(os.path.join(JOURNAL_DIR, "chat-*.jsonl"))):
+        if path == own_path:
+            continue
+        handle = open(path, "r", encoding="utf-8")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Owned by a live worker
+            handle.close()
+            continue
+        for line in handle:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A write torn by the crash was never acknowledged
+                print(f"Warning: Skipping unreadable journal line in {path}")
+        handles.append((path, handle))
+    return entries, handles
+
+
+async def _store(batch: List[Dict[str, Any]]) -> None:
+    messages = [entry["row"] for entry in batch if entry["op"] == "message"]
+    touches = [{"session_id": entry["session_id"]} for entry in batch if entry["op"] == "touch"]
+    await flush_chat_writes(messages, touches)
+
+
+class WriteBehind:
+    def __init__(self, journal: Journal):
+        self.journal = journal
+        self.loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        # session_id -> set while the session has journaled writes not yet stored
+        self._unflushed: Dict[str, asyncio.Event] = {}
+        self._counts: Dict[str, int] = {}
+        # Ids of journaled messages not yet stored
+        self._pending_ids: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.journal.pending:
+            self._track(self.journal.pending)
+            self._wake.set()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    def _track(self, entries) -> None:
+        for entry in entries:
+            session_id = entry["session_id"]
+            self._counts[session_id] = self._counts.get(session_id, 0) + 1
+            self._unflushed.setdefault(session_id, asyncio.Event())
+            if entry["op"] == "message":
+                self._pending_ids.add(entry["row"]["id"])
+
+    def _settle(self, entries) -> None:
+        for entry in entries:
+            session_id = entry["session_id"]
+            if entry["op"] == "message":
+                self._pending_ids.discard(entry["row"]["id"])
+            self._counts[session_id] -= 1
+            if not self._counts[session_id]:
+                del self._counts[session_id]
+                self._unflushed.pop(session_id).set()
+
+    async def write(self, entries: List[Dict[str, Any]]) -> None:
+        self._track(entries)
+        append = asyncio.ensure_future(asyncio.to_thread(self.journal.append, entries))
+        append.add_done_callback(lambda future: self._appended(future, entries))
+        # The append finishes in its thread even if the request is cancelled meanwhile
+        await asyncio.shield(append)
+
+    def _appended(self, future: asyncio.Future, entries: List[Dict[str, Any]]) -> None:
+        if future.cancelled() or future.exception() is not None:
+            self._settle(entries)
+        else:
+            self._wake.set()
+
+    async def flushed(self, session_id: str) -> None:
+        event = self._unflushed.get(session_id)
+        if event is None:
+            return
+        try:
+            await asyncio.wait_for(event.wait(), FLUSH_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Warning: Writes for session {session_id} are still pending, continuing without them")
+
+    async def _flush_pending(self) -> None:
+        backoff = 1.0
+        while True:
+            batch = self.journal.peek(FLUSH_BATCH_SIZE)
+            if not batch:
+                return
+            try:
+                await _store(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Retry the same batch so later writes never overtake it
+                print(f"Warning: Could not flush {len(batch)} chat writes, retrying in {backoff:.0f}s: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, FLUSH_MAX_BACKOFF)
+                continue
+            backoff = 1.0
+            await asyncio.to_thread(self.journal.ack, len(batch))
+            self._settle(batch)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            # Let a burst of replies collect into one batch
+            await asyncio.sleep(FLUSH_LINGER)
+            await self._flush_pending()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        try:
+            await asyncio.wait_for(self._flush_pending(), SHUTDOWN_FLUSH_TIMEOUT)
+        except Exception as e:
+            print(f"Warning: {len(self.journal.pending)} chat writes left in the journal for replay: {e}")
+        self.journal.close(remove=not self.journal.pending)
+
+
+_writer: Optional[WriteBehind] = None
+
+
+async def start_write_behind() -> None:
+    """
+    Open this worker's journal, take over journals of exited workers and start
+    the flusher (called on app startup).
+    """
+    global _writer
+    if not WRITE_BEHIND or _writer is not None:
+        return
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    journal = await asyncio.to_thread(
+        Journal, os.path.join(JOURNAL_DIR, f"chat-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl")
+    )
+    entries, handles = await asyncio.to_thread(_read_orphaned_journals, journal.path)
+    if entries:
+        # Re-journal before deleting the old files, so a crash here loses nothing
+        await asyncio.to_thread(journal.append, entries)
+        print(f"Replaying {len(entries)} chat writes from {len(handles)} journal(s)")
+    for path, handle in handles:
+        os.remove(path)
+        handle.close()
+    _writer = WriteBehind(journal)
+    _writer.start()
+
+
+async def stop_write_behind() -> None:
+    """
+    Flush what is left and release the journal (called on app shutdown).
+    """
+    global _writer
+    if _writer is not None:
+        writer, _writer = _writer, None
+        await writer.stop()
+
+
+def _active_writer() -> Optional[WriteBehind]:
+    if _writer is None:
+        return None
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+    return _writer if running is _writer.loop else None
+
+
+async def persist_message(row: Dict[str, Any], touch_session: bool = True) -> str:
+    """
+    Store a chat message, and move its session's updated_at forward, behind the
+    response. Returns the message id, assigned here so callers can use it straight
+    away. Writes directly when write-behind is off.
+    """
+    row = {**row, "id": row.get("id") or str(uuid.uuid4())}
+    if not row.get("created_at"):
+        row.pop("created_at", None)
+    entries = [{"op": "message", "session_id": row["session_id"], "row": row}]
+    if touch_session:
+        entries.append({"op": "touch", "session_id": row["session_id"]})
+
+    writer = _active_writer()
+    if writer is None:
+        await _store(entries)
+        return row["id"]
+    try:
+        await writer.write(entries)
+    except OSError as e:
+        print(f"Warning: Could not journal chat write, storing directly: {e}")
+        await _store(entries)
+    return row["id"]
+
+
+async def flushed(session_id: Optional[str]) -> None:
+    """
+    Wait (briefly) until the session's journaled writes are stored.
+    """
+    writer = _active_writer()
+    if writer is not None and session_id:
+        await writer.flushed(session_id)
+
+
+def is_pending(message_id: Optional[str]) -> bool:
+    """
+    Whether the message is journaled on this worker but not stored yet.
+    """
+    writer = _active_writer()
+    return writer is not None and message_id in writer._pending_ids
@@ -55,13 +55,20 @@ export async function fetchUserSessions(params: {
 }): Promise<SessionItem[]> {
   const backendUrl =
     process.env.NEXT_PUBLIC_BACKEND_URL || "http://localhost:8000";
-  const query = new URLSearchParams();
-  if (params.userId) query.set("user_id", params.userId);
-  if (params.userEmail) query.set("user_email", params.userEmail);
-  const resp = await fetch(`${backendUrl}/chat/sessions?${query.toString()}`);
-  if (!resp.ok) throw new Error(`Failed to fetch sessions (${resp.status})`);
-  const data = await resp.json();
-  const sessions = (data.sessions || []) as Array<any>;
+  const sessions: Array<any> = [];
+  let cursor: string | null = null;
+  // The backend returns one page at a time (newest activity first); follow next_cursor
+  do {
+    const query = new URLSearchParams();
+    if (params.userId) query.set("user_id", params.userId);
+    if (params.userEmail) query.set("user_email", params.userEmail);
+    if (cursor) query.set("cursor", cursor);
+    const resp = await fetch(`${backendUrl}/chat/sessions?${query.toString()}`);
+    if (!resp.ok) throw new Error(`Failed to fetch sessions (${resp.status})`);
+    const data = await resp.json();
+    sessions.push(...((data.sessions || []) as Array<any>));
+    cursor = data.has_more ? data.next_cursor : null;
+  } while (cursor);
   return sessions.map((s) => ({
     id: s.id,
     title:
@@ -84,10 +91,20 @@ export async function fetchSessionMessages(
 ): Promise<SessionMessage[]> {
   const backendUrl =
     process.env.NEXT_PUBLIC_BACKEND_URL || "http://localhost:8000";
-  const resp = await fetch(`${backendUrl}/chat/sessions/${sessionId}/messages`);
-  if (!resp.ok) throw new Error(`Failed to fetch messages (${resp.status})`);
-  const data = await resp.json();
-  const messages = (data.messages || []) as Array<any>;
+  let messages: Array<any> = [];
+  let cursor: string | null = null;
+  // Pages run from the newest messages backwards (each page oldest first); follow
+  // next_cursor and put each older page in front
+  do {
+    const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : "";
+    const resp = await fetch(
+      `${backendUrl}/chat/sessions/${sessionId}/messages${query}`
+    );
+    if (!resp.ok) throw new Error(`Failed to fetch messages (${resp.status})`);
+    const data = await resp.json();
+    messages = [...((data.messages || []) as Array<any>), ...messages];
+    cursor = data.has_more ? data.next_cursor : null;
+  } while (cursor);
   return messages.map((m) => ({
     id: m.id,
     content: m.content,